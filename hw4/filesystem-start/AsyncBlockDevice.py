@@ -0,0 +1,328 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from BlockDevice import BlockDevice
+import FileSystem
+
+
+class AsyncBlockDevice:
+    """ An asyncio front end for a BlockDevice.
+        Every request is handed to a bounded pool of worker threads, so
+        awaiting a read or write never blocks the event loop. Because
+        BlockDevice I/O is positional, the workers really do run their
+        requests in parallel.
+
+        queue_depth is how many requests can be at the device at once (the
+        number of worker threads). max_in_flight is how many requests can
+        be outstanding in total, counting the ones waiting for a worker;
+        callers past that limit wait (in the event loop) for a slot, which
+        keeps a burst of requests from queueing unbounded work.
+    """
+
+    def __init__(self, bd: BlockDevice, queue_depth=4, max_in_flight=None):
+        """
+        :param bd:            the (open) BlockDevice to wrap
+        :param queue_depth:   number of requests the device works on at once
+        :param max_in_flight: limit on outstanding requests, default 2 * queue_depth
+        """
+        assert queue_depth > 0, "invalid queue depth: {}".format(queue_depth)
+        if max_in_flight is None:
+            max_in_flight = 2 * queue_depth
+        assert max_in_flight >= queue_depth, "max_in_flight must be at least queue_depth"
+        self.block_device = bd
+        self.block_size = bd.block_size
+        self.num_blocks = bd.num_blocks
+        self.queue_depth = queue_depth
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=queue_depth)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def _submit(self, fn, *args):
+        async with self.in_flight:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def read_block(self, block_num, buff):
+        await self._submit(self.block_device.read_block, block_num, buff)
+
+    async def write_block(self, block_num, buff, pad=False):
+        await self._submit(self.block_device.write_block, block_num, buff, pad)
+
+    async def read_blocks(self, start, count, buff):
+        await self._submit(self.block_device.read_blocks, start, count, buff)
+
+    async def write_blocks(self, start, buff):
+        await self._submit(self.block_device.write_blocks, start, buff)
+
+    async def readv_blocks(self, start, buffers):
+        await self._submit(self.block_device.readv_blocks, start, buffers)
+
+    async def writev_blocks(self, start, buffers):
+        await self._submit(self.block_device.writev_blocks, start, buffers)
+
+    async def view_blocks(self, start, count):
+        return await self._submit(self.block_device.view_blocks, start, count)
+
+    def shutdown(self):
+        """ Stop the worker threads, without closing the wrapped device """
+        self.executor.shutdown(wait=True)
+
+    async def close(self):
+        """ Wait for outstanding requests, then close the wrapped device """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.shutdown)
+        self.block_device.close()
+
+
+class AsyncFileSystem:
+    """ async wrappers for a mounted FileSystem.
+        The FileSystem itself isn't thread-safe, so everything that touches
+        its metadata (mount, unmount, open, block lookups, writes into the
+        cache) runs on one dedicated thread, in order. Only the data block
+        fetches of a read fan out to the AsyncBlockDevice, which is what lets
+        a whole-file read overlap its device requests.
+    """
+
+    def __init__(self, fs, adev: AsyncBlockDevice, fs_executor=None):
+        self.fs = fs
+        self.async_device = adev
+        if fs_executor is None:
+            fs_executor = ThreadPoolExecutor(max_workers=1)
+        self.fs_executor = fs_executor
+
+    async def run(self, fn, *args, **kwargs):
+        """ Run fn(*args, **kwargs) on the file system thread (taking turns with a Flusher) """
+        def locked():
+            with self.fs.lock:
+                return fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.fs_executor, locked)
+
+    async def throttle(self):
+        """ Wait on the file system thread, not holding fs.lock, for the flusher to catch up """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.fs_executor, self.fs.throttle)
+
+    @staticmethod
+    async def mount(name, queue_depth=4, max_in_flight=None, **mount_args):
+        """
+        async version of FileSystem.mount
+        :param name:          name of device
+        :param queue_depth:   see AsyncBlockDevice
+        :param max_in_flight: see AsyncBlockDevice
+        :param mount_args:    passed along to FileSystem.mount
+        :return: AsyncFileSystem object or None if invalid file system
+        """
+        fs_executor = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        fs = await loop.run_in_executor(fs_executor,
+                                        functools.partial(FileSystem.FileSystem.mount, name, **mount_args))
+        if fs is None:
+            fs_executor.shutdown()
+            return None
+        return AsyncFileSystem(fs, AsyncBlockDevice(fs.block_device, queue_depth, max_in_flight), fs_executor)
+
+    async def unmount(self):
+        """ async version of FileSystem.unmount """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.async_device.shutdown)
+        ret = await self.run(self.fs.unmount)
+        self.fs_executor.shutdown()
+        return ret
+
+    async def open(self, path, mode):
+        """ async version of FileSystem.open - returns an AsyncFile, or None """
+        f = await self.run(self.fs.open, path, mode)
+        if f is None:
+            return None
+        return AsyncFile(self, f)
+
+
+class AsyncFile:
+    """ async wrapper for a File, returned by AsyncFileSystem.open """
+
+    def __init__(self, afs: AsyncFileSystem, f):
+        self.afs = afs
+        self.file = f
+
+    async def read(self, buff):
+        """
+        Read len(buff) bytes from the current offset. The blocks to fetch are
+        planned on the file system thread (which also reads ahead, as
+        File.read does), then every run of uncached blocks is requested from
+        the device at once, so they overlap. If the file system changed any
+        blocks while they were being fetched, the fetched copies may be stale,
+        so the read is planned again and done under fs.lock.
+        :param buff: bytearray to read in to
+        :return:     number of bytes read
+        """
+        fs = self.afs.fs
+        inode = self.file.inode
+        offset = self.file.offset
+
+        def plan():
+            self.file.readahead.access(inode, offset, len(buff))
+            return inode.planRead(offset, len(buff)) + (fs.blockCache.changes,)
+
+        bytes_wanted, runs, changes = await self.afs.run(plan)
+        adev = self.afs.async_device
+
+        async def fetch(block_addr, count, from_device):
+            if not from_device:
+                return None
+            run_buffer = bytearray(adev.block_size * count)
+            await adev.read_blocks(block_addr, count, run_buffer)
+            return run_buffer
+
+        run_views = await asyncio.gather(*[fetch(*run) for run in runs])
+
+        def copy():
+            if fs.blockCache.changes == changes:
+                return inode.copyRuns(offset, buff, bytes_wanted, runs, run_views)
+            # written (or truncated) since the plan: the device and the cache agree under the lock
+            new_wanted, new_runs = inode.planRead(offset, len(buff))
+            new_views = [fs.block_device.view_blocks(block_addr, count) if from_device else None
+                         for (block_addr, count, from_device) in new_runs]
+            return inode.copyRuns(offset, buff, new_wanted, new_runs, new_views)
+
+        num_read = await self.afs.run(copy)
+        fs.op_counts["read"] += 1
+        fs.op_counts["read_bytes"] += num_read
+        self.file.offset += num_read
+        return num_read
+
+    async def write(self, buff):
+        """ async version of File.write """
+        await self.afs.throttle()
+        return await self.afs.run(self.file.write, buff)
+
+
+# Nosetests
+def test_async_block_device():
+    async def go():
+        bd = BlockDevice('testBlockAsync', 16, create=True)
+        adev = AsyncBlockDevice(bd, queue_depth=2, max_in_flight=3)
+        await asyncio.gather(*[adev.write_block(i, bytearray([i]) * adev.block_size)
+                               for i in range(adev.num_blocks)])
+        buffs = [bytearray(adev.block_size) for i in range(adev.num_blocks)]
+        await asyncio.gather(*[adev.read_block(i, buffs[i]) for i in range(adev.num_blocks)])
+        run = bytearray(4 * adev.block_size)
+        await adev.read_blocks(4, 4, run)
+        await adev.close()
+        return buffs, run
+
+    buffs, run = asyncio.run(go())
+    for i in range(len(buffs)):
+        assert buffs[i] == bytearray([i]) * len(buffs[i]), "async read_block data mismatch"
+    assert run[0] == 4 and run[-1] == 7, "async read_blocks data mismatch"
+
+def test_async_file_read():
+    from INode import INodeType
+    FileSystem.FileSystem.createFileSystem("nose_fs_async", block_count=200, block_size=1024)
+    fs = FileSystem.FileSystem.mount("nose_fs_async")
+    root = fs.inode_map[fs.root_dir_inode]
+    f_index = fs.allocINode(INodeType.FILE)
+    FileSystem.File.inode_to_object(fs, root, None, "w").add_child("data", fs.inode_map[f_index])
+    fs.unmount()
+
+    data = bytearray(i % 253 for i in range(5 * 1024 + 17))
+
+    async def go():
+        afs = await AsyncFileSystem.mount("nose_fs_async", queue_depth=3)
+        f = await afs.open("/data", "w")
+        await f.write(data)
+        await afs.unmount()
+
+        afs = await AsyncFileSystem.mount("nose_fs_async", queue_depth=3)
+        f = await afs.open("/data", "r")
+        buff = bytearray(len(data))
+        num_read = await f.read(buff)
+        await afs.unmount()
+        return num_read, buff
+
+    num_read, buff = asyncio.run(go())
+    assert num_read == len(data)
+    assert buff == data
+
+def test_async_read_during_write():
+    from INode import INodeType
+    FileSystem.FileSystem.createFileSystem("nose_fs_async_race", block_count=200, block_size=1024)
+    fs = FileSystem.FileSystem.mount("nose_fs_async_race")
+    root = fs.inode_map[fs.root_dir_inode]
+    f_index = fs.allocINode(INodeType.FILE)
+    FileSystem.File.inode_to_object(fs, root, None, "w").add_child("data", fs.inode_map[f_index])
+    fs.inode_map[f_index].write(0, bytearray(b'o' * 8 * 1024))
+    fs.unmount()
+
+    async def go():
+        afs = await AsyncFileSystem.mount("nose_fs_async_race", queue_depth=2, max_readahead=0)
+        f = await afs.open("/data", "r")
+        fetch = afs.async_device.read_blocks
+
+        async def fetch_then_write(start, count, buff):
+            # a write lands after the device runs were fetched, before they're copied
+            await fetch(start, count, buff)
+            await afs.run(f.file.inode.write, 0, bytearray(b'n' * 2048))
+        afs.async_device.read_blocks = fetch_then_write
+        buff = bytearray(4 * 1024)
+        reads = afs.fs.op_counts["read"]
+        num_read = await f.read(buff)
+        afs.async_device.read_blocks = fetch
+        reads = afs.fs.op_counts["read"] - reads
+        await afs.unmount()
+        return num_read, buff, reads
+
+    num_read, buff, reads = asyncio.run(go())
+    assert num_read == len(buff) and reads == 1
+    assert buff == b'n' * 2048 + b'o' * 2048, "read copied stale device data"
+
+def test_async_readahead():
+    from INode import INodeType
+    FileSystem.FileSystem.createFileSystem("nose_fs_async_ra", block_count=200, block_size=1024)
+    fs = FileSystem.FileSystem.mount("nose_fs_async_ra")
+    root = fs.inode_map[fs.root_dir_inode]
+    f_index = fs.allocINode(INodeType.FILE)
+    FileSystem.File.inode_to_object(fs, root, None, "w").add_child("data", fs.inode_map[f_index])
+    data = bytearray(i % 241 for i in range(32 * 1024))
+    fs.inode_map[f_index].write(0, data)
+    fs.unmount()
+
+    async def go():
+        afs = await AsyncFileSystem.mount("nose_fs_async_ra", max_readahead=16)
+        f = await afs.open("/data", "r")
+        readback = bytearray()
+        buff = bytearray(1024)
+        while await f.read(buff) > 0:
+            readback += buff
+        prefetched = afs.fs.blockCache.prefetched
+        await afs.unmount()
+        return readback, prefetched
+
+    readback, prefetched = asyncio.run(go())
+    assert readback == data and prefetched > 0, "sequential async reads should read ahead"
+
+def test_async_write_throttled():
+    from INode import INodeType
+    FileSystem.FileSystem.createFileSystem("nose_fs_async_throttle", block_count=300, block_size=1024)
+    fs = FileSystem.FileSystem.mount("nose_fs_async_throttle")
+    root = fs.inode_map[fs.root_dir_inode]
+    FileSystem.File.inode_to_object(fs, root, None, "w").add_child(
+        "data", fs.inode_map[fs.allocINode(INodeType.FILE)])
+    fs.unmount()
+    data = bytearray(i % 251 for i in range(16 * 1024))     # past dirty_ratio in one write
+
+    async def go():
+        afs = await AsyncFileSystem.mount("nose_fs_async_throttle", cache_blocks=64, writeback_interval=10,
+                                          dirty_background_ratio=0.1, dirty_ratio=0.2)
+        f = await afs.open("/data", "w")
+        for i in range(10):
+            f.file.offset = 0   # the same blocks, dirtied again each time
+            await f.write(data)
+        stats = afs.fs.flusher.stats()
+        await afs.unmount()
+        return stats
+
+    stats = asyncio.run(go())
+    # a writer waiting while it holds fs.lock waits out the whole interval for
+    # a flusher that needs the lock, and gives up
+    assert stats["throttled"] > 0 and stats["timeouts"] == 0
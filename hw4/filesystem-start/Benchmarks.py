@@ -0,0 +1,189 @@
+import time
+import FileSystem
+from File import File, Directory
+from INode import INodeType
+from RAMBlockDevice import RAMBlockDevice
+
+# Benchmarks run on a RAM device, so they measure the file system and not the host's disk.
+# Run them with:  python Benchmarks.py
+
+
+def cacheHitRates(policy, cache_blocks=64, hot_files=16, big_blocks=1024, rounds=6):
+    """
+    A mixed scan-plus-lookup workload: a handful of small "hot" files are read
+    over and over (think directories and config files), and between rounds of
+    that, a big file is read from start to end.
+
+    :param policy:       block cache policy to mount with
+    :param cache_blocks: block cache capacity - much smaller than the big file
+    :param hot_files:    how many one-block hot files
+    :param big_blocks:   size of the big file, in blocks
+    :param rounds:       how many lookup/scan rounds
+    :return:             dict of "lookup" and "overall" cache hit rates
+    """
+    num_blocks = big_blocks + hot_files + 200
+    rd = RAMBlockDevice("bench_cache", num_blocks)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=num_blocks)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=cache_blocks, cache_policy=policy)
+    hot = []
+    for i in range(hot_files):
+        inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+        inode.write(0, bytearray([i]) * fs.block_size)
+        hot.append(inode)
+    big = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    big.write(0, bytearray(big_blocks * fs.block_size))
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=cache_blocks, cache_policy=policy)
+    cache = fs.blockCache
+    hot = [fs.inode_map[inode.inode_num] for inode in hot]
+    big = fs.inode_map[big.inode_num]
+    block = bytearray(fs.block_size)
+    chunk = bytearray(16 * fs.block_size)
+    lookup_hits = lookup_total = 0
+    for r in range(rounds):
+        for repeat in range(2):
+            for inode in hot:
+                before = cache.hits
+                inode.read(0, block)
+                lookup_hits += cache.hits - before
+                lookup_total += 1
+        offset = 0
+        while offset < big.length:
+            offset += big.read(offset, chunk)
+    ret = {"lookup": lookup_hits / lookup_total, "overall": cache.hitRate()}
+    fs.unmount()
+    return ret
+
+
+def cacheHitRatesAsString(**kwargs):
+    ret = "policy   lookup hit rate   overall hit rate\n"
+    for policy in ("lru", "2q"):
+        rates = cacheHitRates(policy, **kwargs)
+        ret += "{:<8} {:>15.1%}   {:>16.1%}\n".format(policy, rates["lookup"], rates["overall"])
+    return ret
+
+
+def readThroughput(max_readahead, file_blocks=4096, chunk_bytes=4096):
+    """
+    cat a big file: read it from start to end, chunk_bytes at a time, through File.read
+
+    :param max_readahead: read-ahead window limit to mount with (0 is no read-ahead),
+                          or None to time reading the device directly instead
+    :return:              (MB/s, device read requests)
+    """
+    num_blocks = file_blocks + 300    # room for the block map and inode table too
+    rd = RAMBlockDevice("bench_read", num_blocks)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=num_blocks)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(b'r' * (file_blocks * fs.block_size)))
+    fs.unmount()
+
+    chunk = bytearray(chunk_bytes)
+    if max_readahead is None:
+        rd.iostats.reset()
+        start = time.perf_counter()
+        blocks_per_chunk = chunk_bytes // rd.block_size
+        for block_num in range(0, file_blocks, blocks_per_chunk):
+            rd.read_blocks(block_num, blocks_per_chunk, chunk)
+        elapsed = time.perf_counter() - start
+        return file_blocks * rd.block_size / elapsed / 1e6, rd.iostats.snapshot()["read"]["requests"]
+
+    fs = FileSystem.FileSystem.mount(rd, max_readahead=max_readahead)
+    f = File(fs, None, fs.inode_map[inode.inode_num], "r")
+    fs.resetIOStats()
+    start = time.perf_counter()
+    while f.read(chunk) > 0:
+        pass
+    elapsed = time.perf_counter() - start
+    requests = fs.ioStats()["device"]["read"]["requests"]
+    fs.unmount()
+    return inode.length / elapsed / 1e6, requests
+
+
+def readThroughputAsString(**kwargs):
+    ret = "                    MB/s   device reads\n"
+    for name, max_readahead in (("raw device", None), ("no read-ahead", 0),
+                                ("read-ahead", FileSystem.DEFAULT_MAX_READAHEAD)):
+        mbps, requests = readThroughput(max_readahead, **kwargs)
+        ret += "{:<15} {:>8.1f}   {:>12}\n".format(name, mbps, requests)
+    return ret
+
+
+def seekDistance(locality, dirs=4, files_per_dir=4, file_blocks=64, chunk_blocks=4, num_blocks=8192):
+    """
+    Several writers at once, each filling the files of its own directory,
+    their writes interleaved chunk by chunk (think of a few untars running
+    side by side). Then read every file back from start to end, one
+    directory at a time, and see how far the disk head had to travel.
+
+    :param locality: mount with goal-directed allocation, or lowest free block first
+    :return:         (total read seek distance in blocks, device read requests)
+    """
+    rd = RAMBlockDevice("bench_seek", num_blocks)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=num_blocks)
+    fs = FileSystem.FileSystem.mount(rd, locality=locality)
+    root = fs.inode_map[fs.root_dir_inode]
+    root_dir = Directory(fs, None, "w", root)
+    paths = []
+    files = []
+    for d in range(dirs):
+        dir_inode = fs.inode_map[fs.allocINode(INodeType.DIRECTORY, parent=root.inode_num)]
+        root_dir.add_child("d{}".format(d), dir_inode)
+        directory = Directory(fs, root, "w", dir_inode)
+        for f in range(files_per_dir):
+            inode = fs.inode_map[fs.allocINode(INodeType.FILE, parent=dir_inode.inode_num)]
+            directory.add_child("f{}".format(f), inode)
+            paths.append("/d{}/f{}".format(d, f))
+            files.append(inode)
+    chunk = bytearray(b's' * (chunk_blocks * fs.block_size))
+    for offset in range(0, file_blocks * fs.block_size, len(chunk)):
+        for f in range(files_per_dir):
+            for d in range(dirs):
+                files[d * files_per_dir + f].write(offset, chunk)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd, locality=locality)
+    fs.resetIOStats()
+    for path in paths:
+        f = fs.open(path, "r")
+        while f.read(chunk) > 0:
+            pass
+    fs.unmount()
+    stats = rd.iostats.snapshot()["read"]
+    return stats["seek_distance"], stats["requests"]
+
+
+def seekDistanceAsString(**kwargs):
+    ret = "                 seek distance   device reads\n"
+    for name, locality in (("lowest free", False), ("locality", True)):
+        distance, requests = seekDistance(locality, **kwargs)
+        ret += "{:<15} {:>15}   {:>12}\n".format(name, distance, requests)
+    return ret
+
+
+if __name__ == "__main__":
+    print("Block cache, small files looked up between scans of a big file:")
+    print(cacheHitRatesAsString())
+    print("Sequential read of a big file, 4K at a time:")
+    print(readThroughputAsString())
+    print("Reading back files written by writers in different directories at once:")
+    print(seekDistanceAsString())
+
+
+# Nosetests
+def test_2q_keeps_lookups_through_scans():
+    lru = cacheHitRates("lru", big_blocks=256, rounds=3)
+    twoq = cacheHitRates("2q", big_blocks=256, rounds=3)
+    assert twoq["lookup"] > lru["lookup"], "2Q should beat LRU on lookups between scans"
+
+def test_readahead_merges_reads():
+    plain_mbps, plain_requests = readThroughput(0, file_blocks=256)
+    ra_mbps, ra_requests = readThroughput(FileSystem.DEFAULT_MAX_READAHEAD, file_blocks=256)
+    assert ra_requests * 4 < plain_requests
+
+def test_locality_cuts_seeks():
+    plain_distance, plain_requests = seekDistance(False)
+    local_distance, local_requests = seekDistance(True)
+    assert local_distance * 2 < plain_distance
@@ -0,0 +1,343 @@
+from collections import OrderedDict
+
+DEFAULT_CACHE_BLOCKS = 1024
+MIN_CACHE_BLOCKS = 16   # a block pointer tree walk holds a few pointer blocks at once
+DEFAULT_PROTECTED_FRACTION = 0.25
+FLUSH_BATCH_BLOCKS = 256    # most dirty blocks to hand the device in one flush batch
+
+
+class LRUPolicy():
+    """ Plain least-recently-used replacement """
+
+    def __init__(self, capacity):
+        self.order = OrderedDict()  # least to most recently used
+
+    def resize(self, capacity):
+        pass
+
+    def inserted(self, num_block):
+        self.order[num_block] = True
+
+    def accessed(self, num_block):
+        self.order.move_to_end(num_block)
+
+    def removed(self, num_block):
+        self.order.pop(num_block, None)
+
+    def victim(self):
+        num_block, _ = self.order.popitem(last=False)
+        return num_block
+
+    def __len__(self):
+        return len(self.order)
+
+
+class TwoQPolicy():
+    """ 2Q replacement (Johnson & Shasha), which is scan resistant.
+        A block seen for the first time goes into A1in, a FIFO. If it falls
+        out of A1in, only its number is remembered, in the A1out ghost list.
+        A block that's used again - while it's in A1in, or while it's still
+        remembered in A1out - has proved it's reused, so it goes into Am, an
+        LRU. A long sequential scan only ever churns A1in, and the reused
+        blocks in Am survive it.
+
+        Unlike the paper we promote on a second use in A1in too, with no
+        "correlated reference" period: each file system operation looks a
+        block up only once, so a second lookup really is reuse.
+    """
+
+    def __init__(self, capacity):
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        self.kin = max(1, capacity // 4)     # A1in's share of the cache
+        self.kout = max(1, capacity // 2)    # how many ghosts A1out remembers
+        while len(self.a1out) > self.kout:
+            self.a1out.popitem(last=False)
+
+    def inserted(self, num_block):
+        if num_block in self.a1out:
+            del self.a1out[num_block]
+            self.am[num_block] = True
+        else:
+            self.a1in[num_block] = True
+
+    def accessed(self, num_block):
+        if num_block in self.a1in:
+            del self.a1in[num_block]
+            self.am[num_block] = True
+        else:
+            self.am.move_to_end(num_block)
+
+    def removed(self, num_block):
+        self.a1in.pop(num_block, None)
+        self.am.pop(num_block, None)
+
+    def victim(self):
+        if len(self.a1in) > self.kin or len(self.am) == 0:
+            num_block, _ = self.a1in.popitem(last=False)
+            self.a1out[num_block] = True
+            if len(self.a1out) > self.kout:
+                self.a1out.popitem(last=False)
+            return num_block
+        num_block, _ = self.am.popitem(last=False)
+        return num_block
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+
+POLICIES = {"lru": LRUPolicy, "2q": TwoQPolicy}
+
+
+class BlockCache():
+    """ The block cache holds recently used blocks in memory: data blocks
+        (bytearrays) and blocks of block pointers (views over bytearrays,
+        see INode.pointerView).
+
+        It holds at most <capacity> blocks. When it's full, a block is
+        evicted to make room, and if that block is dirty it's written back
+        first, through the writeback function the FileSystem gives us. So
+        memory stays bounded no matter how much of the device gets read.
+
+        Which block goes is up to the replacement policy ("lru" or the
+        scan resistant "2q"), except for metadata blocks - the pointer
+        blocks of INodes, cached with meta=True. Those live in a separate,
+        protected LRU with a reserved share of the cache, and are only
+        evicted when metadata outgrows its share, so streaming through a
+        big file can't push out the pointer blocks everybody needs.
+
+        Anyone who changes a cached block in place must put it again, which
+        marks it dirty (and re-caches it, should it have been evicted in
+        the meantime). Dirty block numbers are also kept in their own set,
+        so a flush only has to look at the blocks that changed.
+
+        Blocks brought in by read-ahead are loaded with prefetched=True. The
+        read they were fetched for is their first real use, so it doesn't
+        count as reuse to the replacement policy (otherwise 2Q would take
+        every streamed block for a hot one).
+    """
+
+    def __init__(self, capacity, writeback, policy="lru",
+                 protected_fraction=DEFAULT_PROTECTED_FRACTION):
+        """
+        :param capacity:           the most blocks to hold at once
+        :param writeback:          function(block_num, data) that writes a dirty block to the device
+        :param policy:             replacement policy for data blocks, "lru" or "2q"
+        :param protected_fraction: share of the cache reserved for metadata blocks
+        """
+        assert policy in POLICIES, "unknown cache policy {}".format(policy)
+        self.capacity = max(capacity, MIN_CACHE_BLOCKS)
+        self.writeback = writeback
+        self.policy_name = policy
+        self.policy = POLICIES[policy](self.capacity)
+        self.protected = OrderedDict()  # metadata blocks, least to most recently used
+        self.protected_fraction = protected_fraction
+        self.protected_capacity = int(self.capacity * protected_fraction)
+        self.cache = {}                 # block number -> [data, meta, prefetched and not used yet]
+        self.dirty = set()              # block numbers of the dirty blocks
+        self.changes = 0                # puts and discards, so a reader can tell if anything changed
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0     # dirty blocks written back on eviction
+        self.prefetched = 0     # blocks loaded by read-ahead
+        self.prefetch_hits = 0  # ... that were then used
+
+    def resize(self, capacity):
+        """ Change the capacity. Shrinking evicts (writing back dirty blocks) right away. """
+        self.capacity = max(capacity, MIN_CACHE_BLOCKS)
+        self.protected_capacity = int(self.capacity * self.protected_fraction)
+        self.policy.resize(self.capacity)
+        while len(self.cache) > self.capacity:
+            self.evict()
+
+    def put(self, num_block, data, meta=False):
+        """ Cache a block we changed: it's dirty until written back """
+        self.changes += 1
+        self._insert(num_block, data, True, meta)
+
+    def load(self, num_block, data, meta=False, prefetched=False):
+        """ Cache a block we just read from the device: it's clean.
+            If the block is cached already, that copy is at least as new, and stays.
+        """
+        if num_block not in self.cache:
+            self._insert(num_block, data, False, meta, prefetched)
+            self.prefetched += prefetched
+
+    def _insert(self, num_block, data, dirty, meta, prefetched=False):
+        entry = self.cache.get(num_block)
+        if entry is not None:
+            entry[0] = data
+            if dirty:
+                self.dirty.add(num_block)
+            if meta and not entry[1]:
+                # it turns out to be metadata: move it to the protected class
+                self.policy.removed(num_block)
+                entry[1] = True
+                self.protected[num_block] = True
+            else:
+                self._accessed(num_block, entry)
+            return
+        self.cache[num_block] = [data, meta, prefetched]
+        if dirty:
+            self.dirty.add(num_block)
+        if meta:
+            self.protected[num_block] = True
+        else:
+            self.policy.inserted(num_block)
+        while len(self.cache) > self.capacity:
+            self.evict()
+
+    def _accessed(self, num_block, entry):
+        if entry[1]:
+            self.protected.move_to_end(num_block)
+        else:
+            self.policy.accessed(num_block)
+
+    def get(self, num_block):
+        entry = self.cache.get(num_block)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry[2]:
+            entry[2] = False
+            self.prefetch_hits += 1
+        else:
+            self._accessed(num_block, entry)
+        return entry[0]
+
+    def peek(self, num_block):
+        """ get, without counting as a use of the block """
+        entry = self.cache.get(num_block)
+        return None if entry is None else entry[0]
+
+    def isDirty(self, num_block):
+        return num_block in self.dirty
+
+    def dirtyBlocks(self):
+        """ :return: the dirty block numbers, in ascending order """
+        return sorted(self.dirty)
+
+    def markClean(self, num_block):
+        """ The block has been written back, but stays cached """
+        self.dirty.discard(num_block)
+
+    def evict(self):
+        """ Throw out one block, writing it back if it's dirty """
+        if len(self.protected) > self.protected_capacity or len(self.policy) == 0:
+            num_block, _ = self.protected.popitem(last=False)
+        else:
+            num_block = self.policy.victim()
+        data, meta, prefetched = self.cache.pop(num_block)
+        self.evictions += 1
+        if num_block in self.dirty:
+            self.dirty.remove(num_block)
+            self.writeback(num_block, data)
+            self.writebacks += 1
+
+    def discard(self, num_block):
+        # the block was freed: forget its contents, and don't write them back
+        self.changes += 1
+        entry = self.cache.pop(num_block, None)
+        self.dirty.discard(num_block)
+        if entry is not None:
+            if entry[1]:
+                del self.protected[num_block]
+            else:
+                self.policy.removed(num_block)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def residentBytes(self):
+        return sum(memoryview(entry[0]).nbytes for entry in self.cache.values())
+
+    def stats(self):
+        return {"capacity": self.capacity, "policy": self.policy_name,
+                "resident": len(self.cache), "resident_bytes": self.residentBytes(),
+                "metadata": len(self.protected), "dirty": len(self.dirty),
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hitRate(),
+                "evictions": self.evictions, "writebacks": self.writebacks,
+                "prefetched": self.prefetched, "prefetch_hits": self.prefetch_hits}
+
+    def __contains__(self, num_block):
+        return num_block in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+
+# Nosetests
+def test_lru_eviction_writes_back():
+    written = {}
+    cache = BlockCache(MIN_CACHE_BLOCKS, lambda n, data: written.update({n: data}))
+    for n in range(MIN_CACHE_BLOCKS):
+        if n % 2 == 0:
+            cache.put(n, bytearray([n]))
+        else:
+            cache.load(n, bytearray([n]))
+    cache.get(0)    # 0 is now the most recently used, so 1 goes first
+    cache.put(100, bytearray(b'x'))
+    assert cache.get(1) is None and cache.get(0) is not None
+    assert len(written) == 0, "clean block 1 shouldn't be written back"
+    cache.put(101, bytearray(b'y'))     # evicts 2, which is dirty
+    assert written == {2: bytearray([2])}
+    assert len(cache) == MIN_CACHE_BLOCKS
+
+def test_metadata_is_protected():
+    cache = BlockCache(64, lambda n, data: None)
+    for n in range(8):
+        cache.load(n, [0], meta=True)
+    for n in range(1000, 2000):     # a long scan of data blocks
+        cache.load(n, bytearray(1))
+    assert all(n in cache for n in range(8)), "a data scan evicted metadata"
+
+def test_2q_resists_scans():
+    hot = range(16)
+
+    def hot_hits(policy):
+        cache = BlockCache(64, lambda n, data: None, policy=policy)
+        for rounds in range(3):     # warm up: the hot blocks are used again and again
+            for n in hot:
+                if cache.get(n) is None:
+                    cache.load(n, bytearray(1))
+        for n in range(1000, 1500):  # then a big sequential scan
+            if cache.get(n) is None:
+                cache.load(n, bytearray(1))
+        return sum(1 for n in hot if n in cache)
+
+    assert hot_hits("lru") == 0, "LRU should lose the hot set to the scan"
+    assert hot_hits("2q") == len(hot), "2Q should keep the hot set through the scan"
+
+def test_dirty_set():
+    cache = BlockCache(MIN_CACHE_BLOCKS, lambda n, data: None)
+    for n in (9, 3, 5):
+        cache.put(n, bytearray([n]))
+    cache.load(4, bytearray(1))
+    assert cache.dirtyBlocks() == [3, 5, 9]
+    cache.markClean(5)
+    cache.discard(9)
+    assert cache.dirtyBlocks() == [3] and 5 in cache
+
+def test_resize_and_stats():
+    written = {}
+    cache = BlockCache(64, lambda n, data: written.update({n: data}))
+    for n in range(64):
+        cache.put(n, bytearray(8))
+    cache.get(3)
+    cache.get(1000)
+    cache.resize(20)
+    stats = cache.stats()
+    assert len(cache) == 20 and stats["resident_bytes"] == 20 * 8
+    assert stats["evictions"] == 44 and stats["writebacks"] == 44 and len(written) == 44
+    assert stats["dirty"] == 20 and stats["hits"] == 1 and stats["misses"] == 1
+    assert 3 in cache, "the recently used block should survive the shrink"
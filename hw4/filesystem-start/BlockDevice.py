@@ -1,6 +1,116 @@
 import os
+import mmap
+import threading
+import ctypes
+import ctypes.util
+import time
 
 default_blocksize = 1024
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# fallocate(2) mode bits for punching holes (linux/falloc.h)
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def _find_fallocate():
+    """ libc's fallocate, if this platform has one, else None """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError, TypeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+_fallocate = _find_fallocate()
+
+
+class OpStats:
+    """ Counters and a latency histogram for one kind of device operation.
+        Histogram bucket b counts requests that took [2**(b-1), 2**b) ns,
+        so finding the bucket is just int.bit_length.
+    """
+    NUM_BUCKETS = 48    # 2**47 ns is about a day and a half
+
+    def __init__(self):
+        self.requests = 0
+        self.blocks = 0
+        self.bytes = 0
+        self.sequential = 0     # requests starting where the previous one ended
+        self.random = 0         # requests that needed a seek
+        self.seek_distance = 0  # total blocks the "head" moved for the random ones
+        self.total_ns = 0
+        self.histogram = [0] * OpStats.NUM_BUCKETS
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "blocks": self.blocks,
+            "bytes": self.bytes,
+            "sequential": self.sequential,
+            "random": self.random,
+            "seek_distance": self.seek_distance,
+            "total_ns": self.total_ns,
+            "histogram": list(self.histogram),
+        }
+
+
+class IOStats:
+    """ Instrumentation for a BlockDevice: per-operation request, block and
+        byte counts, sequential vs. random accesses, and log2-bucketed
+        latency histograms. Recording a request is a handful of integer
+        updates plus two perf_counter_ns calls, cheap enough to leave on.
+        Updates aren't locked, so with several threads doing I/O the
+        counts are approximate (the GIL may interleave two increments).
+    """
+    OPS = ("read", "write", "discard")
+
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.ops = {op: OpStats() for op in IOStats.OPS}
+        self.head = 0   # block just past the end of the last request, like a disk head
+
+    def record(self, op, start, count, block_size, elapsed_ns):
+        stats = self.ops[op]
+        stats.requests += 1
+        stats.blocks += count
+        stats.bytes += count * block_size
+        if start == self.head:
+            stats.sequential += 1
+        else:
+            stats.random += 1
+            stats.seek_distance += abs(start - self.head)
+        self.head = start + count
+        stats.total_ns += elapsed_ns
+        stats.histogram[min(elapsed_ns.bit_length(), OpStats.NUM_BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        """ All of the counters, as a dict of dicts keyed by operation """
+        return {op: self.ops[op].snapshot() for op in IOStats.OPS}
+
+    def asString(self):
+        lines = []
+        for op in IOStats.OPS:
+            stats = self.ops[op]
+            if stats.requests == 0:
+                continue
+            lines.append("{}: {} requests, {} blocks, {} bytes, {} sequential, {} random "
+                         "(seek distance {}), mean {:.1f}us".format(
+                op, stats.requests, stats.blocks, stats.bytes, stats.sequential, stats.random,
+                stats.seek_distance, stats.total_ns / stats.requests / 1000))
+            buckets = ["<{}us: {}".format(2 ** b / 1000, n) for b, n in enumerate(stats.histogram) if n > 0]
+            lines.append("  latency " + ", ".join(buckets))
+        if len(lines) == 0:
+            return "no I/O recorded"
+        return "\n".join(lines)
+
 class BlockDevice:
     """ The BlockDevice is the API that a file system is built on.
         Any block device supports block-level reads and writes.
@@ -10,10 +120,31 @@ class BlockDevice:
         /dev/rdiskx), but then the program would need to run as
         super-user, and if the wrong device were specified, you could
         overwrite your OS or user data. Beware.
+
+        With use_mmap=True the device file is memory-mapped instead, so
+        reads and writes are memory copies rather than a syscall per
+        block, and view_block can hand out zero-copy memoryviews of the
+        mapped blocks.
+
+        Thread safety: all I/O is positional (os.pread/os.pwrite and
+        friends, or copies into the map), so there is no shared seek
+        position. Any number of threads can call the read/write methods
+        at once and their requests are served in parallel; only requests
+        that overlap the same blocks race with each other, exactly as they
+        would on a real disk. On platforms without preadv/pwritev we fall
+        back to seek + read/write under a lock, which is still safe but
+        serialized.
+
+        Blocks the file system no longer needs can be handed back with
+        discard, which punches a hole in the device file so the host can
+        reclaim the space. The device remembers which blocks are holes
+        (including the ones already sparse when the file was opened), and
+        reads that fall entirely inside holes are zero-filled without
+        touching the file.
     """
 
     def __init__(self, filename="blocks.1024.dev", blockCount=-1,
-                 blockSize=default_blocksize, create=False):
+                 blockSize=default_blocksize, create=False, use_mmap=False):
         """
             Create a new BlockDevice from a given filename. Used for
             creating a new one as well as opening an existing one.
@@ -21,9 +152,14 @@ class BlockDevice:
         :param blockCount: how big the device should be, in blocks
         :param blockSize:  how big each block should be
         :param create:     whether to create the file or just open it
+        :param use_mmap:   memory-map the device file instead of using read/write calls
         """
 
         self.filename = filename
+        self.map = None
+        self.map_view = None
+        self.seek_lock = threading.Lock()  # only used when there's no preadv/pwritev
+        self.iostats = IOStats()
         if create:
             if blockCount <= 0:
                 print("invalid device size: {}".format(blockCount))
@@ -34,9 +170,8 @@ class BlockDevice:
             print('creating {} with {} blocks'.format(self.filename,
                 blockCount))
             self.handle = open(self.filename, 'wb+', buffering=0)
-            self.handle.seek((blockSize * blockCount) - 1)
             outb = bytearray(b'0')
-            num_written = self.handle.write(outb)
+            num_written = os.pwrite(self.handle.fileno(), outb, (blockSize * blockCount) - 1)
         else:
             self.filename = BlockDevice.normalize_filename(filename)
             self.block_size = BlockDevice.filename_to_blocksize(self.filename)
@@ -44,11 +179,33 @@ class BlockDevice:
             self.num_blocks = int(info.st_size / self.block_size)
             self.handle = open(self.filename, 'rb+', buffering=0)
 
+        # one byte per block: 1 if the block is known to be a hole (reads as zeros)
+        self.discarded = bytearray(self.num_blocks)
+        self._find_holes()
+
+        if use_mmap:
+            self.map = mmap.mmap(self.handle.fileno(), self.blocks_to_bytes(self.num_blocks))
+            self.map_view = memoryview(self.map)
+
     def close(self):
-        """ Close the underlying file in preparation for shutdown """
+        """ Close the underlying file in preparation for shutdown.
+            In mmap mode, any views handed out by view_block must have been
+            dropped by now, or the map can't be closed.
+        """
+        if self.map is not None:
+            self.map.flush()
+            self.map_view.release()
+            self.map.close()
+            self.map = None
+            self.map_view = None
         self.handle.flush()  # sync any buffers to disk
         self.handle.close()
 
+    def sync(self):
+        """ Push any writes still sitting in memory (the mmap) out to the file """
+        if self.map is not None:
+            self.map.flush()
+
     def read_block(self, block_num, buff):
         """
         Half of the action of a block device: read a block
@@ -57,9 +214,7 @@ class BlockDevice:
         """
         assert block_num < self.num_blocks, "read_block past end of device"
         assert len(buff) == self.block_size, "bad buff size to read_block"
-        self.handle.seek(block_num * self.block_size)
-        num_read = self.handle.readinto(buff)
-        assert num_read == self.block_size, "ERROR: read_block buffer / file not block aligned"
+        self.readv_blocks(block_num, [buff])
 
     def write_block(self, block_num, buff, pad=False):
         """
@@ -76,11 +231,197 @@ class BlockDevice:
             # print("padded buffer to {}".format(len(buff)))
 
         assert len(buff) == self.block_size, "bad buff size to write_block"
-        # todo: keep track of the file handle's seek location, and only seek when needed
-        self.handle.seek(block_num * self.block_size)
-        num_written = self.handle.write(buff)
-        assert num_written == self.block_size, (
-                "ERROR: write_block buffer / file not block aligned {}".format(num_written))
+        self.writev_blocks(block_num, [buff])
+
+    def read_blocks(self, start, count, buff):
+        """
+        Read <count> contiguous blocks with a single request
+        :param start: first block to read
+        :param count: how many blocks to read
+        :param buff:  bytearray to read in to, assumed to be count * blocksize long
+        """
+        assert len(buff) == self.blocks_to_bytes(count), "bad buff size to read_blocks"
+        self.readv_blocks(start, [buff])
+
+    def write_blocks(self, start, buff):
+        """
+        Write a run of contiguous blocks with a single request
+        :param start: first block to write
+        :param buff:  bytearray holding the data, a whole number of blocks long
+        """
+        self.writev_blocks(start, [buff])
+
+    def readv_blocks(self, start, buffers):
+        """
+        Scatter read: fill buffers, in order, from the contiguous blocks
+        starting at <start>. Each buffer must be a whole number of blocks long.
+        Backed by os.preadv, so a run is one syscall no matter how many buffers.
+        :param start:   first block to read
+        :param buffers: list of bytearrays / writable memoryviews
+        """
+        count = self._check_run(start, buffers, "readv_blocks")
+        if count > 0:
+            started = time.perf_counter_ns() if self.iostats.enabled else 0
+            if self.is_discarded(start, count):
+                for buff in buffers:
+                    buff[:] = bytes(len(buff))
+            else:
+                self._readv(self.blocks_to_bytes(start), buffers)
+            if self.iostats.enabled:
+                self.iostats.record("read", start, count, self.block_size,
+                                    time.perf_counter_ns() - started)
+
+    def writev_blocks(self, start, buffers):
+        """
+        Gather write: write buffers, in order, to the contiguous blocks
+        starting at <start>. Each buffer must be a whole number of blocks long.
+        Backed by os.pwritev.
+        :param start:   first block to write
+        :param buffers: list of bytes-like objects
+        """
+        count = self._check_run(start, buffers, "writev_blocks")
+        if count > 0:
+            started = time.perf_counter_ns() if self.iostats.enabled else 0
+            self.discarded[start:start + count] = bytes(count)
+            self._writev(self.blocks_to_bytes(start), buffers)
+            if self.iostats.enabled:
+                self.iostats.record("write", start, count, self.block_size,
+                                    time.perf_counter_ns() - started)
+
+    def discard(self, start, count=1):
+        """
+        Tell the device that a run of blocks is no longer in use. The run is
+        punched out of the device file with fallocate(PUNCH_HOLE), so the host
+        gets the space back, and afterwards the blocks read as zeros. Where
+        hole punching isn't supported the blocks are overwritten with zeros
+        instead, which keeps the read-as-zeros contract.
+        :param start: first block to discard
+        :param count: how many blocks
+        """
+        assert start + count <= self.num_blocks, "discard past end of device"
+        if count <= 0 or self.is_discarded(start, count):
+            return
+        started = time.perf_counter_ns() if self.iostats.enabled else 0
+        offset = self.blocks_to_bytes(start)
+        length = self.blocks_to_bytes(count)
+        punched = False
+        if _fallocate is not None:
+            punched = _fallocate(self.handle.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                                 offset, length) == 0
+        if not punched:
+            self._writev(offset, [bytes(length)])
+        self.discarded[start:start + count] = b'\x01' * count
+        if self.iostats.enabled:
+            self.iostats.record("discard", start, count, self.block_size,
+                                time.perf_counter_ns() - started)
+
+    def is_discarded(self, start, count=1):
+        """ True if every block in the run is a hole, so it would read as zeros """
+        return self.discarded.count(1, start, start + count) == count
+
+    def _find_holes(self):
+        """ Mark the blocks that are already holes in the device file (where the OS can tell us) """
+        if not hasattr(os, "SEEK_HOLE"):
+            return
+        fd = self.handle.fileno()
+        end = self.blocks_to_bytes(self.num_blocks)
+        try:
+            hole = os.lseek(fd, 0, os.SEEK_HOLE)
+            while hole < end:
+                try:
+                    data = os.lseek(fd, hole, os.SEEK_DATA)
+                except OSError:   # ENXIO: no data after this hole
+                    data = end
+                # only whole blocks inside the hole count
+                first = -(-hole // self.block_size)
+                last = min(data, end) // self.block_size
+                if last > first:
+                    self.discarded[first:last] = b'\x01' * (last - first)
+                if data >= end:
+                    break
+                hole = os.lseek(fd, data, os.SEEK_HOLE)
+        except OSError:
+            pass
+
+    def view_blocks(self, start, count):
+        """
+        Read-only access to a run of blocks without copying them into a caller's
+        buffer. In mmap mode this is a zero-copy memoryview straight into the
+        mapped file (so it also sees later writes to those blocks); otherwise
+        the run is read into a fresh buffer and a view of that is returned.
+        Don't write through the view - use write_block(s).
+        :param start: first block to view
+        :param count: how many blocks
+        :return:      a memoryview, count * blocksize long
+        """
+        assert start + count <= self.num_blocks, "view_blocks past end of device"
+        if self.map is not None:
+            # no I/O as such, but it is a read from the file system's point of view
+            if self.iostats.enabled:
+                self.iostats.record("read", start, count, self.block_size, 0)
+            offset = self.blocks_to_bytes(start)
+            return self.map_view[offset:offset + self.blocks_to_bytes(count)]
+        buff = bytearray(self.blocks_to_bytes(count))
+        self.read_blocks(start, count, buff)
+        return memoryview(buff)
+
+    def view_block(self, block_num):
+        """ view_blocks for a single block """
+        return self.view_blocks(block_num, 1)
+
+    def _check_run(self, start, buffers, caller):
+        """ Validate a vectored request, returning how many blocks it covers """
+        num_bytes = 0
+        for buff in buffers:
+            assert len(buff) % self.block_size == 0, "bad buff size to {}".format(caller)
+            num_bytes += len(buff)
+        count = num_bytes // self.block_size
+        assert start + count <= self.num_blocks, "{} past end of device".format(caller)
+        return count
+
+    def _readv(self, offset, buffers):
+        if self.map is not None:
+            for buff in buffers:
+                buff[:] = self.map_view[offset:offset + len(buff)]
+                offset += len(buff)
+            return
+        if not hasattr(os, "preadv"):
+            with self.seek_lock:
+                for buff in buffers:
+                    self.handle.seek(offset)
+                    num_read = self.handle.readinto(buff)
+                    assert num_read == len(buff), "ERROR: read buffer / file not block aligned"
+                    offset += num_read
+            return
+        # the kernel caps how many buffers one preadv can take
+        for i in range(0, len(buffers), IOV_MAX):
+            chunk = buffers[i:i + IOV_MAX]
+            expected = sum(len(buff) for buff in chunk)
+            num_read = os.preadv(self.handle.fileno(), chunk, offset)
+            assert num_read == expected, "ERROR: read buffer / file not block aligned"
+            offset += num_read
+
+    def _writev(self, offset, buffers):
+        if self.map is not None:
+            for buff in buffers:
+                self.map_view[offset:offset + len(buff)] = buff
+                offset += len(buff)
+            return
+        if not hasattr(os, "pwritev"):
+            with self.seek_lock:
+                for buff in buffers:
+                    self.handle.seek(offset)
+                    num_written = self.handle.write(buff)
+                    assert num_written == len(buff), "ERROR: write buffer / file not block aligned"
+                    offset += num_written
+            return
+        for i in range(0, len(buffers), IOV_MAX):
+            chunk = buffers[i:i + IOV_MAX]
+            expected = sum(len(buff) for buff in chunk)
+            num_written = os.pwritev(self.handle.fileno(), chunk, offset)
+            assert num_written == expected, (
+                "ERROR: write buffer / file not block aligned {}".format(num_written))
+            offset += num_written
 
     def blocks_to_bytes(self, blocknum):
         return blocknum * self.block_size
@@ -147,3 +488,92 @@ def test_write_read_block():
     for i in range(bd.block_size):
         assert buff[i] == i % 256, "data mismatch in test_write_read_block"
 
+def test_mmap_write_read_block():
+    bd = BlockDevice('testBlockMmap', 4, create=True, use_mmap=True)
+    buff = bytearray(bd.block_size)
+    for i in range(bd.block_size):
+        buff[i] = (i * 7) % 256
+    bd.write_block(2, buff)
+    view = bd.view_block(2)
+    assert view == buff, "mmap view_block doesn't see write_block data"
+    view.release()
+    bd.close()
+    bd = BlockDevice('testBlockMmap')
+    readback = bytearray(bd.block_size)
+    bd.read_block(2, readback)
+    bd.close()
+    assert readback == buff, "data mismatch in test_mmap_write_read_block"
+
+def test_vectored_read_write():
+    bd = BlockDevice('testBlockVec', 8, create=True)
+    bs = bd.block_size
+    run = bytearray(3 * bs)
+    for i in range(len(run)):
+        run[i] = (i // bs) + 1
+    bd.write_blocks(2, run)
+    pieces = [bytearray(bs), bytearray(2 * bs)]
+    bd.readv_blocks(2, pieces)
+    assert pieces[0] == run[0:bs] and pieces[1] == run[bs:], "readv_blocks data mismatch"
+    bd.writev_blocks(5, [bytearray(b'\x09' * bs), bytearray(b'\x0a' * bs)])
+    whole = bytearray(8 * bs)
+    bd.read_blocks(0, 8, whole)
+    bd.close()
+    assert whole[2 * bs:5 * bs] == run, "read_blocks lost the first run"
+    assert whole[5 * bs:7 * bs] == b'\x09' * bs + b'\x0a' * bs, "writev_blocks data mismatch"
+
+def test_concurrent_read_write():
+    from concurrent.futures import ThreadPoolExecutor
+    bd = BlockDevice('testBlockThreads', 64, create=True)
+
+    def fill(block_num):
+        bd.write_block(block_num, bytearray([block_num]) * bd.block_size)
+
+    def check(block_num):
+        buff = bytearray(bd.block_size)
+        bd.read_block(block_num, buff)
+        return buff == bytearray([block_num]) * bd.block_size
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(fill, range(bd.num_blocks)))
+        results = list(pool.map(check, range(bd.num_blocks)))
+    bd.close()
+    assert all(results), "concurrent reads saw another thread's block"
+
+def test_discard():
+    bd = BlockDevice('testBlockDiscard', 64, create=True)
+    buff = bytearray(b'\xab') * bd.block_size
+    for i in range(bd.num_blocks):
+        bd.write_block(i, buff)
+    bd.discard(8, 16)
+    assert bd.is_discarded(8, 16) and not bd.is_discarded(7, 2)
+    readback = bytearray(bd.block_size)
+    bd.read_block(10, readback)
+    assert readback == bytes(bd.block_size), "discarded block didn't read as zeros"
+    bd.write_block(10, buff)
+    assert not bd.is_discarded(10), "write didn't clear the discard mark"
+    bd.close()
+
+    # holes in the file are recognised when the device is reopened
+    bd = BlockDevice('testBlockDiscard')
+    bd.read_block(9, readback)
+    assert readback == bytes(bd.block_size)
+    bd.read_block(10, readback)
+    assert readback == buff
+    bd.close()
+
+def test_iostats():
+    bd = BlockDevice('testBlockStats', 16, create=True)
+    bd.iostats.reset()
+    buff = bytearray(bd.block_size)
+    bd.write_block(0, buff)
+    bd.write_block(1, buff)         # sequential
+    bd.write_blocks(8, bytearray(2 * bd.block_size))  # seek of 6 blocks
+    bd.read_block(3, buff)          # seek back 7
+    stats = bd.iostats.snapshot()
+    bd.close()
+    assert stats["write"]["requests"] == 3 and stats["write"]["blocks"] == 4
+    assert stats["write"]["bytes"] == 4 * bd.block_size
+    assert stats["write"]["sequential"] == 2 and stats["write"]["random"] == 1
+    assert stats["read"]["random"] == 1
+    assert stats["write"]["seek_distance"] + stats["read"]["seek_distance"] == 6 + 7
+    assert sum(stats["write"]["histogram"]) == 3
@@ -0,0 +1,221 @@
+CHUNK_BYTES = 128   # the bitmap is summarized 1024 blocks at a time
+
+
+class BlockMap():
+    """ The free block bitmap, packed: one bit per block, 1 -> allocated,
+        0 -> free, with the first block in the high bit of the first byte.
+        That's exactly the on-disk layout, so reading and writing the map is
+        a buffer copy.
+
+        The map is cut into chunks of CHUNK_BYTES bytes, and we keep a count
+        of the free blocks in each one, so finding a free block skips full
+        chunks without looking at their bits, and inside a chunk finds the
+        first byte that isn't 0xFF in one C-speed pass.
+
+        block_map[n] is True if block n is allocated, like the old list of
+        booleans.
+    """
+
+    def __init__(self, count, image=None):
+        """
+        :param count: how many blocks the map covers
+        :param image: the map's on-disk bytes, or None for a map with every block free
+        """
+        self.count = count
+        num_bytes = -(-count // 8)
+        if image is None:
+            self.bits = bytearray(num_bytes)
+        else:
+            self.bits = bytearray(image[:num_bytes])
+            # bits past the last block are padding, never allocated
+            if count % 8 != 0:
+                self.bits[-1] &= (0xFF << (8 - count % 8)) & 0xFF
+        self.chunk_free = []
+        for start in range(0, num_bytes, CHUNK_BYTES):
+            chunk = self.bits[start:start + CHUNK_BYTES]
+            blocks = min(CHUNK_BYTES * 8, count - start * 8)
+            self.chunk_free.append(blocks - int.from_bytes(chunk, "big").bit_count())
+        self.free_count = sum(self.chunk_free)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        return self.bits[n >> 3] & (0x80 >> (n & 7)) != 0
+
+    def __setitem__(self, n, allocated):
+        if self[n] == bool(allocated):
+            return
+        mask = 0x80 >> (n & 7)
+        delta = -1 if allocated else 1
+        self.bits[n >> 3] ^= mask
+        self.chunk_free[(n >> 3) // CHUNK_BYTES] += delta
+        self.free_count += delta
+
+    def findFree(self, start=0):
+        """
+        :param start: the block to start looking from (the search wraps around)
+        :return: the first free block at or after start, or -1 if the map is full
+        """
+        if self.free_count == 0:
+            return -1
+        num_chunks = len(self.chunk_free)
+        first = (start >> 3) // CHUNK_BYTES
+        for i in range(num_chunks + 1):
+            c = (first + i) % num_chunks
+            if self.chunk_free[c] == 0:
+                continue
+            lo = c * CHUNK_BYTES
+            if i == 0:
+                lo = start >> 3       # the start chunk is only searched from start on
+            hi = min((c + 1) * CHUNK_BYTES, len(self.bits))
+            while lo < hi:
+                chunk = self.bits[lo:hi]
+                byte_index = lo + len(chunk) - len(chunk.lstrip(b"\xff"))
+                if byte_index >= hi:
+                    break
+                free_bits = ~self.bits[byte_index] & 0xFF
+                if byte_index == start >> 3 and i == 0:
+                    free_bits &= 0xFF >> (start & 7)
+                if free_bits != 0:
+                    n = byte_index * 8 + 8 - free_bits.bit_length()
+                    if n < self.count:
+                        return n
+                lo = byte_index + 1
+        return -1
+
+    def alloc(self, start=0):
+        """
+        Mark the first free block at or after start allocated
+        :return: its block number, or -1 if there are no free blocks
+        """
+        n = self.findFree(start)
+        if n >= 0:
+            self[n] = True
+        return n
+
+    def runLength(self, n, max_len):
+        """ How many free blocks in a row there are starting at n, up to max_len """
+        length = 0
+        while length < max_len and n + length < self.count:
+            m = n + length
+            if m & 7 == 0 and length + 8 <= max_len and m + 8 <= self.count and self.bits[m >> 3] == 0:
+                length += 8     # a whole free byte at once
+            elif self[m]:
+                break
+            else:
+                length += 1
+        return length
+
+    def findRun(self, min_len, max_len, start=0):
+        """
+        Find a run of consecutive free blocks: the first one at or after
+        start (wrapping around) that's at least min_len long, cut to max_len
+        :return: (first block, length), or (-1, 0) if there's no such run
+        """
+        travelled = 0
+        pos = start
+        while self.free_count >= min_len and travelled < self.count:
+            n = self.findFree(pos)
+            if n < 0:
+                break
+            travelled += (n - pos) % self.count
+            length = self.runLength(n, max_len)
+            if length >= min_len:
+                return n, length
+            travelled += length
+            pos = (n + length) % self.count
+        return -1, 0
+
+    def allocRun(self, min_len, max_len, start=0):
+        """ Like findRun, but the run is marked allocated """
+        n, length = self.findRun(min_len, max_len, start)
+        if n >= 0:
+            self.setRun(n, length, True)
+        return n, length
+
+    def setRun(self, start, length, allocated):
+        """ Mark blocks start .. start+length-1 allocated (or free), a byte at a time where we can """
+        end = start + length
+        n = start
+        while n < end and n & 7 != 0:
+            self[n] = allocated
+            n += 1
+        whole = (end - n) >> 3
+        self.bits[n >> 3:(n >> 3) + whole] = (b"\xff" if allocated else b"\x00") * whole
+        n += whole * 8
+        while n < end:
+            self[n] = allocated
+            n += 1
+        # recount the chunks we touched
+        for c in range((start >> 3) // CHUNK_BYTES, ((end - 1) >> 3) // CHUNK_BYTES + 1):
+            chunk = self.bits[c * CHUNK_BYTES:(c + 1) * CHUNK_BYTES]
+            blocks = min(CHUNK_BYTES * 8, self.count - c * CHUNK_BYTES * 8)
+            free = blocks - int.from_bytes(chunk, "big").bit_count()
+            self.free_count += free - self.chunk_free[c]
+            self.chunk_free[c] = free
+
+    def freeRun(self, start, length):
+        self.setRun(start, length, False)
+
+    def freeRuns(self):
+        """ Generate (start, length) of every run of free blocks, in block order """
+        n = self.findFree(0)
+        while n >= 0:
+            length = self.runLength(n, self.count)
+            yield n, length
+            end = n + length
+            if end >= self.count:
+                return
+            n = self.findFree(end)
+            if n < end:
+                return      # findFree wrapped around to the start
+
+    def image(self, size):
+        """ The map's on-disk bytes, zero padded out to size """
+        return self.bits + bytes(size - len(self.bits))
+
+
+# Nosetests
+def test_block_map():
+    bm = BlockMap(3000)
+    assert bm.free_count == 3000 and len(bm.chunk_free) == 3
+    for n in range(2050):
+        bm[n] = True
+    assert bm.chunk_free == [0, 0, 950] and bm.alloc() == 2050
+    bm[5] = False
+    bm[5] = False
+    assert bm.free_count == 3000 - 2050 and bm.findFree() == 5 and not bm[5]
+    assert bm.findFree(6) == 2051, "should skip the full chunk"
+    assert bm.alloc(2999) == 2999 and bm.findFree(2999) == 5, "search should wrap around"
+    copy = BlockMap(3000, bm.image(512))
+    assert copy.bits == bm.bits and copy.chunk_free == bm.chunk_free
+    assert [n for n in range(3000) if copy[n]] == [n for n in range(3000) if bm[n]]
+
+def test_block_map_full():
+    bm = BlockMap(13)
+    assert [bm.alloc() for i in range(14)] == list(range(13)) + [-1]
+    bm[12] = False
+    assert bm.findFree(3) == 12
+    assert BlockMap(13, bm.image(2)).free_count == 1
+
+def test_alloc_run():
+    bm = BlockMap(100)
+    for n in (3, 10, 11, 40):
+        bm[n] = True
+    assert bm.allocRun(1, 50) == (0, 3)
+    assert bm.allocRun(5, 8) == (4, 6), "should stop at the next allocated block"
+    assert bm.allocRun(20, 20) == (12, 20)
+    assert bm.allocRun(30, 64, start=35) == (41, 59)
+    assert bm.allocRun(9, 9) == (-1, 0) and bm.free_count == 100 - 4 - 3 - 6 - 20 - 59
+    assert bm.allocRun(2, 10, start=90) == (32, 8), "search should wrap around"
+
+def test_runs():
+    bm = BlockMap(2100)
+    bm.setRun(3, 2090, True)
+    assert bm.free_count == 10 and bm.chunk_free == [3, 0, 7] and bm[3] and not bm[2]
+    assert list(bm.freeRuns()) == [(0, 3), (2093, 7)]
+    bm.freeRun(1000, 30)
+    assert list(bm.freeRuns()) == [(0, 3), (1000, 30), (2093, 7)] and bm.free_count == 40
+    assert [bm[n] for n in (999, 1000, 1029, 1030)] == [True, False, False, True]
+    assert BlockMap(2100, bm.image(512)).chunk_free == bm.chunk_free
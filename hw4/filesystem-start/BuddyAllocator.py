@@ -0,0 +1,165 @@
+import heapq
+
+STALE_FACTOR = 4    # rebuild a heap once it's this many times bigger than its free set
+
+
+class BuddyAllocator():
+    """ A buddy system index of the free blocks in a BlockMap, so big
+        contiguous runs are found without scanning the bitmap.
+
+        Free space is kept as free "buddy blocks": runs of 2**k blocks that
+        start at a multiple of 2**k, one set per order k. The buddy of the
+        order k block at b is the one at b ^ 2**k; when both are free, they
+        are merged into one order k+1 block. Allocating takes the smallest
+        buddy block that's big enough and gives back whatever it doesn't use,
+        freeing merges with buddies as far as it can, and both take
+        O(log n) set and heap operations.
+
+        The BlockMap stays the truth (it's what's written to disk); this is
+        rebuilt from it at mount, and keeps it up to date. It has the same
+        alloc, allocRun and freeRun as a BlockMap, so FileSystem can use
+        either one as its allocator.
+    """
+
+    def __init__(self, block_map):
+        self.block_map = block_map
+        self.max_order = block_map.count.bit_length()
+        self.free = [set() for k in range(self.max_order + 1)]
+        # the same starts, so we can take the lowest one (entries no longer
+        # in free[k] are skipped when they come up, and a heap is rebuilt
+        # from its set once they outnumber the live ones STALE_FACTOR to 1)
+        self.heaps = [[] for k in range(self.max_order + 1)]
+        for start, length in block_map.freeRuns():
+            self._addRun(start, length)
+
+    def _add(self, start, order):
+        self.free[order].add(start)
+        heap = self.heaps[order]
+        if len(heap) >= STALE_FACTOR * (len(self.free[order]) + 1):
+            # mostly stale: start over from the blocks that really are free
+            heap[:] = self.free[order]
+            heapq.heapify(heap)
+        else:
+            heapq.heappush(heap, start)
+
+    def _addRun(self, start, length, merge=False):
+        """ Add a run of free blocks, as the biggest aligned buddy blocks that fit """
+        end = start + length
+        while start < end:
+            order = min((start & -start).bit_length() - 1 if start > 0 else self.max_order,
+                        (end - start).bit_length() - 1)
+            if merge:
+                self._addBlock(start, order)
+            else:
+                self._add(start, order)
+            start += 1 << order
+
+    def _addBlock(self, start, order):
+        """ Free an order-sized block, merging it with its buddy as long as that's free """
+        while order < self.max_order:
+            buddy = start ^ (1 << order)
+            if buddy not in self.free[order]:
+                break
+            self.free[order].discard(buddy)
+            start = min(start, buddy)
+            order += 1
+        self._add(start, order)
+
+    def _lowest(self, order):
+        heap = self.heaps[order]
+        while heap[0] not in self.free[order]:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def _take(self, start, length):
+        """ Remove blocks start .. start+length-1 (which must be free) from the free sets """
+        end = start + length
+        n = start
+        while n < end:
+            # the free buddy block holding n
+            order = 0
+            while (n & ~((1 << order) - 1)) not in self.free[order]:
+                order += 1
+                assert order <= self.max_order, "block {} isn't free".format(n)
+            block = n & ~((1 << order) - 1)
+            self.free[order].discard(block)
+            block_end = block + (1 << order)
+            # give back the parts outside the range
+            self._addRun(block, n - block)
+            self._addRun(min(end, block_end), max(block_end - end, 0))
+            n = block_end
+
+    def alloc(self, start=0):
+        first, length = self.allocRun(1, 1, start)
+        return first
+
+    def allocRun(self, min_len, max_len, start=0):
+        """
+        Allocate a run of consecutive blocks, max_len of them if there's a
+        free buddy block that big, else as many as the biggest free buddy
+        block that holds at least min_len. (start is ignored: free space is
+        indexed by size, not place. Within a size, the lowest block goes first.)
+        :return: (first block, length), or (-1, 0) if there's no such run
+        """
+        want = (max_len - 1).bit_length()   # the order that holds max_len blocks
+        for order in range(want, self.max_order + 1):
+            if len(self.free[order]) > 0:
+                first = self._lowest(order)
+                length = max_len
+                break
+        else:
+            for order in range(want - 1, (min_len - 1).bit_length() - 1, -1):
+                if len(self.free[order]) > 0:
+                    first = self._lowest(order)
+                    length = 1 << order
+                    break
+            else:
+                # no buddy block is big enough, but the bitmap may still have
+                # an unaligned run of min_len
+                first, length = self.block_map.findRun(min_len, max_len, start)
+        if first < 0:
+            return -1, 0
+        self._take(first, length)
+        self.block_map.setRun(first, length, True)
+        return first, length
+
+    def freeRun(self, start, length):
+        self.block_map.freeRun(start, length)
+        self._addRun(start, length, merge=True)
+
+    def freeByOrder(self):
+        """ :return: list of how many free buddy blocks there are of each order """
+        return [len(blocks) for blocks in self.free]
+
+
+# Nosetests
+def test_buddy_allocator():
+    from BlockMap import BlockMap
+    bm = BlockMap(1000)
+    bm.setRun(0, 3, True)
+    bm.setRun(500, 1, True)
+    buddy = BuddyAllocator(bm)
+    assert sum(count << order for order, count in enumerate(buddy.freeByOrder())) == bm.free_count == 996
+    assert buddy.allocRun(100, 200) == (512, 200), "should come from the biggest aligned block"
+    assert all(bm[n] for n in range(512, 712)) and bm.free_count == 796
+    assert buddy.alloc() == 3 and buddy.allocRun(2, 2) == (502, 2), "should take the smallest block that fits"
+    buddy.freeRun(512, 200)
+    buddy.freeRun(502, 2)
+    assert 512 in buddy.free[8] and bm.free_count == 995, "freed blocks should merge with their buddies"
+    assert buddy.allocRun(600, 600) == (-1, 0)
+    # 13..23 is free, but the biggest buddy block in it is 16..23
+    bm2 = BlockMap(24)
+    bm2.setRun(0, 13, True)
+    small = BuddyAllocator(bm2)
+    assert small.allocRun(11, 11) == (13, 11) and bm2.free_count == 0
+
+def test_buddy_heaps_stay_bounded():
+    from BlockMap import BlockMap
+    buddy = BuddyAllocator(BlockMap(4096))
+    for i in range(2000):
+        # churn: every free pushes the block back, every alloc leaves a stale entry
+        first, length = buddy.allocRun(8, 8)
+        buddy.freeRun(first, length)
+    # without rebuilding, each order the splits pass through would hold about 2000 entries
+    assert max(len(heap) for heap in buddy.heaps) <= 2 * STALE_FACTOR
+    assert buddy.allocRun(4096, 4096) == (0, 4096)
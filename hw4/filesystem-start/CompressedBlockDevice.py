@@ -0,0 +1,399 @@
+import os
+import sys
+import time
+import threading
+import zlib
+import lzma
+from array import array
+from collections import OrderedDict
+from struct import Struct
+from BlockDevice import *
+
+COMPRESSED_MAGIC = 0xC0DEB10C
+
+# Header, at the start of the image file:
+#   magic number - 32 bits
+#   block size - 32 bits
+#   number of logical blocks - 32 bits
+#   codec (index into CODECS) - 32 bits
+#   file offset of the saved index, 0 if none - 64 bits
+#   length of the saved (zlib compressed) index - 32 bits
+HeaderFormat = Struct("<IIIIQI")
+HEADER_SIZE = 64    # room to grow; records start after this
+
+CODECS = ("zlib", "lzma")
+
+
+class CompressedBlockDevice(BlockDevice):
+    """ A BlockDevice that stores every logical block compressed, to cut
+        both host I/O bytes and image size. Directory blobs and mostly-zero
+        blocks compress very well, and all-zero blocks aren't stored at all.
+
+        The image is log structured: each write appends the block's
+        compressed record to the end of the file, and an index maps every
+        logical block to the file offset and length of its latest record
+        (length 0 means all zeros). The index lives in memory and is saved,
+        itself compressed, by sync and close - so an image is only
+        consistent as of its last sync. Records replaced by later writes
+        are garbage until compact() rewrites the file, which close does
+        once there's more garbage than live data.
+
+        Compressing and decompressing run in parallel for parallel callers;
+        the index, the cache and the file itself (reads, appends and
+        compaction) are only touched under self.lock.
+
+        Recently used blocks are kept decompressed in a small LRU cache.
+        compressionStats reports the compression ratio and the CPU time
+        spent per block compressing and decompressing.
+    """
+
+    def __init__(self, filename="compressed.1024.dev", blockCount=-1,
+                 blockSize=default_blocksize, create=False, codec="zlib", level=6,
+                 cache_blocks=64):
+        """
+        :param filename:     the image filename
+        :param blockCount:   how big the device should be, in (logical) blocks
+        :param blockSize:    how big each block should be
+        :param create:       whether to create the image or just open it
+        :param codec:        "zlib" or "lzma" (only used when creating)
+        :param level:        compression level, passed to the codec
+        :param cache_blocks: how many decompressed blocks to keep in memory
+        """
+        self.map = None
+        self.map_view = None
+        self.seek_lock = threading.Lock()
+        self.lock = threading.RLock()   # guards the index, the cache and the end of the log
+        self.iostats = IOStats()
+        self.level = level
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()      # block number -> decompressed bytes
+        self.index_bytes = 0            # length of the saved index in the log
+        if create:
+            assert blockCount > 0, "invalid device size: {}".format(blockCount)
+            assert codec in CODECS, "unknown codec {}".format(codec)
+            self.filename = BlockDevice.normalize_filename(filename, blockSize)
+            self.num_blocks = blockCount
+            self.block_size = blockSize
+            self.codec = codec
+            self.handle = open(self.filename, 'wb+', buffering=0)
+            self.offsets = array('Q', bytes(8 * blockCount))
+            self.lengths = array('I', bytes(4 * blockCount))
+            self.end = HEADER_SIZE
+            self._write_header(0, 0)
+        else:
+            self.filename = BlockDevice.normalize_filename(filename)
+            self.handle = open(self.filename, 'rb+', buffering=0)
+            header = os.pread(self.handle.fileno(), HeaderFormat.size, 0)
+            (magic, self.block_size, self.num_blocks, codec_num, index_offset, index_len) = \
+                HeaderFormat.unpack(header)
+            assert magic == COMPRESSED_MAGIC, "{} isn't a compressed device image".format(self.filename)
+            self.codec = CODECS[codec_num]
+            self.end = os.fstat(self.handle.fileno()).st_size
+            if index_offset == 0:
+                self.offsets = array('Q', bytes(8 * self.num_blocks))
+                self.lengths = array('I', bytes(4 * self.num_blocks))
+            else:
+                index = zlib.decompress(os.pread(self.handle.fileno(), index_len, index_offset))
+                self.offsets = array('Q')
+                self.offsets.frombytes(index[0:8 * self.num_blocks])
+                self.lengths = array('I')
+                self.lengths.frombytes(index[8 * self.num_blocks:])
+                if sys.byteorder == "big":  # saved little-endian
+                    self.offsets.byteswap()
+                    self.lengths.byteswap()
+                self.index_bytes = index_len
+        # blocks with no record are zeros: that's exactly BlockDevice's notion of a hole
+        self.discarded = bytearray(1 if length == 0 else 0 for length in self.lengths)
+        self.live_bytes = sum(self.lengths)
+        self.garbage_bytes = self.end - HEADER_SIZE - self.live_bytes - self.index_bytes
+        self.counters = dict.fromkeys(("logical_bytes_written", "physical_bytes_written", "zero_blocks",
+                                       "compressed_blocks", "compress_ns", "decompressed_blocks",
+                                       "decompress_ns", "cache_hits", "cache_misses"), 0)
+
+    ########### codec
+
+    def _compress(self, data):
+        started = time.process_time_ns()
+        if self.codec == "zlib":
+            ret = zlib.compress(data, self.level)
+        else:
+            ret = lzma.compress(data, preset=self.level)
+        self.counters["compress_ns"] += time.process_time_ns() - started
+        self.counters["compressed_blocks"] += 1
+        return ret
+
+    def _decompress(self, data):
+        started = time.process_time_ns()
+        if self.codec == "zlib":
+            ret = zlib.decompress(data)
+        else:
+            ret = lzma.decompress(data)
+        self.counters["decompress_ns"] += time.process_time_ns() - started
+        self.counters["decompressed_blocks"] += 1
+        return ret
+
+    ########### the BlockDevice hooks
+
+    def _readv(self, offset, buffers):
+        block_num = offset // self.block_size
+        for buff in buffers:
+            for start in range(0, len(buff), self.block_size):
+                buff[start:start + self.block_size] = self._get(block_num)
+                block_num += 1
+
+    def _writev(self, offset, buffers):
+        block_num = offset // self.block_size
+        for buff in buffers:
+            view = memoryview(buff)
+            for start in range(0, len(buff), self.block_size):
+                self._put(block_num, bytes(view[start:start + self.block_size]))
+                block_num += 1
+
+    def _get(self, block_num):
+        with self.lock:
+            data = self.cache.get(block_num)
+            if data is not None:
+                self.cache.move_to_end(block_num)
+                self.counters["cache_hits"] += 1
+                return data
+            self.counters["cache_misses"] += 1
+            offset = self.offsets[block_num]
+            length = self.lengths[block_num]
+            if length == 0:
+                return bytes(self.block_size)
+            record = os.pread(self.handle.fileno(), length, offset)
+        data = self._decompress(record)
+        with self.lock:
+            # a write while we decompressed replaced the block: don't cache the old copy
+            if self.offsets[block_num] == offset and self.lengths[block_num] == length:
+                self._cache(block_num, data)
+        return data
+
+    def _put(self, block_num, data):
+        self.counters["logical_bytes_written"] += len(data)
+        if data.count(0) == len(data):
+            # all zeros: no record needed
+            self.counters["zero_blocks"] += 1
+            with self.lock:
+                self._drop(block_num)
+                self.discarded[block_num] = 1
+            return
+        record = self._compress(data)
+        with self.lock:
+            # the record is in the file before the index points at it, and
+            # compact can't move the file out from under us
+            offset = self.end
+            os.pwrite(self.handle.fileno(), record, offset)
+            self.end += len(record)
+            self._drop(block_num)
+            self.offsets[block_num] = offset
+            self.lengths[block_num] = len(record)
+            self.live_bytes += len(record)
+            self.counters["physical_bytes_written"] += len(record)
+            self._cache(block_num, data)
+
+    def _drop(self, block_num):
+        """ Forget block_num's current record (lock held) """
+        self.live_bytes -= self.lengths[block_num]
+        self.garbage_bytes += self.lengths[block_num]
+        self.offsets[block_num] = 0
+        self.lengths[block_num] = 0
+        self.cache.pop(block_num, None)
+
+    def _cache(self, block_num, data):
+        with self.lock:
+            self.cache[block_num] = data
+            self.cache.move_to_end(block_num)
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+
+    def discard(self, start, count=1):
+        assert start + count <= self.num_blocks, "discard past end of device"
+        with self.lock:
+            for block_num in range(start, start + count):
+                self._drop(block_num)
+            self.discarded[start:start + count] = b'\x01' * count
+        if self.iostats.enabled:
+            self.iostats.record("discard", start, count, self.block_size, 0)
+
+    ########### index, compaction and shutdown
+
+    def _write_header(self, index_offset, index_len):
+        header = bytearray(HEADER_SIZE)
+        HeaderFormat.pack_into(header, 0, COMPRESSED_MAGIC, self.block_size, self.num_blocks,
+                               CODECS.index(self.codec), index_offset, index_len)
+        os.pwrite(self.handle.fileno(), header, 0)
+
+    def sync(self):
+        """ Save the index at the end of the log, and point the header at it.
+            New records go after it; the index saved before it is garbage.
+        """
+        with self.lock:
+            offsets = array('Q', self.offsets)
+            lengths = array('I', self.lengths)
+            if sys.byteorder == "big":
+                offsets.byteswap()
+                lengths.byteswap()
+            index = zlib.compress(offsets.tobytes() + lengths.tobytes())
+            os.pwrite(self.handle.fileno(), index, self.end)
+            self._write_header(self.end, len(index))
+            self.end += len(index)
+            self.garbage_bytes += self.index_bytes
+            self.index_bytes = len(index)
+
+    def compact(self):
+        """ Rewrite the image with only the live records, dropping the garbage """
+        with self.lock:
+            tmpname = self.filename + ".compact"
+            with open(tmpname, 'wb', buffering=0) as out:
+                out.write(bytes(HEADER_SIZE))
+                end = HEADER_SIZE
+                for block_num in range(self.num_blocks):
+                    length = self.lengths[block_num]
+                    if length == 0:
+                        continue
+                    out.write(os.pread(self.handle.fileno(), length, self.offsets[block_num]))
+                    self.offsets[block_num] = end
+                    end += length
+            self.handle.close()
+            os.replace(tmpname, self.filename)
+            self.handle = open(self.filename, 'rb+', buffering=0)
+            self.end = end
+            self.garbage_bytes = 0
+            self.index_bytes = 0
+            self.sync()
+
+    def close(self):
+        if self.garbage_bytes > self.live_bytes:
+            self.compact()
+        else:
+            self.sync()
+        self.handle.close()
+
+    ########### stats
+
+    def compressionStats(self):
+        """
+        :return: dict of counters, plus:
+            ratio               logical bytes stored / bytes of live records
+            write_ratio         logical bytes written / physical bytes written
+            compress_us_per_block, decompress_us_per_block: CPU time per block
+        """
+        ret = dict(self.counters)
+        stored_blocks = self.num_blocks - self.discarded.count(1)
+        ret["live_bytes"] = self.live_bytes
+        ret["garbage_bytes"] = self.garbage_bytes
+        ret["ratio"] = self.blocks_to_bytes(stored_blocks) / self.live_bytes if self.live_bytes > 0 else 0.0
+        ret["write_ratio"] = (ret["logical_bytes_written"] / ret["physical_bytes_written"]
+                              if ret["physical_bytes_written"] > 0 else 0.0)
+        ret["compress_us_per_block"] = (ret["compress_ns"] / ret["compressed_blocks"] / 1000
+                                        if ret["compressed_blocks"] > 0 else 0.0)
+        ret["decompress_us_per_block"] = (ret["decompress_ns"] / ret["decompressed_blocks"] / 1000
+                                          if ret["decompressed_blocks"] > 0 else 0.0)
+        return ret
+
+    def compressionStatsAsString(self):
+        s = self.compressionStats()
+        return ("{codec}: ratio {ratio:.2f} ({live_bytes} live bytes, {garbage_bytes} garbage), "
+                "{compressed_blocks} blocks compressed at {compress_us_per_block:.1f}us, "
+                "{decompressed_blocks} decompressed at {decompress_us_per_block:.1f}us, "
+                "{zero_blocks} zero blocks, cache {cache_hits} hits / {cache_misses} misses"
+                ).format(codec=self.codec, **s)
+
+
+# Nosetests
+def test_compressed_round_trip():
+    for codec in CODECS:
+        cd = CompressedBlockDevice('testCompressed', 32, create=True, codec=codec, cache_blocks=2)
+        bs = cd.block_size
+        text = bytearray((b'file|%d\n' % 17) * (bs // 8 + 1))[0:bs]
+        for n in range(8):
+            cd.write_block(n, text)
+        cd.write_block(3, bytearray(bs))    # zeros aren't stored
+        cd.write_block(2, text)             # a rewrite leaves garbage behind
+        stats = cd.compressionStats()
+        assert stats["ratio"] > 4, "repetitive text should compress well ({})".format(stats["ratio"])
+        assert stats["zero_blocks"] == 1 and cd.is_discarded(3)
+        cd.close()
+
+        cd = CompressedBlockDevice('testCompressed')
+        assert cd.num_blocks == 32 and cd.codec == codec
+        buff = bytearray(bs)
+        cd.read_block(2, buff)
+        assert buff == text
+        cd.read_block(3, buff)
+        assert buff == bytes(bs)
+        cd.close()
+
+def test_compressed_sync_then_write():
+    cd = CompressedBlockDevice('testCompressedSync', 8, create=True)
+    bs = cd.block_size
+    first = bytearray(b'first block ' * (bs // 12 + 1))[0:bs]
+    second = bytearray(b'second block ' * (bs // 13 + 1))[0:bs]
+    cd.write_block(1, first)
+    cd.sync()
+    cd.write_block(2, second)   # mustn't land on the index sync just saved
+    buff = bytearray(bs)
+    reopened = CompressedBlockDevice('testCompressedSync')
+    reopened.read_block(1, buff)
+    assert buff == first and reopened.is_discarded(2), "should see the image as of the sync"
+    reopened.handle.close()
+    cd.sync()
+    assert cd.garbage_bytes > 0, "the first index should be garbage now"
+    reopened = CompressedBlockDevice('testCompressedSync')
+    reopened.read_block(2, buff)
+    assert buff == second and reopened.garbage_bytes == cd.garbage_bytes
+    reopened.write_block(3, first)
+    reopened.close()
+    cd.handle.close()
+    cd = CompressedBlockDevice('testCompressedSync')
+    cd.read_block(1, buff)
+    assert buff == first
+    cd.read_block(3, buff)
+    assert buff == first
+    cd.close()
+
+def test_compressed_write_during_read():
+    cd = CompressedBlockDevice('testCompressedRace', 8, create=True, cache_blocks=0)
+    bs = cd.block_size
+    old = bytearray(b'old ' * (bs // 4))
+    new = bytearray(b'new ' * (bs // 4))
+    cd.write_block(1, old)
+    cd.cache_blocks = 4
+    decompress = cd._decompress
+    def write_meanwhile(record):
+        # another thread rewrites block 1 while this read is decompressing it
+        writer = threading.Thread(target=cd.write_block, args=(1, new))
+        writer.start()
+        writer.join()
+        return decompress(record)
+    cd._decompress = write_meanwhile
+    buff = bytearray(bs)
+    cd.read_block(1, buff)
+    cd._decompress = decompress
+    assert buff == old
+    cd.read_block(1, buff)
+    assert buff == new, "the read mustn't have cached the block it replaced"
+    cd.compact()
+    cd.read_block(1, buff)
+    assert buff == new
+    cd.close()
+
+def test_compressed_filesystem():
+    import FileSystem
+    from INode import INodeType
+    cd = CompressedBlockDevice('nose_fs_compressed', 300, create=True)
+    FileSystem.FileSystem.createFileSystem(cd, 300)
+    fs = FileSystem.FileSystem.mount(cd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(b'all work and no play ' * 500)
+    inode.write(0, data)
+    fs.unmount()
+    size = os.stat(cd.filename).st_size
+    assert size < 300 * 1024 // 10, "image should be much smaller than the device ({})".format(size)
+
+    fs = FileSystem.FileSystem.mount(CompressedBlockDevice('nose_fs_compressed'))
+    readback = bytearray(len(data))
+    fs.inode_map[inode.inode_num].read(0, readback)
+    fs.unmount()
+    assert readback == data
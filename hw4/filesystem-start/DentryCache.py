@@ -0,0 +1,116 @@
+from collections import OrderedDict
+
+DEFAULT_DCACHE_ENTRIES = 4096
+NEGATIVE = -1   # cached answer for "there's no such name in that directory"
+
+
+class DentryCache():
+    """ The directory entry cache maps (parent directory inode number, name)
+        to the child's inode number, so path lookups don't have to parse
+        directories again and again. It also keeps negative entries, for
+        names that were looked up and found not to exist.
+
+        A directory is parsed once to fill in all of its names (fill), and
+        add_child keeps the cache up to date as it changes a directory
+        (put). At most <capacity> entries are kept, least recently used
+        ones go first. Negative entries are also indexed by directory, so a
+        directory's can all be dropped when it changes.
+    """
+
+    def __init__(self, capacity=DEFAULT_DCACHE_ENTRIES):
+        self.capacity = capacity
+        self.entries = OrderedDict()   # (parent inode num, name) -> inode num or NEGATIVE
+        self.negatives = {}            # parent inode num -> set of names with NEGATIVE entries
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, parent, name):
+        """
+        :return: the child's inode number, NEGATIVE if it's known not to
+                 exist, or None if we don't know
+        """
+        key = (parent, name)
+        inode_num = self.entries.get(key)
+        if inode_num is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return inode_num
+
+    def put(self, parent, name, inode_num=NEGATIVE):
+        self._unindex(parent, name)
+        self.entries[(parent, name)] = inode_num
+        self.entries.move_to_end((parent, name))
+        if inode_num == NEGATIVE:
+            self.negatives.setdefault(parent, set()).add(name)
+        self._trim()
+
+    def _unindex(self, parent, name):
+        names = self.negatives.get(parent)
+        if names is not None:
+            names.discard(name)
+            if len(names) == 0:
+                del self.negatives[parent]
+
+    def fill(self, parent, children):
+        """
+        Enter the names of a freshly parsed directory. Names already cached
+        are left alone - the cache may know about changes that haven't been
+        written to the directory yet.
+        :param children: dict of name -> inode number
+        """
+        for name, inode_num in children.items():
+            if self.entries.setdefault((parent, name), inode_num) == NEGATIVE:
+                self.negatives.setdefault(parent, set()).add(name)
+        self._trim()
+
+    def invalidate(self, parent, name):
+        self.entries.pop((parent, name), None)
+        self._unindex(parent, name)
+
+    def dropNegatives(self, parent):
+        """ Forget every "no such name" answer for directory parent """
+        for name in self.negatives.pop(parent, ()):
+            self.entries.pop((parent, name), None)
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        self._trim()
+
+    def _trim(self):
+        while len(self.entries) > self.capacity:
+            (parent, name), inode_num = self.entries.popitem(last=False)
+            if inode_num == NEGATIVE:
+                self._unindex(parent, name)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"capacity": self.capacity, "resident": len(self.entries),
+                "negative": sum(1 for inode_num in self.entries.values() if inode_num == NEGATIVE),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Nosetests
+def test_dentry_cache():
+    dc = DentryCache(capacity=4)
+    assert dc.get(0, "a") is None
+    dc.fill(0, {"a": 5, "b": 6})
+    dc.put(0, "nope")
+    assert dc.get(0, "a") == 5 and dc.get(0, "nope") == NEGATIVE
+    dc.put(0, "b", 7)
+    dc.fill(0, {"b": 6})
+    assert dc.get(0, "b") == 7, "fill overwrote a newer entry"
+    dc.fill(5, {"x": 8, "y": 9})
+    assert len(dc) == 4 and dc.get(0, "a") is None, "least recently used entry should be gone"
+    assert dc.hits == 3 and dc.misses == 2
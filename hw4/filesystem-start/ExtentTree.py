@@ -0,0 +1,253 @@
+from array import array
+from bisect import bisect_right
+import INode
+
+EXTENTS_FLAG = 0x80     # set in an INode's level byte if it's extent mapped
+LEAF_WIDTH = 3          # a leaf record is (logical start, physical start, length)
+INDEX_WIDTH = 2         # an index record is (logical start, child block)
+
+
+class ExtentTree():
+    """ The block map of an extent-mapped INode: a B-tree of extents,
+        (logical start, physical start, length) records, sorted by logical
+        start. A contiguous run of a file's blocks is one record, however
+        long it is.
+
+        Every node is an array of 32 bit ints: the number of records, then
+        the records. The root node is the INode's own block_ptrs, so a file
+        with a few extents needs no blocks for its map at all. When the root
+        fills up, its records are pushed down into a block of their own and
+        the root becomes an index node over it; inode.level is the depth of
+        the tree (0: the root is a leaf). Index records are (logical start
+        of the child's first record, child's disk address).
+
+        Lookups bisect each node on the way down, so they take O(log n).
+        An ExtentTree is just a view of an INode's map; make one when
+        you need it.
+    """
+
+    def __init__(self, fs, inode):
+        self.fs = fs
+        self.inode = inode
+
+    @staticmethod
+    def capacity(node, width):
+        return (len(node) - 1) // width
+
+    def _node(self, block_addr):
+        """ The tree node in block block_addr, from the block cache """
+        node = self.fs.blockCache.get(block_addr)
+        if node is None:
+            node = INode.pointerView(bytearray(self.fs.block_device.view_block(block_addr)))
+            self.fs.blockCache.load(block_addr, node, meta=True)
+        return node
+
+    @staticmethod
+    def _starts(node, width):
+        """ The logical starts of node's records (a view for a block, so bisecting doesn't copy it) """
+        return node[1:1 + node[0] * width:width]
+
+    @staticmethod
+    def _records(node, width):
+        return [tuple(node[1 + i * width:1 + (i + 1) * width]) for i in range(node[0])]
+
+    def _store(self, node, records, width, block_addr):
+        """ Write records into node (and mark its block dirty, unless it's the root) """
+        flat = [value for record in records for value in record]
+        node[0] = len(records)
+        node[1:1 + len(flat)] = array('I', flat)
+        if block_addr != 0:
+            self.fs.blockCache.put(block_addr, node, meta=True)
+
+    def find(self, block_number):
+        """
+        :return: (the (logical start, physical start, length) extent holding
+                 block_number or None if it's a hole, the logical start of
+                 the next extent after block_number or None if there isn't one)
+        """
+        node = self.inode.block_ptrs
+        bound = None    # every record under node starts before this
+        for depth in range(self.inode.level, 0, -1):
+            starts = self._starts(node, INDEX_WIDTH)
+            i = max(bisect_right(starts, block_number) - 1, 0)
+            if i + 1 < len(starts):
+                bound = starts[i + 1]
+            node = self._node(node[2 + i * INDEX_WIDTH])
+        starts = self._starts(node, LEAF_WIDTH)
+        i = bisect_right(starts, block_number) - 1
+        next_start = starts[i + 1] if i + 1 < len(starts) else bound
+        if i >= 0:
+            start, phys, length = node[1 + i * LEAF_WIDTH:1 + (i + 1) * LEAF_WIDTH]
+            if block_number < start + length:
+                return (start, phys, length), next_start
+        return None, next_start
+
+    def lookup(self, block_number):
+        """ :return: the disk address of block_number, or 0 for a hole """
+        extent, next_start = self.find(block_number)
+        if extent is None:
+            return 0
+        return extent[1] + block_number - extent[0]
+
+    def addrs(self, first_block, count):
+        """ :return: list of disk addresses of blocks first_block .. first_block+count-1, 0 for holes """
+        ret = []
+        block_number = first_block
+        end = first_block + count
+        while block_number < end:
+            extent, next_start = self.find(block_number)
+            if extent is not None:
+                start, phys, length = extent
+                n = min(end, start + length) - block_number
+                ret.extend(range(phys + block_number - start, phys + block_number - start + n))
+            else:
+                n = (end if next_start is None else min(end, next_start)) - block_number
+                ret.extend([0] * n)
+            block_number += n
+        return ret
+
+    def extents(self):
+        """ :return: every extent, in logical order """
+        ret = []
+        self._walk(self.inode.block_ptrs, self.inode.level, ret, [])
+        return ret
+
+    def _walk(self, node, depth, extents, tree_blocks):
+        if depth == 0:
+            extents.extend(self._records(node, LEAF_WIDTH))
+            return
+        for start, child in self._records(node, INDEX_WIDTH):
+            tree_blocks.append(child)
+            self._walk(self._node(child), depth - 1, extents, tree_blocks)
+
+    def insert(self, start, phys, length):
+        """
+        Map blocks start .. start+length-1 to disk blocks phys .. phys+length-1.
+        They must be a hole now. An extent that continues the one before it
+        (or is continued by the one after) is merged with it.
+        """
+        split = self._insert(self.inode.block_ptrs, self.inode.level, 0, (start, phys, length))
+        if split is None:
+            return
+        # the root overflowed: push its records down into a block of their
+        # own, and split that block the way any other node is split
+        root = self.inode.block_ptrs
+        width = LEAF_WIDTH if self.inode.level == 0 else INDEX_WIDTH
+        records = split
+        child_addr = self.fs.allocBlock(self.inode.allocGoal(self.fs))
+        child = INode.pointerView(bytearray(self.fs.block_size))
+        new_split = self._split(child, records, width, child_addr)
+        index = [(records[0][0], child_addr)]
+        if new_split is not None:
+            index.append(new_split)
+        root[:] = [0] * len(root)
+        self._store(root, index, INDEX_WIDTH, 0)
+        self.inode.level += 1
+
+    def _insert(self, node, depth, block_addr, extent):
+        """
+        Insert extent under node (in block block_addr, 0 for the root)
+        :return: None if it all fit. Otherwise, for the root: all of its records;
+                 for a node in a block: the index record of the new block it was split into
+        """
+        if depth == 0:
+            width = LEAF_WIDTH
+            records = self._records(node, width)
+            start, phys, length = extent
+            i = bisect_right([record[0] for record in records], start)
+            if i > 0 and records[i - 1][0] + records[i - 1][2] == start \
+                    and records[i - 1][1] + records[i - 1][2] == phys:
+                # continues the extent before it
+                start, phys, length = records[i - 1][0], records[i - 1][1], records[i - 1][2] + length
+                i -= 1
+                del records[i]
+            if i < len(records) and start + length == records[i][0] and phys + length == records[i][1]:
+                length += records[i][2]
+                del records[i]
+            records.insert(i, (start, phys, length))
+        else:
+            width = INDEX_WIDTH
+            records = self._records(node, width)
+            i = max(bisect_right([record[0] for record in records], extent[0]) - 1, 0)
+            child_addr = records[i][1]
+            split = self._insert(self._node(child_addr), depth - 1, child_addr, extent)
+            if split is None and extent[0] >= records[i][0]:
+                return None     # nothing to change at this level
+            records[i] = (min(records[i][0], extent[0]), child_addr)
+            if split is not None:
+                records.insert(i + 1, split)
+        if len(records) <= self.capacity(node, width):
+            self._store(node, records, width, block_addr)
+            return None
+        if block_addr == 0:
+            return records
+        return self._split(node, records, width, block_addr)
+
+    def _split(self, node, records, width, block_addr):
+        """
+        Store records in node (in block block_addr), moving the top half into
+        a new block if they don't fit
+        :return: None, or the index record for the new block
+        """
+        if len(records) <= self.capacity(node, width):
+            self._store(node, records, width, block_addr)
+            return None
+        half = len(records) // 2
+        new_addr = self.fs.allocBlock(self.inode.allocGoal(self.fs))
+        new_node = INode.pointerView(bytearray(self.fs.block_size))
+        self._store(new_node, records[half:], width, new_addr)
+        self._store(node, records[:half], width, block_addr)
+        return records[half][0], new_addr
+
+    def truncate(self, num_blocks):
+        """
+        Unmap every block from num_blocks on. The tree is rebuilt from the
+        extents that are left, which are few if the file was written in big
+        pieces.
+        :return: list of the disk blocks no longer used - data and tree - for the caller to free
+        """
+        extents = []
+        freed = []
+        self._walk(self.inode.block_ptrs, self.inode.level, extents, freed)
+        self.inode.block_ptrs = [0] * len(self.inode.block_ptrs)
+        self.inode.level = 0
+        for start, phys, length in extents:
+            keep = max(min(length, num_blocks - start), 0)
+            freed.extend(range(phys + keep, phys + length))
+            if keep > 0:
+                self.insert(start, phys, keep)
+        return freed
+
+    def asString(self):
+        return " ".join("{}+{}@{}".format(start, length, phys) for start, phys, length in self.extents())
+
+
+# Nosetests
+def test_extent_tree():
+    import FileSystem
+    from INode import INodeType
+    from RAMBlockDevice import RAMBlockDevice
+    rd = RAMBlockDevice("nose_fs_extent_tree", 2000)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=2000)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE, extents=True)]
+    tree = ExtentTree(fs, inode)
+    tree.insert(0, 500, 10)
+    tree.insert(10, 510, 5)
+    assert tree.extents() == [(0, 500, 15)], "contiguous extents should merge"
+    # every other block, so nothing merges and the tree has to grow
+    for i in range(300):
+        tree.insert(100 + 2 * i, 1000 + 2 * i, 1)
+    assert inode.level >= 1 and len(tree.extents()) == 301
+    assert tree.lookup(3) == 503 and tree.lookup(15) == 0 and tree.lookup(100 + 2 * 77) == 1000 + 2 * 77
+    assert tree.find(16) == (None, 100) and tree.find(101) == (None, 102)
+    assert tree.addrs(12, 5) == [512, 513, 514, 0, 0]
+    for i in range(300):
+        tree.insert(101 + 2 * i, 1001 + 2 * i, 1)
+    assert tree.addrs(95, 610) == [0] * 5 + list(range(1000, 1600)) + [0] * 5
+    assert len(tree.extents()) < 40, "filling the gaps should merge extents"
+    freed = tree.truncate(110)
+    assert sorted(freed)[-1] == 1599 and len([b for b in freed if b >= 1000]) == 590
+    assert tree.extents() == [(0, 500, 15), (100, 1000, 10)] and inode.level == 0
+    fs.freeBlocks(freed)
+    fs.unmount()
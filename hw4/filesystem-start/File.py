@@ -1,3 +1,4 @@
+import codecs
 import FileSystem
 from enum import Enum
 from INode import *
@@ -19,6 +20,45 @@ def inode_to_object(filesystem, inode:INode, parent, mode="r"):
     print("unknown inode type in inode_to_object")
     return None
 
+MIN_READAHEAD = 4   # blocks
+
+
+class ReadAhead(object):
+    """ Read-ahead state for one open File. When reads pick up where the
+        last one stopped, the blocks after them are fetched into the block
+        cache before they're asked for, in one device request per run,
+        and the window doubles (up to the file system's max_readahead) for
+        as long as the reads stay sequential. A read anywhere else resets it.
+    """
+    def __init__(self):
+        self.next_block = 0     # where a sequential read would start
+        self.window = 0         # 0 while the reads don't look sequential
+        self.fetched_to = 0     # blocks before this have been read ahead
+
+    def access(self, inode, offset, nbytes):
+        """ A read of nbytes @ offset is about to happen """
+        max_window = inode.fs.max_readahead
+        if max_window <= 0 or nbytes <= 0:
+            return
+        block_size = inode.fs.block_size
+        first_block = offset // block_size
+        last_block = (offset + nbytes - 1) // block_size
+        if first_block != self.next_block:
+            self.window = 0
+        elif self.window == 0:
+            self.window = min(MIN_READAHEAD, max_window)
+            self.fetched_to = first_block
+        self.next_block = (offset + nbytes) // block_size
+        if self.window == 0:
+            return
+        # once the reads get halfway into the window, fetch the next (bigger) one
+        if self.fetched_to < last_block + 1 + self.window // 2:
+            start = max(self.fetched_to, first_block)
+            self.fetched_to = last_block + 1 + self.window
+            inode.prefetch(start, self.fetched_to - start)
+            self.window = min(2 * self.window, max_window)
+
+
 class File(object):
     """ A File is a wrapper for an iNode that provides arbitrary-
         length / non-aligned reads, and keeps track of the current
@@ -30,12 +70,21 @@ class File(object):
         self.parent = parent
         self.fs     = fs
         self.mode   = mode
+        self.readahead = ReadAhead()
 
     def read(self, buff):
+        self.readahead.access(self.inode, self.offset, len(buff))
         num_read = self.inode.read(self.offset, buff)
         self.offset += num_read
         return num_read
 
+    def readViews(self, nbytes):
+        """ read, without copying: see INode.readViews """
+        self.readahead.access(self.inode, self.offset, nbytes)
+        views = self.inode.readViews(self.offset, nbytes)
+        self.offset += sum(len(view) for view in views)
+        return views
+
     def write(self, buff):
         if self.mode != "r":
             if self.mode == "a":
@@ -83,7 +132,10 @@ class Directory(File):
         # do we have any invariants wrt. directories being cached?
         self.ensure_cached()
         self.children[child_name] = child
-        self.fs.dirCache.append(self)
+        self.fs.dirCache[self.inode.inode_num] = self
+        # path lookups see the new name right away, before this directory is written
+        self.fs.dcache.dropNegatives(self.inode.inode_num)
+        self.fs.dcache.put(self.inode.inode_num, child_name, child_inode.inode_num)
 
     def get_children(self):
         self.ensure_cached()
@@ -119,23 +171,40 @@ class Directory(File):
     def read(self):
         """ Read the directory from its iNode's contents """
         # print("fetching dir, {} bytes".format(str(self.inode.num_bytes)))
-        buff = bytearray(self.inode.length)
-        self.inode.read(0, buff) # read the whole file
-        dir_as_string = buff.decode("utf-8")
-        child_pipe_inode = dir_as_string.split("\n")
         self.children = {}
+        for name, inode_num in Directory.entries(self.inode).items():
+            child_obj = inode_to_object(self.fs, self.fs.inode_map[inode_num], self, self.mode)
+            self.children[name] = child_obj
+
+    @staticmethod
+    def entries(inode: INode):
+        """ The name -> inode number pairs in a directory's contents, without
+            making INodes (or Files) for the children
+        """
+        # decode straight out of the cached blocks - a character may straddle two of them
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        parts = [decoder.decode(view) for view in inode.readViews(0, inode.length)]
+        parts.append(decoder.decode(b"", final=True))
+        dir_as_string = "".join(parts)
+        child_pipe_inode = dir_as_string.split("\n")
+        ret = {}
         # print("unmarshalling directory {}".format(dir_as_string))
         for child in child_pipe_inode:
             if len(child) == 0: continue
             # print("unmarshaling {} ({})".format(child, len(child)))
             entry = child.split("|")
-            child_obj = inode_to_object(self.fs, self.fs.inode_map[int(entry[1])], self, self.mode)
-            self.children[entry[0]] = child_obj
+            ret[entry[0]] = int(entry[1])
+        return ret
 
     def sync(self):
         self.flush()
 
 # TODO: add unit tests here. :)
+from RAMBlockDevice import RAMBlockDevice
+from DentryCache import NEGATIVE
+from ExtentTree import ExtentTree
+from BuddyAllocator import BuddyAllocator
+
 contents = bytearray(b'Lorem ipsum dolores umbridge yeah idr the rest of the latin placeholder thing')
 
 def test_inode_rw():
@@ -171,4 +240,345 @@ def test_namei():
     i_untitled.read(0, read_buff)
     assert read_buff == contents
     # assert 1 == 0
-    fs.unmount()
\ No newline at end of file
+    fs.unmount()
+
+def test_multiblock_read():
+    rd = RAMBlockDevice("nose_fs_multi", 200)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=200)
+    fs = FileSystem.FileSystem.mount(rd)
+    f_index = fs.allocINode(INodeType.FILE)
+    inode = fs.inode_map[f_index]
+    data = bytearray(i % 251 for i in range(3 * fs.block_size + 100))
+    inode.write(0, data)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[f_index]
+    whole = bytearray(len(data))
+    assert inode.read(0, whole) == len(data)
+    assert whole == data
+    # unaligned read spanning three blocks
+    part = bytearray(2 * fs.block_size)
+    assert inode.read(fs.block_size // 2, part) == len(part)
+    assert part == data[fs.block_size // 2:fs.block_size // 2 + len(part)]
+    fs.unmount()
+
+def test_sparse_read():
+    rd = RAMBlockDevice("nose_fs_sparse", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, b'0123456789')
+    # growing the file leaves holes, some of them past what the pointer tree holds yet
+    inode.truncate(40 * fs.block_size)
+    readback = bytearray(40 * fs.block_size)
+    assert inode.read(0, readback) == len(readback)
+    assert readback[:10] == b'0123456789' and readback[10:] == bytes(len(readback) - 10)
+    fs.unmount()
+
+def test_truncate_frees_blocks():
+    rd = RAMBlockDevice("nose_fs_trunc", 200)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=200)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(b'z' * (4 * fs.block_size)))
+    tail_addr = inode.getDiskAddrOfBlock(fs, 3)
+    inode.truncate(fs.block_size + 10)
+    assert inode.length == fs.block_size + 10
+    assert not fs.block_map[tail_addr], "truncate didn't free the tail block"
+    assert fs.block_device.is_discarded(tail_addr), "freed block wasn't discarded"
+    assert inode.getDiskAddrOfBlock(fs, 1) > 0
+    fs.unmount()
+
+def test_io_stats():
+    rd = RAMBlockDevice("nose_fs_stats", 200)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=200)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(3 * fs.block_size))
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[inode.inode_num]    # (reads its inode table block)
+    fs.resetIOStats()
+    inode.read(0, bytearray(3 * fs.block_size))
+    stats = fs.ioStats()
+    assert stats["fs"]["read"] == 1 and stats["fs"]["read_bytes"] == 3 * fs.block_size
+    # the three data blocks are contiguous, so they're one device request
+    assert stats["device"]["read"]["requests"] == 1
+    assert stats["device"]["read"]["blocks"] == 3
+    fs.unmount()
+
+def test_bounded_block_cache():
+    rd = RAMBlockDevice("nose_fs_cache", 2000)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=2000)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=16)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 239 for i in range(600 * fs.block_size))
+    inode.write(0, data)
+    assert len(fs.blockCache) <= 16, "block cache grew past its capacity"
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd, cache_bytes=16 * 1024)
+    readback = bytearray(len(data))
+    assert fs.inode_map[inode.inode_num].read(0, readback) == len(data)
+    assert readback == data, "data lost on its way through cache eviction"
+    fs.unmount()
+
+def test_incremental_flush():
+    rd = RAMBlockDevice("nose_fs_flush", 200)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=200)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(b'f' * (3 * fs.block_size)))
+    fs.flushBlockCache()
+    assert fs.blockCache.dirtyBlocks() == [], "flush should leave the cache clean"
+    fs.block_device.sync()
+    writes = rd.iostats.snapshot()["write"]["blocks"]
+    fs.flushBlockCache()
+    fs.block_device.sync()
+    assert rd.iostats.snapshot()["write"]["blocks"] == writes, "second flush rewrote clean blocks"
+    inode.write(0, b'g')
+    assert fs.blockCache.dirtyBlocks() == [inode.getDiskAddrOfBlock(fs, 0)]
+    fs.unmount()
+
+def test_pointer_blocks_little_endian():
+    import struct
+    on_disk = struct.pack("<3I", 7, 0x01020304, 0)
+    ptrs = pointerView(bytearray(on_disk))
+    assert list(ptrs) == [7, 0x01020304, 0] and bytes(pointerBytes(ptrs)) == on_disk
+    rd = RAMBlockDevice("nose_fs_endian", 400)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=400)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(b'p' * (40 * fs.block_size)))
+    assert inode.level >= 1
+    addrs = [inode.getDiskAddrOfBlock(fs, n) for n in range(40)]
+    pointer_block = inode.block_ptrs[0]
+    fs.unmount()
+    assert struct.unpack_from("<40I", rd.view_block(pointer_block)) == tuple(addrs), \
+        "block pointers should be stored little-endian"
+
+def test_sequential_readahead():
+    rd = RAMBlockDevice("nose_fs_readahead", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 233 for i in range(100 * fs.block_size))
+    inode.write(0, data)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    f = File(fs, None, fs.inode_map[inode.inode_num], "r")
+    fs.resetIOStats()
+    readback = bytearray()
+    chunk = bytearray(fs.block_size // 2)
+    while True:
+        num_read = f.read(chunk)
+        if num_read == 0:
+            break
+        readback += chunk[:num_read]
+    assert readback == data
+    # 200 half-block reads, but only a handful of growing read-ahead requests
+    assert fs.ioStats()["device"]["read"]["requests"] <= 8
+    assert fs.blockCache.prefetch_hits == 100
+    fs.unmount()
+
+def test_dentry_cache_lookups():
+    rd = RAMBlockDevice("nose_fs_dcache", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd)
+    root = inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+    sub = fs.inode_map[fs.allocINode(INodeType.DIRECTORY)]
+    root.add_child("sub", sub)
+    leaf = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    subdir = inode_to_object(fs, sub, root.inode, "w")
+    subdir.add_child("leaf", leaf)
+    for i in range(20):
+        subdir.add_child("other{}".format(i), fs.inode_map[fs.allocINode(INodeType.FILE)])
+    # add_child put the names in the dentry cache, so they're found before any flush
+    assert fs.namei("/sub/leaf") is leaf
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    assert fs.namei("/sub/leaf").inode_num == leaf.inode_num
+    assert len(fs.inode_map.live) == 3, "parsing a directory shouldn't make INodes for all its children"
+    assert fs.namei("/sub/missing") is None
+    assert fs.dcache.get(sub.inode_num, "missing") == NEGATIVE, "missing name should be a negative entry"
+    misses = fs.dcache.misses
+    for i in range(10):
+        assert fs.namei("/sub/leaf").inode_num == leaf.inode_num
+        assert fs.open("/sub/missing", "r") is None
+    assert fs.dcache.misses == misses, "hot lookups should all hit the dentry cache"
+    f = fs.open("/sub/leaf", "r")
+    assert f.mode == "r" and fs.open("/sub/leaf", "a") is not f
+    assert fs.open("/sub/leaf/x", "r") is None and fs.open("/sub", "r") is None
+    fs.unmount()
+
+def test_dentry_eviction_before_flush():
+    rd = RAMBlockDevice("nose_fs_dcache_evict", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd)
+    fs.dcache.capacity = 1
+    root = inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+    a = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    b = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    root.add_child("a", a)
+    root.add_child("b", b)
+    # "a" was evicted from the dentry cache before root was written
+    assert fs.namei("/a") is a, "an unflushed name was lost"
+    assert fs.namei("/c") is None
+    fs.flushDirCache()
+    assert fs.namei("/a") is a and fs.namei("/b") is b
+    c = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    root.add_child("c", c)
+    assert fs.namei("/c") is c, "a stale negative entry survived add_child"
+    fs.unmount()
+
+def test_read_views():
+    import hashlib
+    rd = RAMBlockDevice("nose_fs_views", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd)
+    root = inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 199 for i in range(5 * fs.block_size + 17))
+    inode.write(0, data)
+    # a long non-ASCII name, so the directory spans blocks and a character straddles two
+    name = "\u00e9" * fs.block_size
+    root.add_child(name, inode)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    f = fs.open("/" + name, "r")
+    assert f is not None, "directory didn't decode across block boundaries"
+    views = f.readViews(len(data))
+    assert all(isinstance(view, memoryview) for view in views)
+    assert b"".join(views) == data
+    digest = hashlib.sha256()
+    for view in fs.inode_map[inode.inode_num].readViews(100, 3 * fs.block_size):
+        digest.update(view)
+    assert digest.digest() == hashlib.sha256(data[100:100 + 3 * fs.block_size]).digest()
+    fs.unmount()
+
+def test_cache_stats_and_resize():
+    rd = RAMBlockDevice("nose_fs_cachestats", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=64)
+    root = inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 227 for i in range(40 * fs.block_size))
+    inode.write(0, data)
+    root.add_child("big", inode)
+    stats = fs.cacheStats()
+    assert stats["block"]["dirty"] >= 40 and stats["block"]["resident_bytes"] >= 40 * fs.block_size
+    assert stats["dir"]["dirty"] == 1
+    fs.resetCacheStats()
+    assert fs.cacheStats()["block"]["hits"] == 0
+    fs.resizeCache("block", 16)
+    stats = fs.cacheStats()["block"]
+    assert len(fs.blockCache) <= 16 and stats["capacity"] == 16
+    assert stats["evictions"] > 0 and stats["writebacks"] > 0, "shrinking should write back dirty blocks"
+    assert fs.max_readahead <= 4
+    fs.resizeCache("dentry", 1)
+    fs.resizeCache("inode", 8)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    readback = bytearray(len(data))
+    assert fs.namei("/big").read(0, readback) == len(data) and readback == data
+    assert fs.namei("/big") is not None
+    stats = fs.cacheStats()
+    assert stats["dentry"]["hits"] >= 1 and stats["inode"]["hits"] >= 1
+    fs.unmount()
+
+def test_extent_allocation():
+    rd = RAMBlockDevice("nose_fs_extents", 400)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=400)
+    fs = FileSystem.FileSystem.mount(rd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 241 for i in range(100 * fs.block_size))
+    allocs = fs.op_counts["alloc_block"]
+    assert inode.write(0, data) == len(data)
+    addrs = inode.getDiskAddrsOfBlocks(fs, 0, 100)
+    assert addrs == list(range(addrs[0], addrs[0] + 100)), "one write should get one extent"
+    assert fs.op_counts["alloc_block"] - allocs >= 100
+    # writes at an offset, and ones that extend the file, pick up where it left off
+    inode.write(100 * fs.block_size + 10, b'x' * fs.block_size)
+    assert inode.length == 101 * fs.block_size + 10
+    assert inode.getDiskAddrsOfBlocks(fs, 100, 2) == [addrs[-1] + 1, addrs[-1] + 2]
+    inode.write(5, b'hello')
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    readback = bytearray(inode.length)
+    assert fs.inode_map[inode.inode_num].read(0, readback) == len(readback)
+    data[5:10] = b'hello'
+    assert readback[:len(data)] == data and readback[len(data) + 10:] == b'x' * fs.block_size
+    fs.unmount()
+
+def test_extent_inodes():
+    rd = RAMBlockDevice("nose_fs_extent_inodes", 1200)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=1200)
+    fs = FileSystem.FileSystem.mount(rd, extent_inodes=True)
+    root = inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+    big = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    pointers = fs.inode_map[fs.allocINode(INodeType.FILE, extents=False)]
+    data = bytearray(i % 251 for i in range(600 * fs.block_size))
+    big.write(0, data)
+    pointers.write(0, data[:40 * fs.block_size])
+    # a few scattered writes into holes, and a directory that's extent mapped too
+    for i in range(12):
+        big.write((700 + 10 * i) * fs.block_size, b'%d' % i)
+    root.add_child("big", big)
+    assert big.extents and not pointers.extents and not fs.inode_map[fs.root_dir_inode].extents
+    assert big.level == 1 and pointers.level == 1
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    big = fs.namei("/big")
+    assert big.extents and fs.inode_map[pointers.inode_num].level == 1
+    tree = ExtentTree(fs, big)
+    assert tree.extents()[0][2] == 600, "one write should be one extent"
+    readback = bytearray(600 * fs.block_size)
+    assert big.read(0, readback) == len(readback) and readback == data
+    assert big.getDiskAddrOfBlock(fs, 650) == -1, "a hole has no disk address"
+    chunk = bytearray(2)
+    assert big.read(710 * fs.block_size, chunk) == 2 and chunk == b'1\0'
+    readback = bytearray(40 * fs.block_size)
+    assert fs.inode_map[pointers.inode_num].read(0, readback) == len(readback)
+    assert readback == data[:len(readback)]
+    free = fs.block_map.free_count
+    big.truncate(100 * fs.block_size)
+    assert tree.extents() == [(0, tree.extents()[0][1], 100)] and big.level == 0
+    assert fs.block_map.free_count == free + 500 + 12 + 1, "data and tree blocks should be freed"
+    fs.unmount()
+
+def test_buddy_allocator_mount():
+    rd = RAMBlockDevice("nose_fs_buddy", 1500)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=1500)
+    fs = FileSystem.FileSystem.mount(rd, allocator="buddy")
+    assert isinstance(fs.allocator, BuddyAllocator)
+    inodes = []
+    for i in range(10):
+        inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+        inode.write(0, bytearray([i]) * (20 * fs.block_size))
+        inodes.append(inode)
+    for inode in inodes[::2]:
+        inode.truncate(0)
+    frag = fs.fragmentation()
+    assert frag["free_blocks"] == fs.block_map.free_count and frag["free_runs"] > 1
+    assert sum(count << order for order, count in enumerate(frag["buddy_free_by_order"])) == frag["free_blocks"]
+    assert 0 < frag["index"] < 1 and "fragmentation index" in fs.fragmentationAsString()
+    big = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    big.write(0, bytearray(b'B' * (256 * fs.block_size)))
+    addrs = big.getDiskAddrsOfBlocks(fs, 0, 256)
+    assert addrs == list(range(addrs[0], addrs[0] + 256)) and addrs[0] % 256 == 0
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    assert fs.allocator is fs.block_map
+    readback = bytearray(20 * fs.block_size)
+    assert fs.inode_map[inodes[3].inode_num].read(0, readback) == len(readback)
+    assert readback == bytearray([3]) * len(readback)
+    fs.unmount()
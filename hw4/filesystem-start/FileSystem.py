@@ -1,27 +1,47 @@
+import threading
 from BlockDevice import *
-import numpy as np
-from INode import INodeType, INode, BlockPointerFormat
+from IOScheduler import IOScheduler
+from DentryCache import DentryCache, NEGATIVE
+from BlockMap import BlockMap, CHUNK_BYTES
+from BuddyAllocator import BuddyAllocator
+from INodeMap import INodeMap, DEFAULT_INODE_CACHE
+from Flusher import Flusher, DEFAULT_DIRTY_BACKGROUND_RATIO, DEFAULT_DIRTY_RATIO
+from BlockCache import BlockCache, DEFAULT_CACHE_BLOCKS, FLUSH_BATCH_BLOCKS
+from INode import INodeType, INode, BlockPointerFormat, pointerView, pointerBytes
 from struct import Struct
 import File
 
 
 MAGIC_NUMBER = 0xF00DCAFE   # change me, but make it
 INODE_COUNT = 1024
+DEFAULT_MAX_READAHEAD = 64  # blocks; see File.ReadAhead
+# the disk is split into block groups for locality (see allocINode); a group
+# is one BlockMap chunk, so the BlockMap already keeps each group's free count
+BLOCK_GROUP_BLOCKS = CHUNK_BYTES * 8
 
-class BlockCache():
-    def __init__(self, size):
-        self.cache = [None]*size
-        self.dirty = [False]*size
 
-    def put(self, num_block, data):
-        self.cache[num_block] = data
-        self.dirty[num_block] = True
+class FSLock():
+    """ FileSystem.lock: a re-entrant lock that knows whether the calling
+        thread holds it, so throttle can tell a writer that mustn't wait
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.owned = threading.local()  # .depth: how many times this thread holds it
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.owned.depth = getattr(self.owned, "depth", 0) + 1
+        return self
 
-    def get(self, num_block):
-        return self.cache[num_block]
+    def __exit__(self, *exc_info):
+        self.owned.depth -= 1
+        self.lock.release()
+
+    def held(self):
+        """ True if the calling thread holds the lock """
+        return getattr(self.owned, "depth", 0) > 0
 
-    def isDirty(self, num_block):
-        return self.dirty[num_block]
 
 class FileSystem():
     """ A File System lives on a block device. The root block, at a
@@ -34,6 +54,9 @@ class FileSystem():
         and structures (the directory cache - assignment 3)
     """
 
+    OPS = ("open", "namei", "read", "read_bytes", "write", "write_bytes",
+           "alloc_block", "free_block", "alloc_inode", "free_inode")
+
     def __init__(self, bd:BlockDevice):
         self.block_device = bd
         self.block_size = bd.block_size
@@ -44,9 +67,25 @@ class FileSystem():
         self.inode_count = INODE_COUNT
         self.inode_map = None
         self.block_map = None
+        self.allocator = None   # block_map itself, or an index over it (see mount)
         self.dirty = 0
         self.blockCache = None
-        self.dirCache = None
+        self.dirCache = None    # inode number -> Directory with changes not written yet
+        self.dcache = DentryCache()
+        # the background flusher (if any) and our operations take turns through this
+        self.lock = FSLock()
+        self.flusher = None
+        self.unsynced = False   # blocks were written back since the last device sync
+        self.max_readahead = 0
+        self.extent_inodes = False  # whether allocINode makes extent-mapped INodes by default
+        self.locality = False       # goal-directed allocation (see allocINode and INode.allocGoal)
+        self.dir_flushes = 0    # directories written out by flushDirCache
+        # what's on disk for the block map, by start block, so writing it
+        # back only has to write the blocks that changed (INodeMap does the
+        # same for the inode table)
+        self.on_disk = {}
+        # file-system level operation counts (the device keeps its own, see iostat)
+        self.op_counts = dict.fromkeys(FileSystem.OPS, 0)
 
     # TODO: part of Assignment 4:
     def open(self, path, mode):
@@ -59,26 +98,12 @@ class FileSystem():
         :param mode:   "r", "w", or "a"
         :return:       File object, or None if there is no such file (or it's a directory)
         """
-        path_contents = path.split("/")
-        if path[0] == "/":
-            path_contents = path_contents[1:]
-        if path[-1] == "/":
-            path_contents = path_contents[:-1]
-
-        cwd = File.inode_to_object(self, self.inode_map[self.root_dir_inode], None, "w")
-        for i in range(len(path_contents)):
-            fname = path_contents[i]
-            try:
-                cwd.ensure_cached()
-                # for name in cwd.children:
-                #     print(name, cwd.children[name].mode)
-                cwd = cwd.get_children()[fname]
-            except KeyError:
-                return None
-        
-        if cwd.inode.isDirectory():
+        self.op_counts["open"] += 1
+        parent, inode = self.lookup(path)
+        if inode is None or inode.isDirectory():
             return None
-        return cwd
+        # each open gets its own File, with its own offset, mode and read-ahead
+        return File.File(self, parent, inode, mode)
 
     # TODO: part of Assignment 4:
     def namei(self, path):
@@ -87,49 +112,69 @@ class FileSystem():
         :param path: path of a file or directory
         :return: INode structure
         """
-        ret = None
-        # start cwd <- root_dir,
-        # iterate through elements of path,
-        # finding a child of the current directory whose name matches, updating cwd as you go
-        path_contents = path.split("/")
-        if path[0] == "/":
-            path_contents = path_contents[1:]
-        if path[-1] == "/":
-            path_contents = path_contents[:-1]
-        
-        cwd = File.inode_to_object(self, self.inode_map[self.root_dir_inode], None, "r")
-        cwd.ensure_cached()
-        for i in range(len(path_contents)):
-            fname = path_contents[i]
-            try:
-                cwd = cwd.get_children()[fname]
-            except KeyError:
-                return None
-        
-        if cwd != None:
-            ret = cwd.inode
-        return ret
+        self.op_counts["namei"] += 1
+        return self.lookup(path)[1]
+
+    def lookup(self, path):
+        """
+        Walk path from the root directory, one dentry cache lookup per path
+        component. Only a directory we don't know the name from gets parsed,
+        and then all of its names go in the cache.
+        :param path: path of a file or directory
+        :return:     (parent directory INode, INode), or (None, None) if there's no such path
+        """
+        path_contents = [fname for fname in path.split("/") if fname != ""]
+        with self.lock:
+            parent = None
+            cwd = self.inode_map[self.root_dir_inode]
+            for fname in path_contents:
+                if not cwd.isDirectory():
+                    return None, None
+                inode_num = self.dcache.get(cwd.inode_num, fname)
+                if inode_num is None:
+                    # a directory with changes that aren't written yet has to
+                    # answer for itself: its blocks are out of date
+                    pending = self.dirCache.get(cwd.inode_num)
+                    if pending is not None:
+                        names = {name: child.inode.inode_num for name, child in pending.get_children().items()}
+                    else:
+                        # just the numbers: the children's INodes are made as they're
+                        # walked into, but their table blocks are read in now, together
+                        names = File.Directory.entries(cwd)
+                        self.inode_map.prefetch(names.values())
+                    self.dcache.fill(cwd.inode_num, names)
+                    # (answer from names: a small cache may not hold on to them all)
+                    inode_num = names.get(fname, NEGATIVE)
+                    if inode_num == NEGATIVE:
+                        self.dcache.put(cwd.inode_num, fname, NEGATIVE)
+                if inode_num == NEGATIVE:
+                    return None, None
+                parent = cwd
+                cwd = self.inode_map[inode_num]
+            return parent, cwd
 
     @staticmethod
     def createFileSystem(filename, block_count, block_size = default_blocksize):
         """
         createFileSystem - creates a newly initialized file system (doesn't mount it)
-        :param filename:        block device name
+        :param filename:        block device name, or an already created BlockDevice
+                                (e.g. a StripedBlockDevice) to build the file system on
         :param block_count:     block device size
-        :param block_size:      block size
+        :param block_size:      block size (ignored if filename is a BlockDevice)
         :return:                0 upon success
         """
 
         # create a FileSystem object, including block map, inode map, so that we can
         # call the same write functions as unmount to initialize it on disk.
-        bd = BlockDevice(filename, blockCount=block_count, blockSize=block_size, create=True)
+        if isinstance(filename, BlockDevice):
+            bd = filename
+            assert block_count <= bd.num_blocks, "createFileSystem bigger than its device"
+            block_size = bd.block_size
+        else:
+            bd = BlockDevice(filename, blockCount=block_count, blockSize=block_size, create=True)
         fs = FileSystem(bd)
 
-        fs.block_map = [False] * block_count # will fix this later in this function
-
-        fs.inode_map = []
-        for i in range(INODE_COUNT):
-            fs.inode_map.append(INode(fs, number=i))
+        fs.block_map = BlockMap(block_count) # will fix this later in this function
 
         bytes_in_block_map = ceildiv(block_count, 8)
         blocks_in_block_map = ceildiv(bytes_in_block_map, block_size)
@@ -144,6 +189,9 @@ class FileSystem():
 
         for i in range(preallocated_blocks):
             fs.block_map[i] = True
+        fs.allocator = fs.block_map
+
+        fs.inode_map = INodeMap(fs, INODE_COUNT, create=True)
 
         # create our root directory
         fs.root_dir_inode = fs.allocINode(INodeType.DIRECTORY)
@@ -167,14 +215,37 @@ class FileSystem():
     MasterBlockFormat = Struct("<IIHHIIIB")
 
     @staticmethod
-    def mount(name):
+    def mount(name, use_mmap=False, cache_blocks=DEFAULT_CACHE_BLOCKS, cache_bytes=None,
+              cache_policy="lru", max_readahead=DEFAULT_MAX_READAHEAD, inode_cache=DEFAULT_INODE_CACHE,
+              extent_inodes=False, allocator="bitmap", locality=False, writeback_interval=None,
+              dirty_background_ratio=DEFAULT_DIRTY_BACKGROUND_RATIO, dirty_ratio=DEFAULT_DIRTY_RATIO):
         """
         Factory method - mounts device file, reads master block, returns FileSystem object
-        :param name: name of device
+        :param name:         name of device, or an already open BlockDevice (e.g. a StripedBlockDevice)
+        :param use_mmap:     memory-map the device (see BlockDevice)
+        :param cache_blocks: block cache capacity, in blocks
+        :param cache_bytes:  block cache capacity in bytes - overrides cache_blocks if given
+        :param cache_policy: block cache replacement policy, "lru" or the scan resistant "2q"
+        :param max_readahead: biggest read-ahead window, in blocks (0 turns read-ahead off)
+        :param inode_cache:   how many INodes to keep unpacked in memory (see INodeMap)
+        :param extent_inodes: make new INodes extent mapped (see ExtentTree); INodes that
+                              already exist keep whichever block map they have
+        :param allocator:     block allocator: "bitmap" (first fit, from the block map) or
+                              "buddy" (a BuddyAllocator, for fast big allocations)
+        :param locality:      keep each INode's blocks together, and each directory's files
+                              in a block group of their own (False: lowest free block first)
+        :param writeback_interval:     if given, start a background Flusher that writes dirty
+                                       state back every this many seconds
+        :param dirty_background_ratio: dirty share of the block cache that wakes the flusher early
+        :param dirty_ratio:            dirty share of the block cache at which writers are throttled
         :return: FileSystem object or None if invalid file system
         """
-        bd = BlockDevice(name)
-        ret = FileSystem(bd)
+        if isinstance(name, BlockDevice):
+            bd = name
+        else:
+            bd = BlockDevice(name, use_mmap=use_mmap)
+        # all of our I/O goes through the elevator, which sorts and merges writes
+        ret = FileSystem(IOScheduler(bd))
         ret.readMasterBlock()
 
         if ret.magic_number != MAGIC_NUMBER:
@@ -188,12 +259,23 @@ class FileSystem():
             print("Warning: mounting a file system that was not cleanly unmounted")
 
         ret.readBlockMap()
-        ret.readINodeMap()
+        assert allocator in ("bitmap", "buddy"), "unknown allocator {}".format(allocator)
+        ret.allocator = ret.block_map if allocator == "bitmap" else BuddyAllocator(ret.block_map)
+        ret.readINodeMap(inode_cache)
 
         ret.dirty = 1
         ret.writeMasterBlock() # set the dirty bit on disk
-        ret.blockCache = BlockCache(bd.num_blocks)
-        ret.dirCache = []
+        ret.block_device.sync()
+        if cache_bytes is not None:
+            cache_blocks = cache_bytes // bd.block_size
+        ret.blockCache = BlockCache(cache_blocks, ret.writeCachedBlock, cache_policy)
+        ret.dirCache = {}
+        # a read-ahead window mustn't be able to push itself out of the cache
+        ret.max_readahead = min(max_readahead, ret.blockCache.capacity // 4)
+        ret.extent_inodes = extent_inodes
+        ret.locality = locality
+        if writeback_interval is not None:
+            ret.flusher = Flusher(ret, writeback_interval, dirty_background_ratio, dirty_ratio)
         return ret
 
     # writeMasterBlock / readMasterBlock use the struct package to get the FileSystem object's
@@ -206,9 +288,7 @@ class FileSystem():
         self.block_device.write_block(0, ba, pad = True)
 
     def readMasterBlock(self):
-        bd = self.block_device
-        master_block_bytes = bytearray(bd.block_size)
-        bd.read_block(0, master_block_bytes)
+        master_block_bytes = self.block_device.view_block(0)
         (self.magic_number, self.block_count, self.block_size, self.inode_count,
          self.block_map_loc, self.inode_map_loc, self.root_dir_inode, self.dirty) = \
             FileSystem.MasterBlockFormat.unpack(master_block_bytes[0:FileSystem.MasterBlockFormat.size])
@@ -218,21 +298,52 @@ class FileSystem():
         Unmount - write block map, inode map, caches, then master block indicating a clean unmount
         :return: True on success
         """
-        self.flushDirCache()
-        self.writeBlockMap()
-        self.writeINodeMap()
-        self.flushBlockCache()
-        # When we have a directory cache and a file cache, flush them here:
-        # TODO: flush file and directory caches
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+        self.max_readahead = 0
+        # everything else must be on disk before the clean bit is:
+        self.writeback()
         # clear dirty bit, then write clean master block to disk:
         self.dirty = 0
         self.writeMasterBlock()
         self.block_device.close()
         return True
 
+    def writeback(self):
+        """
+        Write all dirty state - directories, block map, inode table and block
+        cache - to the device, and wait for it to get there. The file system
+        stays mounted (and marked dirty on disk). If nothing changed since the
+        last writeback, the device isn't touched at all.
+        """
+        with self.lock:
+            written = len(self.dirCache) + len(self.blockCache.dirty)
+            self.flushDirCache()
+            written += self.writeBlockMap()
+            written += self.writeINodeMap()
+            self.flushBlockCache()
+            # an idle file system leaves the device alone: a sync isn't always
+            # free (CompressedBlockDevice saves its whole index)
+            if written > 0 or self.unsynced:
+                self.block_device.sync()
+            self.unsynced = False
+
+    def throttle(self):
+        """ Writers call this before dirtying blocks. A caller that holds
+            self.lock isn't held back: the flusher needs the lock to catch up.
+        """
+        if self.flusher is not None:
+            self.flusher.dirtied(wait=not self.lock.held())
+
     def flushDirCache(self):
-        for d in self.dirCache:
+        dirty = self.dirCache
+        self.dirCache = {}
+        for inode_num, d in dirty.items():
             d.sync()
+            # what's on disk now is current, so "not in there" answers may be stale
+            self.dcache.dropNegatives(inode_num)
+        self.dir_flushes += len(dirty)
 
     """
     Block Cache functions:
@@ -240,19 +351,34 @@ class FileSystem():
     readBlockCache - reads a block of block pointers
     """
     def flushBlockCache(self):
-        buf = bytearray(self.block_device.block_size)
-        # todo: check whether the buffer is a bytearray or an array of ints
-        for i in range(self.block_device.num_blocks):
-            if self.blockCache.isDirty(i):
-                offset = 0
-                cached_block = self.blockCache.get(i)
-                if isinstance(cached_block, bytearray):
-                    self.block_device.write_block(i, cached_block)
-                else:
-                    for bptr in cached_block:
-                        BlockPointerFormat.pack_into(buf, offset, bptr)
-                        offset += BlockPointerFormat.size
-                    self.block_device.write_block(i, buf)
+        # only the dirty blocks are written, in block order and in batches of
+        # FLUSH_BATCH_BLOCKS; each run of consecutive blocks in a batch goes to
+        # the device as one vectored write. Afterwards the blocks are clean,
+        # so flushing again only writes what changed since.
+        dirty = self.blockCache.dirtyBlocks()
+        for batch_start in range(0, len(dirty), FLUSH_BATCH_BLOCKS):
+            batch = dirty[batch_start:batch_start + FLUSH_BATCH_BLOCKS]
+            run_start = batch[0]
+            run = []
+            for i in batch:
+                if run_start + len(run) != i:
+                    self.block_device.writev_blocks(run_start, run)
+                    run_start = i
+                    run = []
+                run.append(self.cachedBlockBytes(self.blockCache.peek(i)))
+            self.block_device.writev_blocks(run_start, run)
+            for i in batch:
+                self.blockCache.markClean(i)
+
+    def cachedBlockBytes(self, cached_block):
+        """ The on-disk bytes of a cached block - pointer blocks are views over theirs """
+        view = memoryview(cached_block)
+        return pointerBytes(view) if view.format == 'I' else view
+
+    def writeCachedBlock(self, block_num, cached_block):
+        """ Write back a dirty block the cache is evicting """
+        self.unsynced = True
+        self.block_device.write_block(block_num, self.cachedBlockBytes(cached_block))
 
     # Assignment 4: important note:
     # This is the cache-helper for INode.getDiskAddressOfBlock
@@ -261,69 +387,113 @@ class FileSystem():
     # to this one for handling the bytearray contents of INodes as a helper for
     # Inode.read and write
 
-    def readBlockCache(self, index, blocks, alloc_p = True):
-        block_ptrs_per_block = self.block_device.block_size // 4
+    def readBlockCache(self, index, blocks, alloc_p = True, blocks_addr = 0, goal = 0):
+        """
+        Get the block of block pointers that blocks[index] points to
+        :param index:       which entry of blocks
+        :param blocks:      a block pointer array (the INode's, or a cached pointer block)
+        :param alloc_p:     if there's no block there yet, do we allocate one?
+        :param blocks_addr: disk address of blocks, or 0 if it's the INode's own array.
+                            Needed so that allocating can mark blocks dirty.
+        :param goal:        where to allocate a new block, if we can (see allocBlock)
+        :return:            pointer view (see INode.pointerView) of the block pointers, or None
+        """
         if blocks[index] == 0:
             if alloc_p:
-                block_num = self.allocBlock()
+                block_num = self.allocBlock(goal)
                 blocks[index] = block_num
-                self.blockCache.put([0] * block_ptrs_per_block, block_num)
-                return self.blockCache.get(block_num)
+                if blocks_addr != 0:
+                    self.blockCache.put(blocks_addr, blocks, meta=True)
+                new_blocks = pointerView(bytearray(self.block_device.block_size))
+                self.blockCache.put(block_num, new_blocks, meta=True)
+                return new_blocks
             else:
                 # if it's not
                 return None
         block_num = blocks[index]
-        if self.blockCache.get(block_num) == None:
-            buf = bytearray(self.block_device.block_size)
-            self.block_device.read_block(block_num, buf)
-            ptrs = [0] * block_ptrs_per_block
-            for i in range(block_ptrs_per_block):
-                (ptrs[i],) = BlockPointerFormat.unpack_from(buf, i * 4)
-            self.blockCache.put(block_num, ptrs)
-        return self.blockCache.get(block_num)
+        ptrs = self.blockCache.get(block_num)
+        if ptrs is None:
+            # one copy out of the device, and the cache owns it
+            ptrs = pointerView(bytearray(self.block_device.view_block(block_num)))
+            self.blockCache.load(block_num, ptrs, meta=True)
+        return ptrs
 
     """
     BlockMap functions:
     The BlockMap is how we keep track of allocated and free blocks.
     On-disk, it's a contiguous set of blocks storing the sequence of bits
     0 -> free, 1 -> allocated.
-    In memory it's a Python array of booleans, False -> free, True -> allocated
+    In memory it's the same bits, packed in a BlockMap (see BlockMap.py).
+    Blocks are allocated and freed through self.allocator: the BlockMap
+    itself, or a BuddyAllocator that indexes its free space by size.
     """
     #
     # allocBlock and freeBlock allocate and free block if the file system has
     # been mounted.
     #
-    def allocBlock(self):
-        for i in range(len(self.block_map)):
-            if self.block_map[i] == False:
-                self.block_map[i] = True
-                return i
-        print("There are no free blocks available for allocation")
-        return -1
+    def allocBlock(self, goal=0):
+        """
+        :param goal: the block we'd like, if it's free - else the next free one after it
+                     (the buddy allocator has no use for goals)
+        :return:     the block allocated, or -1 if there are no free blocks
+        """
+        self.op_counts["alloc_block"] += 1
+        n = self.allocator.alloc(goal % len(self.block_map))
+        if n < 0:
+            print("There are no free blocks available for allocation")
+        return n
+
+    def allocExtent(self, min_len, max_len, hint=0):
+        """
+        Allocate a run of contiguous blocks, so a file written in one go
+        lands in one place on the device
+        :param min_len: the shortest run that will do
+        :param max_len: the most blocks wanted
+        :param hint:    where to start looking (e.g. just past the file's last block)
+        :return:        (first block, number of blocks), or (-1, 0) if there's no run of min_len
+        """
+        start, length = self.allocator.allocRun(min_len, max_len, hint % len(self.block_map))
+        if start < 0:
+            print("There are no {} contiguous free blocks available for allocation".format(min_len))
+        self.op_counts["alloc_block"] += length
+        return start, length
 
     def freeBlock(self, n:int):
-        if self.block_map[n] == False:
-            print("Warning: attempt to free an already unallocated block {}".format(n))
-        self.block_map[n] = False
+        self.freeBlocks([n])
+
+    def freeBlocks(self, block_nums):
+        """
+        Free a batch of blocks. Freed blocks are dropped from the block cache
+        and discarded on the device (so a sparse image gives the space back),
+        one discard per run of consecutive block numbers.
+        :param block_nums: the blocks to free, in any order
+        """
+        runs = []   # [start, length] of each run of consecutive blocks
+        self.op_counts["free_block"] += len(block_nums)
+        for n in sorted(block_nums):
+            if self.block_map[n] == False or (len(runs) > 0 and n < runs[-1][0] + runs[-1][1]):
+                print("Warning: attempt to free an already unallocated block {}".format(n))
+                continue
+            if self.blockCache is not None:
+                self.blockCache.discard(n)
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == n:
+                runs[-1][1] += 1
+            else:
+                runs.append([n, 1])
+        for run_start, run_len in runs:
+            self.allocator.freeRun(run_start, run_len)
+            self.block_device.discard(run_start, run_len)
 
     # Internal read/write functions for mount/unmount
     def writeBlockMap(self):
         """
-        flush the current block map to disk
+        flush the current block map to disk (only the blocks that changed)
         :return: the number of blocks written
         """
-        blockmap_buffer = bytearray(self.block_size)
-
-        # Split block map into block-sized chunks
-        blockmapchunks = split_array(self.block_map, self.block_size * 8)
-
-        # iterate through each chunk, turning it into a bytearray, and writing it
-        for i in range(len(blockmapchunks)):
-            buffer = bytearray(self.block_size)
-            bitsAsBytes = bytearray(np.packbits(blockmapchunks[i]))
-            buffer[0:len(bitsAsBytes)] = bitsAsBytes
-            self.block_device.write_block(self.block_map_loc + i, buffer)
-        return len(blockmapchunks)
+        blocks_in_block_map = ceildiv(ceildiv(len(self.block_map), 8), self.block_size)
+        # the map is already packed the way it's laid out on disk
+        blockmap_buffer = self.block_map.image(self.block_size * blocks_in_block_map)
+        return self.writeChangedBlocks(self.block_map_loc, blockmap_buffer)
 
     def readBlockMap(self):
         """
@@ -331,17 +501,83 @@ class FileSystem():
         Assumes that self contains the metadata from the master block
         :return: side-effect that self has a populated block map
         """
-        blockmap_buffer = bytearray(self.block_size)
-        self.block_map = [False] * self.block_count
+        blockmap_buffer = self.block_device.view_blocks(self.block_map_loc,
+                                                        self.inode_map_loc - self.block_map_loc)
+        self.on_disk[self.block_map_loc] = bytes(blockmap_buffer)
+        self.block_map = BlockMap(self.block_count, blockmap_buffer)
 
-        bitOffset = 0
-        bitsPerBlock = self.block_size * 8
+    """
+    Instrumentation:
+    the FileSystem counts its own operations, the IOScheduler (if any) counts
+    queueing and merging, and the BlockDevice underneath counts requests,
+    bytes, seeks and latencies.
+    """
+    def ioStats(self):
+        """
+        :return: dict with "fs", "scheduler" (if we have one) and "device" statistics
+        """
+        ret = {"fs": dict(self.op_counts)}
+        if hasattr(self.block_device, "stats"):
+            ret["scheduler"] = self.block_device.stats()
+        if self.flusher is not None:
+            ret["flusher"] = self.flusher.stats()
+        ret["device"] = self.block_device.iostats.snapshot()
+        return ret
+
+    def resetIOStats(self):
+        self.op_counts = dict.fromkeys(FileSystem.OPS, 0)
+        self.block_device.iostats.reset()
 
-        for diskBlock in range(self.block_map_loc, self.inode_map_loc):
-            self.block_device.read_block(diskBlock, blockmap_buffer)
-            blockmap_bits = np.unpackbits(blockmap_buffer)
-            self.block_map[bitOffset:bitOffset+bitsPerBlock] = blockmap_bits
-            bitOffset += bitsPerBlock
+    def ioStatsAsString(self):
+        resultstring = " ".join("{} {}".format(op, n) for op, n in self.op_counts.items())
+        if hasattr(self.block_device, "statsAsString"):
+            resultstring += "\n" + self.block_device.statsAsString()
+        return resultstring + "\n" + self.block_device.iostats.asString()
+
+    """
+    Cache statistics and sizing:
+    every cache counts its hits, misses and evictions, so they can be sized
+    from real hit rates, and any of them can be resized on a live mount.
+    """
+    def cacheStats(self):
+        """
+        :return: dict of "block", "dentry", "inode" and "dir" cache statistics
+        """
+        with self.lock:
+            return {"block": self.blockCache.stats(),
+                    "dentry": self.dcache.stats(),
+                    "inode": self.inode_map.stats(),
+                    "dir": {"dirty": len(self.dirCache),
+                            "writebacks": self.dir_flushes}}
+
+    def resetCacheStats(self):
+        with self.lock:
+            self.blockCache.resetStats()
+            self.dcache.resetStats()
+            self.inode_map.resetStats()
+            self.dir_flushes = 0
+
+    def resizeCache(self, cache, capacity):
+        """
+        Change a cache's capacity on the mounted file system. Shrinking evicts
+        right away (the block cache writes back dirty blocks as it goes).
+        :param cache:    "block" (in blocks), "dentry" (in entries) or "inode" (in INodes)
+        :param capacity: the new capacity
+        """
+        caches = {"block": self.blockCache, "dentry": self.dcache, "inode": self.inode_map}
+        assert cache in caches, "unknown cache {}".format(cache)
+        with self.lock:
+            caches[cache].resize(capacity)
+            if cache == "block":
+                self.max_readahead = min(self.max_readahead, self.blockCache.capacity // 4)
+
+    def cacheStatsAsString(self):
+        lines = []
+        for name, stats in self.cacheStats().items():
+            lines.append("{}: ".format(name) + ", ".join(
+                "{} {:.1%}".format(key, value) if key == "hit_rate" else "{} {}".format(key, value)
+                for key, value in stats.items()))
+        return "\n".join(lines)
 
     def blockMapAsString(self):
         resultstring = ""
@@ -356,6 +592,42 @@ class FileSystem():
                 resultstring += "0"
         return resultstring
 
+    def fragmentation(self):
+        """
+        How broken up the free space is
+        :return: dict of free block and free run counts, the longest run,
+                 a histogram of run lengths (by power of 2: 4 counts the runs of 4-7 blocks),
+                 and the fragmentation index, 1 - longest run / free blocks
+                 (0 is all in one piece, near 1 is all scattered)
+        """
+        runs = 0
+        longest = 0
+        histogram = {}
+        for start, length in self.block_map.freeRuns():
+            runs += 1
+            longest = max(longest, length)
+            bucket = 1 << (length.bit_length() - 1)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        free = self.block_map.free_count
+        ret = {"free_blocks": free, "free_runs": runs, "longest_run": longest,
+               "mean_run": free / runs if runs > 0 else 0.0,
+               "index": 1 - longest / free if free > 0 else 0.0,
+               "histogram": dict(sorted(histogram.items()))}
+        if isinstance(self.allocator, BuddyAllocator):
+            ret["buddy_free_by_order"] = self.allocator.freeByOrder()
+        return ret
+
+    def fragmentationAsString(self):
+        frag = self.fragmentation()
+        ret = "{} free blocks in {} runs, longest {}, mean {:.1f}, fragmentation index {:.2f}\n".format(
+            frag["free_blocks"], frag["free_runs"], frag["longest_run"], frag["mean_run"], frag["index"])
+        ret += "free runs by length: " + ", ".join(
+            "{}-{}: {}".format(bucket, 2 * bucket - 1, count) for bucket, count in frag["histogram"].items())
+        if "buddy_free_by_order" in frag:
+            ret += "\nfree buddy blocks by order: " + ", ".join(
+                "{}: {}".format(order, count) for order, count in enumerate(frag["buddy_free_by_order"]) if count > 0)
+        return ret
+
     """
     INodeMap functions:
     The INodeMap is an array of all of the inodes in this file system. It's also how
@@ -367,47 +639,115 @@ class FileSystem():
     # allocINode and freeINode both work like alloc and free block
     #
 
-    def allocINode(self, inode_type:INodeType):
-        for i in range(len(self.inode_map)):
-            if self.inode_map[i].flags == INodeType.FREE:
-                self.inode_map[i].flags = inode_type
-                return i
+    def allocINode(self, inode_type:INodeType, extents=None, parent=None):
+        """
+        With locality on, INodes are allocated by block group: the inode
+        table is split into as many ranges as there are block groups, and
+        an INode's data goes in the block group of its range (see
+        INode.allocGoal). A new directory goes in a group that has at least
+        the average number of free blocks and the fewest directories, so
+        directories spread out over the disk; anything else goes in its
+        parent directory's group, next to its siblings.
+        :param inode_type: what the new INode is
+        :param extents:    map its blocks with an ExtentTree instead of block pointers
+                           (None: whatever the file system was mounted with)
+        :param parent:     inode number of the directory it's going in, if known
+        :return:           the new INode's number, or -1 if there are none left
+        """
+        self.op_counts["alloc_inode"] += 1
+        if extents is None:
+            extents = self.extent_inodes
+        with self.lock:
+            first = 0
+            if self.locality and inode_type == INodeType.DIRECTORY:
+                first = self.inodeRange(self.directoryGroup())[0]
+            elif self.locality and parent is not None:
+                first = self.inodeRange(self.blockGroup(parent))[0]
+            for j in range(len(self.inode_map)):
+                i = (first + j) % len(self.inode_map)
+                if self.inode_map.flags(i) == INodeType.FREE:
+                    inode = self.inode_map[i]
+                    inode.flags = inode_type
+                    if inode.extents != extents:
+                        # a block map of the other flavour would be garbage
+                        inode.extents = extents
+                        inode.block_ptrs = [0] * INode.BlockPtrsPerInode
+                        inode.level = 0
+                    return i
         # if we made it this far, all of the inodes are allocated
         print("ERROR: there are no inodes available for allocation")
         return -1
 
+    def numBlockGroups(self):
+        return len(self.block_map.chunk_free)
+
+    def inodeRange(self, group):
+        """ :return: (first, last + 1) inode numbers of block group <group> """
+        groups = self.numBlockGroups()
+        return group * len(self.inode_map) // groups, (group + 1) * len(self.inode_map) // groups
+
+    def blockGroup(self, inode_num):
+        """ :return: the block group inode <inode_num>'s data goes in """
+        return inode_num * self.numBlockGroups() // len(self.inode_map)
+
+    def directoryGroup(self):
+        """ The block group for a new directory (see allocINode) """
+        free = self.block_map.chunk_free
+        average = sum(free) / len(free)
+        best = None
+        for group in range(len(free)):
+            if free[group] < average:
+                continue
+            first, last = self.inodeRange(group)
+            dirs = sum(1 for i in range(first, last) if self.inode_map.flags(i) == INodeType.DIRECTORY)
+            if best is None or (dirs, -free[group]) < best[0]:
+                best = ((dirs, -free[group]), group)
+        return best[1]
+
     def freeINode(self, n:int):
+        self.op_counts["free_inode"] += 1
         # todo: throw an error if the user tries to free a reserved block
-        self.inode_map[n].flags = INodeType.FREE
+        with self.lock:
+            self.inode_map[n].flags = INodeType.FREE
 
     # Internal read/write functions for mount/unmount
     def writeINodeMap(self):
-        inode_buffer = bytearray(self.block_size)
-        blocks_in_inode_map = ceildiv(INode.bytesPerINode() * INODE_COUNT, self.block_size)
-        inodes_per_block = self.block_size // INode.bytesPerINode()
-        inode_index = 0
-        for i in range(blocks_in_inode_map):
-            for j in range (inodes_per_block):
-                self.inode_map[inode_index].packIntoBuffer(inode_buffer, j * INode.bytesPerINode())
-                inode_index = inode_index + 1
-            self.block_device.write_block(self.inode_map_loc + i, inode_buffer)
-
-    def readINodeMap(self):
-        blocks_in_inode_map = ceildiv(INode.bytesPerINode() * INODE_COUNT, self.block_size)
-        inode_buffer = bytearray(self.block_size)
-        inodes_per_block = self.block_size // INode.bytesPerINode()
-
-        inode_index = 0
-        self.inode_map = [None] * INODE_COUNT
-        for i in range(blocks_in_inode_map):
-            self.block_device.read_block(self.inode_map_loc + i, inode_buffer)
-            for j in range(inodes_per_block):
-                t = INode(self)
-                start = j * INode.bytesPerINode()
-                end = start + INode.bytesPerINode()
-                t.unpackFromBuffer(inode_buffer[start:end])
-                self.inode_map[inode_index] = t
-                inode_index = inode_index + 1
+        """
+        flush the inode table to disk (only the blocks that changed)
+        :return: the number of blocks written
+        """
+        return self.inode_map.writeBack()
+
+    def readINodeMap(self, cache_size=DEFAULT_INODE_CACHE):
+        # nothing is read yet: the table blocks come in as their inodes are used
+        self.inode_map = INodeMap(self, INODE_COUNT, capacity=cache_size)
+
+    def writeChangedBlocks(self, start, image):
+        """
+        Write image (the block map) to the device at block
+        <start>, skipping the blocks that already hold the same bytes on disk
+        :return: the number of blocks written
+        """
+        old = self.on_disk.get(start)
+        view = memoryview(image)
+        bs = self.block_size
+        num_blocks = len(image) // bs
+        written = 0
+        i = 0
+        while i < num_blocks:
+            run_len = 0
+            while (i + run_len < num_blocks
+                   and (old is None or view[(i + run_len) * bs:(i + run_len + 1) * bs]
+                        != old[(i + run_len) * bs:(i + run_len + 1) * bs])):
+                run_len += 1
+            if run_len > 0:
+                self.block_device.write_blocks(start + i, view[i * bs:(i + run_len) * bs])
+                written += run_len
+                i += run_len
+            else:
+                i += 1
+        self.on_disk[start] = bytes(image)
+        return written
 
     def inodeMapAsString(self):
         resultstring = ""
@@ -416,7 +756,7 @@ class FileSystem():
                 resultstring += "|"
             if i % 64 == 0 and i != 0:
                 resultstring += "\n"
-            resultstring += self.inode_map[i].charRep()
+            resultstring += INode.flagsChar(self.inode_map.flags(i))
         return resultstring
 
 ########## end of FileSystem definition
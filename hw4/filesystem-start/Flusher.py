@@ -0,0 +1,177 @@
+import threading
+
+DEFAULT_WRITEBACK_INTERVAL = 5.0       # seconds between periodic writebacks
+DEFAULT_DIRTY_BACKGROUND_RATIO = 0.1   # wake the flusher early past this share of dirty cache
+DEFAULT_DIRTY_RATIO = 0.4              # writers wait for the flusher past this share
+
+
+class Flusher():
+    """ A background thread that writes a mounted FileSystem's dirty state
+        (dirty cache blocks, the block map and the changed parts of the inode
+        table) back to the device, so a long mount doesn't build up dirty
+        state for one huge stall at unmount.
+
+        It writes back every <interval> seconds, and early whenever the
+        dirty share of the block cache passes background_ratio. Past
+        dirty_ratio, writers are throttled: FileSystem.throttle makes them
+        wait for the flusher to catch up (for at most one interval, so a
+        writer can never wait forever on a flusher that's stuck behind it).
+
+        The flusher and the FileSystem's operations take turns through
+        FileSystem.lock.
+    """
+
+    def __init__(self, fs, interval=DEFAULT_WRITEBACK_INTERVAL,
+                 background_ratio=DEFAULT_DIRTY_BACKGROUND_RATIO, dirty_ratio=DEFAULT_DIRTY_RATIO):
+        """
+        :param fs:               the FileSystem to write back
+        :param interval:         seconds between writebacks
+        :param background_ratio: dirty share of the block cache that triggers an early writeback
+        :param dirty_ratio:      dirty share of the block cache at which writers are throttled
+        """
+        assert 0 < background_ratio <= dirty_ratio, "need 0 < background_ratio <= dirty_ratio"
+        self.fs = fs
+        self.interval = interval
+        self.background_ratio = background_ratio
+        self.dirty_ratio = dirty_ratio
+        self.cond = threading.Condition()
+        self.running = True
+        self.kicked = False
+        self.flushes = 0    # writebacks done
+        self.throttled = 0  # times a writer had to wait
+        self.timeouts = 0   # ... and gave up waiting, because the flusher didn't catch up in time
+        self.thread = threading.Thread(target=self.run, name="flusher", daemon=True)
+        self.thread.start()
+
+    def dirtyShare(self):
+        cache = self.fs.blockCache
+        return len(cache.dirty) / cache.capacity
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.running and not self.kicked:
+                    self.cond.wait(self.interval)
+                if not self.running:
+                    return
+                self.kicked = False
+            self.fs.writeback()
+            with self.cond:
+                self.flushes += 1
+                self.cond.notify_all()   # throttled writers can go again
+
+    def dirtied(self, wait=True):
+        """
+        A writer is about to dirty more blocks: kick the flusher or hold the writer back
+        :param wait: False if the writer can't wait (it holds FileSystem.lock)
+        """
+        if threading.current_thread() is self.thread:
+            return      # the flusher's own writes (directories being synced)
+        share = self.dirtyShare()
+        if share < self.background_ratio:
+            return
+        with self.cond:
+            self.kicked = True
+            self.cond.notify_all()
+            if wait and share >= self.dirty_ratio:
+                self.throttled += 1
+                if not self.cond.wait_for(lambda: not self.running or self.dirtyShare() < self.dirty_ratio,
+                                          timeout=self.interval):
+                    self.timeouts += 1
+
+    def stop(self):
+        """ Stop the thread, after any writeback in progress """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        return {"flushes": self.flushes, "throttled": self.throttled, "timeouts": self.timeouts,
+                "dirty_share": self.dirtyShare()}
+
+
+# Nosetests
+def test_background_writeback():
+    import time
+    import FileSystem
+    from INode import INodeType
+    from RAMBlockDevice import RAMBlockDevice
+    rd = RAMBlockDevice("nose_fs_flusher", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=64, writeback_interval=0.05)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    inode.write(0, bytearray(b'b' * (4 * fs.block_size)))
+    deadline = time.time() + 5
+    while fs.flusher.flushes < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert fs.blockCache.dirtyBlocks() == [], "the flusher didn't write the cache back"
+    assert rd.view_block(inode.getDiskAddrOfBlock(fs, 3)) == b'b' * fs.block_size
+    with fs.lock:
+        assert fs.writeINodeMap() == 0, "the inode table was already written back"
+    fs.unmount()
+
+def test_writers_throttled():
+    import FileSystem
+    from INode import INodeType
+    from RAMBlockDevice import RAMBlockDevice
+    rd = RAMBlockDevice("nose_fs_throttle", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=64, writeback_interval=60,
+                                     dirty_background_ratio=0.1, dirty_ratio=0.2)
+    data = bytearray(i % 211 for i in range(4 * fs.block_size))
+    inodes = []
+    for i in range(20):
+        # each write dirties 4 more blocks, but the flusher keeps up
+        assert len(fs.blockCache.dirty) < 64 * 0.2 + 4
+        inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+        inode.write(0, data)
+        inodes.append(inode.inode_num)
+    assert fs.flusher.throttled > 0 and fs.flusher.flushes > 0
+    fs.unmount()
+    fs = FileSystem.FileSystem.mount(rd)
+    for inode_num in inodes:
+        readback = bytearray(len(data))
+        assert fs.inode_map[inode_num].read(0, readback) == len(data)
+        assert readback == data
+    fs.unmount()
+
+def test_no_throttle_under_lock():
+    import FileSystem
+    from INode import INodeType
+    from RAMBlockDevice import RAMBlockDevice
+    rd = RAMBlockDevice("nose_fs_throttle_locked", 300)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=300)
+    fs = FileSystem.FileSystem.mount(rd, cache_blocks=64, writeback_interval=10,
+                                     dirty_background_ratio=0.1, dirty_ratio=0.2)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    with fs.lock:
+        # the flusher can't get in to catch up, so waiting here would wait out the interval
+        inode.write(0, bytearray(b'l' * (20 * fs.block_size)))
+        assert fs.flusher.dirtyShare() >= fs.flusher.dirty_ratio
+        fs.throttle()
+    assert fs.flusher.timeouts == 0, "a writer holding fs.lock was made to wait for the flusher"
+    fs.unmount()
+
+def test_idle_writeback_leaves_device_alone():
+    import time
+    import os
+    import FileSystem
+    from CompressedBlockDevice import CompressedBlockDevice
+    from INode import INodeType
+    cd = CompressedBlockDevice("nose_fs_idle", 300, create=True)
+    FileSystem.FileSystem.createFileSystem(cd, 300)
+    fs = FileSystem.FileSystem.mount(cd, writeback_interval=0.01)
+    with fs.lock:
+        root = FileSystem.File.inode_to_object(fs, fs.inode_map[fs.root_dir_inode], None, "w")
+        root.add_child("idle", fs.inode_map[fs.allocINode(INodeType.FILE)])
+    deadline = time.time() + 5
+    while fs.flusher.flushes < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    size = os.stat(cd.filename).st_size
+    flushes = fs.flusher.flushes
+    while fs.flusher.flushes < flushes + 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert fs.flusher.flushes >= flushes + 5
+    assert os.stat(cd.filename).st_size == size, "an idle file system's image kept growing"
+    fs.unmount()
@@ -1,10 +1,43 @@
+import sys
+from array import array
 from enum import Enum
 from struct import *
 import FileSystem
+import ExtentTree
 
 INodeFormat = Struct("<HIIHBBII")
 BlockPointerFormat = Struct("<I")
 INODE_MAGIC = 0xD0D0F00D
+ZERO_BLOCK = bytes(65536)   # what holes read as (block sizes are 16 bits)
+
+# Blocks of block pointers are used in place, through a memoryview cast to
+# 'I' (see pointerView). That uses the host's byte order, and the on-disk
+# format is little-endian, so a big-endian host works on a byteswapped copy.
+
+
+def pointerView(buff):
+    """
+    The block pointers stored in buff, as an array of ints. On a
+    little-endian host nothing is copied: reading the view reads buff, and
+    assigning to it changes buff. On a big-endian one it's a byteswapped
+    array('I'), and pointerBytes gives back what goes on disk.
+    :param buff: a bytes-like object, a whole number of block pointers long
+    :return:     memoryview (or array) of unsigned 32 bit ints
+    """
+    if sys.byteorder == "little":
+        return memoryview(buff).cast('I')
+    ret = array('I')
+    ret.frombytes(buff)
+    ret.byteswap()
+    return ret
+
+
+def pointerBytes(ptrs):
+    """ The on-disk bytes of block pointers (a pointer view, or an array('I')) """
+    if sys.byteorder == "big":
+        ptrs = array('I', ptrs)
+        ptrs.byteswap()
+    return memoryview(ptrs).cast('B')
 
 
 class INodeType(Enum):
@@ -22,6 +55,9 @@ class INode():
     flags = INodeType.FREE
     perms = 0
     level = 0
+    extents = False     # True: block_ptrs holds an ExtentTree, not block pointers
+    evicted_from = None # the INodeMap that evicted us while we were still held
+    goal = 0            # just past the last block allocated to us (0: not known yet)
     length = 0  # content length in bytes, forgot this in As 2. Struct includes it
     magic_number = 0
     block_ptrs = None
@@ -32,6 +68,11 @@ class INode():
         self.block_ptrs = [0] * INode.BlockPtrsPerInode
         self.fs = fs
 
+    def __del__(self):
+        # evicted from the inode map but held on to: keep what's changed since
+        if self.evicted_from is not None:
+            self.evicted_from._store(self.inode_num, self)
+
     ########### Exported functions
 
     # TODO: Assignment 4
@@ -50,46 +91,156 @@ class INode():
         :param buffer:      read up to len(buffer) bytes into this buffer
         :return:            number of bytes successfully read
         """
-        bytes_read = 0
-        block_to_read = file_offset // self.fs.block_size   # local to inode
-        # print(block_to_read, file_offset)
-        if block_to_read == 0:
-            offset_in_block = file_offset
-        else:
-            offset_in_block = file_offset % block_to_read
-        read_buffer = bytearray(self.fs.block_size)
+        with self.fs.lock:
+            bytes_wanted, runs = self.planRead(file_offset, len(buffer))
+            run_views = [self.fs.block_device.view_blocks(block_addr, count) if from_device else None
+                         for (block_addr, count, from_device) in runs]
+            bytes_read = self.copyRuns(file_offset, buffer, bytes_wanted, runs, run_views)
+        self.fs.op_counts["read"] += 1
+        self.fs.op_counts["read_bytes"] += bytes_read
+        return bytes_read
 
-        while bytes_read < len(buffer):
-            block_addr = self.getDiskAddrOfBlock(self.fs, block_to_read)
-            if block_addr == -1:    # no more data to read
-                break
+    def planRead(self, file_offset: int, nbytes: int):
+        """
+        First half of read: work out which disk blocks cover a request.
+        Blocks that are neither cached nor holes are grouped into runs of
+        consecutive disk addresses, so each run can be one device request.
 
-            if self.fs.block_map[block_addr] == 1:       # skip if block isn't allocated
-                # Get block: check cache first, otherwise read in
-                cached_block = self.fs.blockCache.get(block_addr)
-                if cached_block != None:
-                    read_buffer = cached_block
+        :param file_offset: the offset into the file we want to read from
+        :param nbytes:      how many bytes we'd like
+        :return:            (bytes that can be read, list of (block_addr, count, from_device) runs)
+        """
+        block_size = self.fs.block_size
+        bytes_wanted = min(nbytes, self.length - file_offset)
+        if bytes_wanted <= 0:
+            return 0, []
+        first_block = file_offset // block_size   # local to inode
+        last_block = (file_offset + bytes_wanted - 1) // block_size
+
+        # Look up the disk address of every block covered by the request
+        # (0 for a hole, which reads as zeros)
+        block_addrs = self.getDiskAddrsOfBlocks(self.fs, first_block, last_block - first_block + 1)
+
+        # one cache lookup per block, so the cache's hit counts mean something
+        needs_read = [self._needsDeviceRead(block_addr) for block_addr in block_addrs]
+        runs = []
+        i = 0
+        while i < len(block_addrs):
+            run_len = 1
+            from_device = needs_read[i]
+            if from_device:
+                while (i + run_len < len(block_addrs)
+                       and block_addrs[i + run_len] == block_addrs[i] + run_len
+                       and needs_read[i + run_len]):
+                    run_len += 1
+            runs.append((block_addrs[i], run_len, from_device))
+            i += run_len
+        return max(bytes_wanted, 0), runs
+
+    def copyRuns(self, file_offset: int, buffer, bytes_wanted, runs, run_views):
+        """
+        Second half of read: copy the planned runs into buffer. Blocks that
+        came from the device are added to the block cache, as clean blocks.
+
+        :param file_offset:  the offset the plan was made for
+        :param buffer:       destination
+        :param bytes_wanted: byte count from planRead
+        :param runs:         runs from planRead
+        :param run_views:    for each run, the device data if it came from the device, else None
+        :return:             number of bytes copied
+        """
+        bytes_read = 0
+        for view in self.runViews(file_offset, bytes_wanted, runs, run_views):
+            buffer[bytes_read:bytes_read + len(view)] = view
+            bytes_read += len(view)
+        return bytes_read
+
+    def runViews(self, file_offset: int, bytes_wanted, runs, run_views):
+        """
+        Generate, in file order, a memoryview of the wanted part of each
+        planned block: the cached copy, or zeros for a hole. Blocks that came
+        from the device are copied into the block cache on the way.
+        Arguments as for copyRuns.
+        """
+        block_size = self.fs.block_size
+        bytes_read = 0
+        offset_in_block = file_offset % block_size
+        for (block_addr, run_len, from_device), run_view in zip(runs, run_views):
+            for j in range(run_len):
+                if from_device:
+                    read_buffer = bytearray(run_view[j * block_size:(j + 1) * block_size])
+                    self.fs.blockCache.load(block_addr + j, read_buffer)
+                elif block_addr != 0 and self.fs.block_map[block_addr] == 1:
+                    read_buffer = self.fs.blockCache.peek(block_addr)
+                    if read_buffer is None:
+                        # evicted to make room for this read's own blocks
+                        read_buffer = self.fs.block_device.view_block(block_addr)
                 else:
-                    self.fs.block_device.read_block(block_addr, read_buffer)
-                
-                # Read to end of block, or read to end of buffer, whichever's shorter
-                bytes_to_read = min(self.fs.block_size-offset_in_block, len(buffer)-bytes_read)
-                start = bytes_read
-                stop = start + bytes_to_read
-                read_start = offset_in_block
-                read_stop = read_start + bytes_to_read
-                # print(start,stop,read_start,read_stop)
-                buffer[start:stop] = read_buffer[read_start:read_stop]
-                
+                    # a hole, or a block that isn't allocated reads as zeros
+                    read_buffer = memoryview(ZERO_BLOCK)[:block_size]
+
+                # Read to end of block, or read to end of request, whichever's shorter
+                bytes_to_read = min(block_size - offset_in_block, bytes_wanted - bytes_read)
+                yield memoryview(read_buffer)[offset_in_block:offset_in_block + bytes_to_read]
                 bytes_read += bytes_to_read
                 # Remaining blocks will be (left-)aligned
-                if offset_in_block != 0:
-                    offset_in_block = 0
-
-            block_to_read += 1
+                offset_in_block = 0
 
-        return bytes_read
+    def readViews(self, file_offset: int, nbytes: int):
+        """
+        Read without copying: a scatter list of memoryviews over the cached
+        blocks that hold bytes file_offset .. file_offset+nbytes-1 of this
+        INode (blocks that aren't cached yet are read into the cache first).
+        The views are of the cache's own buffers, so use them before the
+        file is written again, and don't write through them.
 
+        :param file_offset: the offset into the file we want to read from
+        :param nbytes:      read up to this many bytes
+        :return:            list of memoryviews, in file order
+        """
+        with self.fs.lock:
+            bytes_wanted, runs = self.planRead(file_offset, nbytes)
+            run_views = [self.fs.block_device.view_blocks(block_addr, count) if from_device else None
+                         for (block_addr, count, from_device) in runs]
+            views = list(self.runViews(file_offset, bytes_wanted, runs, run_views))
+        self.fs.op_counts["read"] += 1
+        self.fs.op_counts["read_bytes"] += bytes_wanted
+        return views
+
+    def _needsDeviceRead(self, block_addr):
+        """ True if block_addr's contents have to come from the device """
+        return (block_addr != 0 and self.fs.block_map[block_addr] == 1
+                and self.fs.blockCache.get(block_addr) is None)
+
+    def prefetch(self, first_block: int, count: int):
+        """
+        Read ahead: bring this file's blocks first_block .. first_block+count-1
+        into the block cache, with one device request per run of consecutive
+        disk blocks. Blocks past the end of the file, holes and blocks that
+        are cached already are skipped.
+
+        :param first_block: the first block to fetch (local to the inode)
+        :param count:       how many blocks
+        :return:            number of blocks read from the device
+        """
+        block_size = self.fs.block_size
+        cache = self.fs.blockCache
+        fetched = 0
+        with self.fs.lock:
+            wanted = [block_addr for block_addr in self.getDiskAddrsOfBlocks(self.fs, first_block, count)
+                      if block_addr > 0 and self.fs.block_map[block_addr] == 1 and block_addr not in cache]
+            i = 0
+            while i < len(wanted):
+                run_len = 1
+                while i + run_len < len(wanted) and wanted[i + run_len] == wanted[i] + run_len:
+                    run_len += 1
+                run_view = self.fs.block_device.view_blocks(wanted[i], run_len)
+                for j in range(run_len):
+                    cache.load(wanted[i] + j, bytearray(run_view[j * block_size:(j + 1) * block_size]),
+                               prefetched=True)
+                fetched += run_len
+                i += run_len
+        return fetched
 
     # TODO: Assignment 4
     #     Similarly tricky as read, except when you look up blocks, pass the
@@ -103,41 +254,46 @@ class INode():
         :param buffer:       write these bytes to the file
         :return:             number of bytes written
         """
-        block_to_write = file_offset // self.fs.block_size
-        if block_to_write == 0:
-            offset_in_block = file_offset
-        else:
-            offset_in_block = file_offset % block_to_read
-        bytes_written = 0
-
-        while bytes_written < len(buffer):
-            block_addr = self.getDiskAddrOfBlock(self.fs, block_to_write, True)
-
-            w_buffer = bytearray(self.fs.block_size)
-            bytes_to_write = min(self.fs.block_size-offset_in_block, len(buffer)-bytes_written)
-            # If bytes to be written don't fill block, read block to retrieve not-to-be-overwritten bytes
-            if bytes_to_write < self.fs.block_size:
-                # check cache first, otherwise read in
-                cached_block = self.fs.blockCache.get(block_addr)
-                if cached_block != None:
-                    w_buffer = cached_block
-                else:
-                    self.fs.block_device.read_block(block_addr, w_buffer)
+        # hold off while the flusher catches up, if there's too much dirty data
+        self.fs.throttle()
+        with self.fs.lock:
+            block_to_write = file_offset // self.fs.block_size
+            offset_in_block = file_offset % self.fs.block_size
+            bytes_written = 0
+            # allocate every block the write covers up front, in as few extents as we can
+            num_blocks = FileSystem.ceildiv(offset_in_block + len(buffer), self.fs.block_size)
+            block_addrs = self.allocBlocks(self.fs, block_to_write, num_blocks) if len(buffer) > 0 else []
+
+            for block_addr in block_addrs:
+                if block_addr == 0:
+                    break   # out of space
+
+                w_buffer = bytearray(self.fs.block_size)
+                bytes_to_write = min(self.fs.block_size-offset_in_block, len(buffer)-bytes_written)
+                # If bytes to be written don't fill block, read block to retrieve not-to-be-overwritten bytes
+                if bytes_to_write < self.fs.block_size:
+                    # check cache first, otherwise read in
+                    cached_block = self.fs.blockCache.get(block_addr)
+                    if cached_block != None:
+                        w_buffer = cached_block
+                    else:
+                        self.fs.block_device.read_block(block_addr, w_buffer)
+
+                # Write block
+                start = bytes_written
+                stop = start + bytes_to_write
+                write_start = offset_in_block
+                write_stop = write_start + bytes_to_write
+                w_buffer[write_start:write_stop] = buffer[start:stop]
+                self.fs.blockCache.put(block_addr, w_buffer)
 
-            # Write block
-            start = bytes_written
-            stop = start + bytes_to_write
-            write_start = offset_in_block
-            write_stop = write_start + bytes_to_write
-            w_buffer[write_start:write_stop] = buffer[start:stop]
-            self.fs.blockCache.put(block_addr, w_buffer)
-
-            if offset_in_block != 0:
-                offset_in_block = 0
-            bytes_written += bytes_to_write
-            block_to_write += 1
+                if offset_in_block != 0:
+                    offset_in_block = 0
+                bytes_written += bytes_to_write
 
-        self.length += bytes_written
+            self.length = max(self.length, file_offset + bytes_written)
+        self.fs.op_counts["write"] += 1
+        self.fs.op_counts["write_bytes"] += bytes_written
         return bytes_written
 
     # isFile and isDirectory help clients of the API not need to know about
@@ -151,13 +307,30 @@ class INode():
 
     # returns a character with the textual representation of its type
     def charRep(self):
+        return INode.flagsChar(self.flags)
+
+    @staticmethod
+    def flagsChar(flags):
         chars = "_fds"
-        return chars[self.flags.value]
+        return chars[flags.value]
 
     def truncate(self, len):
-        # TODO: mark any allocated blocks in the truncated range
-        #       as free if we shorten the inode
-        self.length = len
+        # if we shorten the inode, free the data blocks past the new end
+        # (emptied pointer blocks stay allocated, ready for regrowth)
+        old_blocks = FileSystem.ceildiv(self.length, self.fs.block_size)
+        new_blocks = FileSystem.ceildiv(len, self.fs.block_size)
+        freed = []
+        with self.fs.lock:
+            if self.extents:
+                # (an extent tree gives back its emptied tree blocks too)
+                freed = ExtentTree.ExtentTree(self.fs, self).truncate(new_blocks)
+            else:
+                for block_number in range(new_blocks, old_blocks):
+                    block_addr = self.clearDiskAddrOfBlock(self.fs, block_number)
+                    if block_addr != 0:
+                        freed.append(block_addr)
+            self.fs.freeBlocks(freed)
+            self.length = len
 
     ########### Internal functions
 
@@ -170,6 +343,15 @@ class INode():
         :param alloc_p:           if it's not there, do we allocate one?
         :return:                -1 on failure, or a > 0 block_number for this INode's block
         """
+        if self.extents:
+            if alloc_p:
+                block_addr = self.allocBlocks(fs, block_number, 1)[0]
+            elif block_number >= FileSystem.ceildiv(self.length, fs.block_size):
+                return -1
+            else:
+                block_addr = ExtentTree.ExtentTree(fs, self).lookup(block_number)
+            return block_addr if block_addr != 0 else -1
+
         if alloc_p:
             self.ensureCapacity(fs, block_number)
             # note: in this case, we ignore the length, but also don't adjust it.
@@ -178,15 +360,136 @@ class INode():
             if block_number >= FileSystem.ceildiv(self.length, fs.block_size):
                 # we're asking for a block past the current file size, in read mode
                 return -1
+            if block_number >= len(self.block_ptrs) * (fs.block_size // 4) ** self.level:
+                # past what the pointer tree can hold yet (a truncate can make
+                # the file that long): a hole
+                return -1
 
         return self.getDiskAddrOfBlock_recursive(fs, block_number, alloc_p, self.block_ptrs, self.level)
 
+    def getDiskAddrsOfBlocks(self, fs:FileSystem, first_block, count):
+        """
+        Get the disk addresses of a range of this INode's blocks, walking the
+        block pointer tree once for the lot (so each pointer block is looked
+        up once, not once per data block). Never allocates.
+        :param fs:          our FileSystem object
+        :param first_block: the first block we're looking for
+        :param count:       how many blocks
+        :return:            list of disk addresses, 0 for holes - shorter than count
+                            if the file ends first (but not if it just has a hole at the end)
+        """
+        last_block = min(first_block + count, FileSystem.ceildiv(self.length, fs.block_size))
+        if first_block >= last_block:
+            return []
+        return self.mappedAddrs(fs, first_block, last_block - first_block)
+
+    def mappedAddrs(self, fs:FileSystem, first_block, count):
+        """ Like getDiskAddrsOfBlocks, but not cut off at the end of the file """
+        if self.extents:
+            return ExtentTree.ExtentTree(fs, self).addrs(first_block, count)
+        ret = []
+        # blocks past what the pointer tree can hold yet (a truncate can make
+        # the file that long) are holes
+        capacity = len(self.block_ptrs) * (fs.block_size // 4) ** self.level
+        if first_block < capacity:
+            self.getDiskAddrsOfBlocks_recursive(fs, first_block, min(count, capacity - first_block),
+                                                self.block_ptrs, self.level, ret)
+        ret.extend([0] * (count - len(ret)))
+        return ret
+
+    def getDiskAddrsOfBlocks_recursive(self, fs:FileSystem, first_block, count, blocks, level, addrs):
+        """ Helper for getDiskAddrsOfBlocks: append the addresses of blocks first_block.. to addrs """
+        if level == 0:
+            addrs.extend(blocks[first_block:first_block + count])
+            return
+        block_pointers_per_index = (fs.block_size // 4) ** level
+        while count > 0:
+            inner_block_num, inner_offset = divmod(first_block, block_pointers_per_index)
+            inner_count = min(count, block_pointers_per_index - inner_offset)
+            inner_blocks = fs.readBlockCache(inner_block_num, blocks, alloc_p=False)
+            if inner_blocks is None:
+                addrs.extend([0] * inner_count)
+            else:
+                self.getDiskAddrsOfBlocks_recursive(fs, inner_offset, inner_count, inner_blocks, level - 1, addrs)
+            first_block += inner_count
+            count -= inner_count
+
+    def allocBlocks(self, fs:FileSystem, first_block, count):
+        """
+        Make sure blocks first_block .. first_block+count-1 of this INode are
+        allocated. The holes among them are filled with extents from
+        fs.allocExtent, each one started just past the block before it, so a
+        file written in one go ends up contiguous on the device.
+        :return: list of the blocks' disk addresses, 0 for any we ran out of space for
+        """
+        self.ensureCapacity(fs, first_block + count - 1)
+        start = max(first_block - 1, 0)
+        addrs = self.mappedAddrs(fs, start, first_block + count - start)
+        hint = addrs[0] + 1 if first_block > 0 and addrs[0] != 0 else self.allocGoal(fs)
+        addrs = addrs[first_block - start:]
+        i = 0
+        while i < count:
+            if addrs[i] != 0:
+                hint = addrs[i] + 1
+                i += 1
+                continue
+            hole = 1
+            while i + hole < count and addrs[i + hole] == 0:
+                hole += 1
+            extent_start, extent_len = fs.allocExtent(1, hole, hint)
+            if extent_len == 0:
+                break
+            addrs[i:i + extent_len] = range(extent_start, extent_start + extent_len)
+            if self.extents:
+                ExtentTree.ExtentTree(fs, self).insert(first_block + i, extent_start, extent_len)
+            else:
+                for j in range(extent_len):
+                    self.setDiskAddrOfBlock(fs, first_block + i + j, extent_start + j)
+            hint = extent_start + extent_len
+            i += extent_len
+            if fs.locality:
+                self.goal = hint
+        return addrs
+
+    def allocGoal(self, fs:FileSystem):
+        """
+        Where our next block should go: right after the last one we got, or
+        for a new INode, the start of its block group (0, the lowest free
+        block, if the file system isn't doing locality)
+        """
+        if not fs.locality:
+            return 0
+        if self.goal == 0:
+            self.goal = fs.blockGroup(self.inode_num) * FileSystem.BLOCK_GROUP_BLOCKS
+        return self.goal
+
+    def setDiskAddrOfBlock(self, fs:FileSystem, block_number, block_addr):
+        """
+        Point <block_number> of this INode at disk block <block_addr>,
+        allocating pointer blocks on the way down as needed (the INode must
+        already be big enough - see ensureCapacity)
+        """
+        block_ptrs_per_block = fs.block_size // 4
+        blocks = self.block_ptrs
+        blocks_addr = 0     # disk address of <blocks>, 0 while we're in the INode itself
+        for level in range(self.level, 0, -1):
+            block_pointers_per_index = block_ptrs_per_block ** level
+            inner_block_num = block_number // block_pointers_per_index
+            inner_blocks = fs.readBlockCache(inner_block_num, blocks, alloc_p=True, blocks_addr=blocks_addr,
+                                             goal=self.allocGoal(fs))
+            blocks_addr = blocks[inner_block_num]
+            blocks = inner_blocks
+            block_number = block_number % block_pointers_per_index
+        blocks[block_number] = block_addr
+        if blocks_addr != 0:
+            fs.blockCache.put(blocks_addr, blocks, meta=True)   # re-mark the pointer block dirty
+
     # TODO: Assignment 3.1
     #     Start by considering just level 0 (the blocks array is an array of block addresses)
     #     Then figure what size is too big for level 0, and how to convert to a level-1 inode,
     #     and how to look up data in a level 1 inode, then use recursion to take care of bigger levels
 
-    def getDiskAddrOfBlock_recursive(self, fs:FileSystem, block_number, alloc_p, blocks, level):
+    def getDiskAddrOfBlock_recursive(self, fs:FileSystem, block_number, alloc_p, blocks, level, blocks_addr=0):
         """
         Helper function for getDiskAddrOfBlock, which takes level and blocks, which makes recursion feasible
         In a lot of ways, this is the real business of an INode.
@@ -197,6 +500,7 @@ class INode():
         :param alloc_p:      whether we should allocate if the sought block is missing
         :param blocks:       the block array at this level
         :param level:        the distance from the leaves of the block pointer tree
+        :param blocks_addr:  disk address of blocks (0 for the INode's own array), so changes can be marked dirty
         :return:             -1 if alloc is false and block is missing, otherwise the disk block address
                                 corresponding to this INode's data @ block_number
         """
@@ -206,7 +510,11 @@ class INode():
                 "internal error:  level 0 blocks overflow {} >= {}".format(block_number, len(blocks))
             if blocks[block_number] == 0:
                 if alloc_p:
-                    blocks[block_number] = fs.allocBlock()
+                    blocks[block_number] = fs.allocBlock(self.allocGoal(fs))
+                    if fs.locality:
+                        self.goal = blocks[block_number] + 1
+                    if blocks_addr != 0:
+                        fs.blockCache.put(blocks_addr, blocks, meta=True)   # re-mark the pointer block dirty
                 else:
                     print("can't find block {} in {}".format(block_number, blocks))
                     return -1
@@ -218,10 +526,43 @@ class INode():
             inner_block_num = block_number // block_pointers_per_index
             inner_offset = block_number % block_pointers_per_index
 
-            inner_blocks = fs.readBlockCache(inner_block_num, blocks)
-            return self.getDiskAddrOfBlock_recursive(fs, inner_offset, alloc_p, inner_blocks, level-1)
+            inner_blocks = fs.readBlockCache(inner_block_num, blocks, alloc_p, blocks_addr, self.allocGoal(fs))
+            if inner_blocks is None:
+                return -1
+            return self.getDiskAddrOfBlock_recursive(fs, inner_offset, alloc_p, inner_blocks, level-1,
+                                                     blocks[inner_block_num])
+
+    def clearDiskAddrOfBlock(self, fs:FileSystem, block_number):
+        """
+        Unhook <block_number> from this INode's block pointer tree (the block
+        itself isn't freed - that's up to the caller)
+        :param fs:           our FileSystem object
+        :param block_number: the block to remove
+        :return:             its disk address, or 0 if it didn't have one
+        """
+        block_ptrs_per_block = fs.block_size // 4
+        if block_number >= len(self.block_ptrs) * (block_ptrs_per_block ** self.level):
+            return 0
+        blocks = self.block_ptrs
+        blocks_addr = 0     # disk address of <blocks>, 0 while we're in the INode itself
+        for level in range(self.level, 0, -1):
+            block_pointers_per_index = block_ptrs_per_block ** level
+            inner_block_num = block_number // block_pointers_per_index
+            if blocks[inner_block_num] == 0:
+                return 0
+            blocks_addr = blocks[inner_block_num]
+            blocks = fs.readBlockCache(inner_block_num, blocks, alloc_p=False)
+            block_number = block_number % block_pointers_per_index
+        block_addr = blocks[block_number]
+        if block_addr != 0:
+            blocks[block_number] = 0
+            if blocks_addr != 0:
+                fs.blockCache.put(blocks_addr, blocks, meta=True)   # re-mark the pointer block dirty
+        return block_addr
 
     def ensureCapacity(self, fs, block_number):
+        if self.extents:
+            return      # extent trees grow as they need to
         block_ptrs_per_block = fs.block_size // 4
 
         while block_number >= len(self.block_ptrs) * (block_ptrs_per_block ** self.level):
@@ -232,18 +573,17 @@ class INode():
     # Preserves the previous INode pointers - just pushes them down a level.
     #
     def increaseLevel(self, fs:FileSystem):
-        new_b = fs.allocBlock()
-        block_ptrs_per_block = fs.block_size // 4
+        new_b = fs.allocBlock(self.allocGoal(fs))
         # bps is our new, fresh acres of block pointers
-        bps = [0] * block_ptrs_per_block
+        bps = pointerView(bytearray(fs.block_size))
         # copy the inodes block pointers to our new array
-        bps[0:len(self.block_ptrs)] = self.block_ptrs
+        bps[0:len(self.block_ptrs)] = array('I', self.block_ptrs)
         # zero out our inode's block pointers:
         self.block_ptrs = [0] * len(self.block_ptrs)
         # enter our new array as the 0th element of our inode
         self.block_ptrs[0] = new_b
         # cache it!
-        fs.blockCache.put(new_b, bps)
+        fs.blockCache.put(new_b, bps, meta=True)
         self.level = self.level + 1
 
     #
@@ -257,12 +597,11 @@ class INode():
         :return: void
         """
         INodeFormat.pack_into(buffer, offset, self.inode_num, self.cdate, self.mdate,
-                              self.perms, self.level, self.flags.value, self.length, INODE_MAGIC)
+                              self.perms, self.level | (ExtentTree.EXTENTS_FLAG if self.extents else 0),
+                              self.flags.value, self.length, INODE_MAGIC)
         off = offset + INodeFormat.size
         #print("pack: {}".format(self.block_ptrs))
-        for i in range(INode.BlockPtrsPerInode):
-            BlockPointerFormat.pack_into(buffer, off, self.block_ptrs[i])
-            off += BlockPointerFormat.size
+        self.packBlockPointers(memoryview(buffer)[off:], self.block_ptrs, INode.BlockPtrsPerInode)
 
     def unpackFromBuffer(self, buffer):
         """
@@ -273,29 +612,25 @@ class INode():
         (self.inode_num, self.cdate, self.mdate, self.perms, self.level, flagVal, self.length, self.magic_number) \
             = INodeFormat.unpack_from(buffer)
         self.flags = INodeType(flagVal)
+        self.extents = self.level & ExtentTree.EXTENTS_FLAG != 0
+        self.level &= ~ExtentTree.EXTENTS_FLAG
         assert self.magic_number == INODE_MAGIC, "Bad magic in INode.unpackFromBuffer"
 
         # unpack the block pointers in the INode structure
         off = INodeFormat.size
-        self.block_ptrs = [0] * INode.BlockPtrsPerInode
-
-        for i in range(INode.BlockPtrsPerInode):
-            (self.block_ptrs[i],) = BlockPointerFormat.unpack_from(buffer, off)
-            off += 4
+        # the INode's own pointers are a list, since INodes are packed and unpacked wholesale
+        self.block_ptrs = self.unpackBlockPointers(memoryview(buffer)[off:], INode.BlockPtrsPerInode).tolist()
 
     def unpackBlockPointers(self, buff, block_ptrs_per_block):
-        ret = [0] * block_ptrs_per_block
-        offset = 0
-        for i in range(block_ptrs_per_block):
-            (ret[i],) = BlockPointerFormat.unpack_from(buff, offset)
-            offset += 4
-        return ret
+        """ View (not copy) the first block_ptrs_per_block block pointers in buff """
+        return pointerView(memoryview(buff)[:block_ptrs_per_block * BlockPointerFormat.size])
 
     def packBlockPointers(self, buff, blocks, block_ptrs_per_block):
-        offset = 0
-        for i in range (block_ptrs_per_block):
-            BlockPointerFormat.pack_into(buff, offset, blocks[i])
-            offset += 4
+        """ Store the first block_ptrs_per_block of blocks (a list or a pointer view) in buff """
+        if isinstance(blocks, list):
+            blocks = array('I', blocks[:block_ptrs_per_block])
+        dest = memoryview(buff)[:block_ptrs_per_block * BlockPointerFormat.size]
+        dest[:] = pointerBytes(blocks[:block_ptrs_per_block])
 
     # debugging function: traverse a tree of block pointers to see that gDAOB works
     def printBlocks(self, depth, blocks, fs):
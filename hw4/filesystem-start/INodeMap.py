@@ -0,0 +1,250 @@
+import weakref
+from collections import OrderedDict
+from struct import calcsize
+from INode import INode, INodeType
+
+DEFAULT_INODE_CACHE = 256
+# where the flags byte sits in a packed INode (see INodeFormat)
+FLAGS_OFFSET = calcsize("<HIIHB")
+
+
+class INodeMap():
+    """ The inode table, loaded lazily. inode_map[n] works like indexing the
+        old list of INodes, but the table blocks are only read from the
+        device the first time one of their inodes is asked for, so mount
+        time doesn't grow with the size of the table.
+
+        At most <capacity> INode objects are kept materialized, least
+        recently used first out. An evicted INode is packed back into its
+        table block, and writeBack writes only the table blocks that changed.
+        Callers may hold on to an INode as long as they like: every INode
+        handed out is also kept in a weak map, so while anyone still holds an
+        evicted one, looking its number up again returns that same object
+        rather than a second copy, and whatever it's changed since its
+        eviction is packed back when it's looked up, written back or dropped.
+    """
+
+    def __init__(self, fs, count, create=False, capacity=DEFAULT_INODE_CACHE):
+        """
+        :param fs:       the FileSystem the table belongs to
+        :param count:    how many inodes in the table
+        :param create:   build a fresh table of free inodes instead of reading the device
+        :param capacity: the most INode objects to keep around
+        """
+        self.fs = fs
+        self.count = count
+        self.capacity = capacity
+        self.bytes_per_inode = INode.bytesPerINode()
+        self.num_blocks = -(-self.bytes_per_inode * count // fs.block_size)
+        self.table = {}     # table block index -> bytearray, for the blocks we've loaded
+        self.on_disk = {}   # table block index -> bytes on the device, if we know them
+        self.live = OrderedDict()   # inode number -> INode, least recently used first
+        self.refs = weakref.WeakValueDictionary()  # inode number -> every INode still in use
+        self.resetStats()
+        if create:
+            image = bytearray(self.num_blocks * fs.block_size)
+            for n in range(count):
+                INode(fs, number=n).packIntoBuffer(image, n * self.bytes_per_inode)
+            for i in range(self.num_blocks):
+                self.table[i] = image[i * fs.block_size:(i + 1) * fs.block_size]
+
+    def resetStats(self):
+        self.hits = 0           # lookups of an INode that was already materialized
+        self.misses = 0         # ... and of one that had to be unpacked
+        self.revived = 0        # hits on an evicted INode someone was still holding
+        self.evictions = 0
+        self.writebacks = 0     # table blocks written
+
+    def _block(self, i):
+        """ Table block i, read in if we haven't yet """
+        block = self.table.get(i)
+        if block is None:
+            loc = self.fs.inode_map_loc + i
+            block = bytearray(self.fs.block_device.view_block(loc))
+            self.table[i] = block
+            self.on_disk[i] = bytes(block)
+        return block
+
+    def _blockRange(self, n):
+        start = n * self.bytes_per_inode
+        return start // self.fs.block_size, (start + self.bytes_per_inode - 1) // self.fs.block_size
+
+    def _record(self, n):
+        """ The packed bytes of inode n (which may straddle two table blocks) """
+        bs = self.fs.block_size
+        start = n * self.bytes_per_inode
+        first, last = self._blockRange(n)
+        if first == last:
+            return memoryview(self._block(first))[start % bs:start % bs + self.bytes_per_inode]
+        return b"".join(self._block(i) for i in range(first, last + 1))[start % bs:start % bs + self.bytes_per_inode]
+
+    def _store(self, n, inode):
+        """ Pack inode n back into the table blocks """
+        bs = self.fs.block_size
+        record = bytearray(self.bytes_per_inode)
+        inode.packIntoBuffer(record, 0)
+        offset = n * self.bytes_per_inode
+        done = 0
+        while done < len(record):
+            block = self._block(offset // bs)
+            in_block = offset % bs
+            count = min(bs - in_block, len(record) - done)
+            block[in_block:in_block + count] = record[done:done + count]
+            done += count
+            offset += count
+
+    def __getitem__(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError("inode number {} out of range".format(n))
+        inode = self.live.get(n)
+        if inode is not None:
+            self.hits += 1
+            self.live.move_to_end(n)
+            return inode
+        inode = self.refs.get(n)
+        if inode is not None:
+            self.hits += 1
+            self.revived += 1
+            inode.evicted_from = None
+        else:
+            self.misses += 1
+            inode = INode(self.fs)
+            inode.unpackFromBuffer(self._record(n))
+            self.refs[n] = inode
+        self.live[n] = inode
+        if len(self.live) > self.capacity:
+            self._trim()
+        return inode
+
+    def prefetch(self, inode_nums):
+        """ Read in the table blocks holding these inodes, without materializing
+            them, one device request per run of consecutive blocks
+        """
+        wanted = set()
+        for n in inode_nums:
+            first, last = self._blockRange(n)
+            wanted.update(i for i in range(first, last + 1) if i not in self.table)
+        bs = self.fs.block_size
+        run = []
+        for i in sorted(wanted) + [None]:
+            if len(run) > 0 and (i is None or i != run[0] + len(run)):
+                view = self.fs.block_device.view_blocks(self.fs.inode_map_loc + run[0], len(run))
+                for j in run:
+                    block = bytearray(view[(j - run[0]) * bs:(j - run[0] + 1) * bs])
+                    self.table[j] = block
+                    self.on_disk[j] = bytes(block)
+                run = []
+            if i is not None:
+                run.append(i)
+
+    def _trim(self):
+        while len(self.live) > self.capacity:
+            n, inode = self.live.popitem(last=False)
+            self._store(n, inode)
+            # if it's still held, it packs itself back again when it's dropped
+            inode.evicted_from = self
+            self.evictions += 1
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        if len(self.live) > capacity:
+            self._trim()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"capacity": self.capacity, "resident": len(self.live), "held": len(self.refs) - len(self.live),
+                "table_blocks": len(self.table),
+                "table_dirty": sum(1 for i, block in self.table.items() if self.on_disk.get(i) != block),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0, "revived": self.revived,
+                "evictions": self.evictions, "writebacks": self.writebacks}
+
+    def __len__(self):
+        return self.count
+
+    def flags(self, n):
+        """ inode n's type, without materializing it """
+        inode = self.refs.get(n)
+        if inode is not None:
+            return inode.flags
+        return INodeType(self._record(n)[FLAGS_OFFSET])
+
+    def writeBack(self):
+        """
+        Pack the INodes in use into the table and write the table blocks that
+        differ from what's on disk, a run of consecutive blocks at a time.
+        Table blocks no INode in use needs are dropped afterwards.
+        :return: the number of table blocks written
+        """
+        inodes = list(self.refs.items())   # (a strong reference each while we work)
+        for n, inode in inodes:
+            self._store(n, inode)
+        changed = [i for i in sorted(self.table) if self.on_disk.get(i) != self.table[i]]
+        written = 0
+        run = []
+        for i in changed + [None]:
+            if len(run) > 0 and (i is None or i != run[0] + len(run)):
+                self.fs.block_device.write_blocks(self.fs.inode_map_loc + run[0],
+                                                  b"".join(self.table[j] for j in run))
+                for j in run:
+                    self.on_disk[j] = bytes(self.table[j])
+                written += len(run)
+                self.writebacks += len(run)
+                run = []
+            if i is not None:
+                run.append(i)
+        in_use = set()
+        for n, inode in inodes:
+            first, last = self._blockRange(n)
+            in_use.update(range(first, last + 1))
+        for i in list(self.table):
+            if i not in in_use:
+                del self.table[i]
+                self.on_disk.pop(i, None)
+        return written
+
+
+# Nosetests
+def test_lazy_inode_map():
+    import FileSystem
+    import File
+    from RAMBlockDevice import RAMBlockDevice
+    rd = RAMBlockDevice("nose_fs_inodes", 400)
+    FileSystem.FileSystem.createFileSystem(rd, block_count=400)
+    fs = FileSystem.FileSystem.mount(rd, inode_cache=16)
+    assert len(fs.inode_map.live) == 0 and len(fs.inode_map.table) == 0, "mount shouldn't load the inode table"
+    n = fs.allocINode(INodeType.FILE)
+    held = fs.inode_map[n]
+    held.length = 1234
+    for i in range(500, 600):
+        assert fs.inode_map.flags(i) == INodeType.FREE
+        fs.inode_map[i].perms = 7
+    assert len(fs.inode_map.live) == 16 and n not in fs.inode_map.live
+    held.length = 4321      # changed after it was evicted
+    assert fs.inode_map[n] is held, "a held INode should be found again, not unpacked a second time"
+    assert fs.inode_map.stats()["revived"] == 1
+
+    f = File.File(fs, None, fs.inode_map[700], "r")
+    f.inode.perms = 5
+    for i in range(500, 600):
+        fs.inode_map[i].perms = 7
+    assert fs.inode_map[700] is f.inode, "an open File's INode should be found again"
+    for i in range(500, 600):
+        fs.inode_map[i].perms = 7
+    assert n not in fs.inode_map.live and 700 not in fs.inode_map.live
+    # changed after eviction and then dropped, without being looked up again
+    f.inode.perms = 6
+    held.length = 5555
+    del f, held
+    assert n not in fs.inode_map.refs and 700 not in fs.inode_map.refs
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(rd)
+    assert fs.inode_map[n].length == 5555 and fs.inode_map.flags(n) == INodeType.FILE
+    assert fs.inode_map[700].perms == 6, "a change made after eviction was lost"
+    assert fs.inode_map[555].perms == 7, "an evicted INode's changes were lost"
+    fs.inode_map.prefetch(range(800, 900))
+    assert len(fs.inode_map.live) == 3 and fs.inode_map[850].flags == INodeType.FREE
+    fs.inode_map[555].perms = 3
+    assert fs.writeINodeMap() == 1, "only the one touched table block should be written"
+    fs.unmount()
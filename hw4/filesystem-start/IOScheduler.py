@@ -0,0 +1,251 @@
+import threading
+from BlockDevice import BlockDevice
+
+
+class IOScheduler:
+    """ An elevator-style I/O scheduler that sits between the FileSystem
+        and its BlockDevice, and looks like a BlockDevice to the layer above.
+
+        Writes aren't sent to the device straight away: each block is queued
+        (a later write to the same block replaces the earlier one), and when
+        the queue is dispatched its blocks are sorted by block number and
+        runs of adjacent blocks are merged into single vectored writes.
+        Reads see queued data, so the layer above never notices the delay.
+
+        The queue is dispatched when it reaches max_queued blocks, on sync,
+        and on close. sync is also the ordering barrier: the FileSystem
+        uses it so that the master block's clean bit only reaches the disk
+        after everything else has.
+    """
+
+    def __init__(self, bd: BlockDevice, max_queued=256):
+        """
+        :param bd:         the BlockDevice to schedule requests for
+        :param max_queued: dispatch once this many blocks are waiting
+        """
+        self.block_device = bd
+        self.filename = bd.filename
+        self.block_size = bd.block_size
+        self.num_blocks = bd.num_blocks
+        self.iostats = bd.iostats   # the device's instrumentation
+        self.max_queued = max_queued
+        self.queue = {}     # block number -> bytes waiting to be written
+        self.lock = threading.Lock()
+        # held for a whole dispatch, so a discard can't punch a hole that
+        # a write already on its way to the device then fills back in
+        self.dispatch_lock = threading.Lock()
+        self.queued = 0         # block writes submitted
+        self.deduplicated = 0   # queued writes replaced by a later write to the same block
+        self.dispatched = 0     # blocks actually written to the device
+        self.requests = 0       # device write requests those blocks were merged into
+        self.read_hits = 0      # block reads served from the queue
+
+    def blocks_to_bytes(self, blocknum):
+        return blocknum * self.block_size
+
+    ########### writes: queued, then sorted and merged in dispatch
+
+    def write_block(self, block_num, buff, pad=False):
+        assert block_num < self.num_blocks, "write_block past end of device"
+        if pad and (len(buff) < self.block_size):
+            buff = bytes(buff) + bytes(self.block_size - len(buff))
+        assert len(buff) == self.block_size, "bad buff size to write_block"
+        self._queue(block_num, [buff])
+
+    def write_blocks(self, start, buff):
+        self.writev_blocks(start, [buff])
+
+    def writev_blocks(self, start, buffers):
+        self._queue(start, buffers)
+
+    def _queue(self, start, buffers):
+        block_num = start
+        with self.lock:
+            for buff in buffers:
+                assert len(buff) % self.block_size == 0, "bad buff size to writev_blocks"
+                view = memoryview(buff)
+                for offset in range(0, len(buff), self.block_size):
+                    assert block_num < self.num_blocks, "writev_blocks past end of device"
+                    if block_num in self.queue:
+                        self.deduplicated += 1
+                    # copy: the caller is free to reuse its buffer as soon as we return
+                    self.queue[block_num] = bytes(view[offset:offset + self.block_size])
+                    self.queued += 1
+                    block_num += 1
+            full = len(self.queue) >= self.max_queued
+        if full:
+            self.dispatch()
+
+    def dispatch(self):
+        """
+        Send everything queued to the device: in block order, with adjacent
+        blocks merged into one vectored write.
+        :return: the number of device requests issued
+        """
+        with self.dispatch_lock:
+            with self.lock:
+                pending = sorted(self.queue.items())
+            requests = 0
+            i = 0
+            while i < len(pending):
+                run_start = pending[i][0]
+                run_len = 1
+                while i + run_len < len(pending) and pending[i + run_len][0] == run_start + run_len:
+                    run_len += 1
+                self.block_device.writev_blocks(run_start, [data for (n, data) in pending[i:i + run_len]])
+                requests += 1
+                i += run_len
+            with self.lock:
+                # only retire what we wrote - a block queued again meanwhile stays queued
+                for (n, data) in pending:
+                    if self.queue.get(n) is data:
+                        del self.queue[n]
+                self.dispatched += len(pending)
+                self.requests += requests
+            return requests
+
+    def sync(self):
+        """ Barrier: dispatch the queue, then sync the device """
+        self.dispatch()
+        self.block_device.sync()
+
+    def close(self):
+        self.dispatch()
+        self.block_device.close()
+
+    def discard(self, start, count=1):
+        with self.dispatch_lock:
+            with self.lock:
+                for n in range(start, start + count):
+                    self.queue.pop(n, None)
+            self.block_device.discard(start, count)
+
+    def is_discarded(self, start, count=1):
+        with self.lock:
+            for n in range(start, start + count):
+                if n in self.queue:
+                    return False
+        return self.block_device.is_discarded(start, count)
+
+    ########### reads: from the device, patched with anything still queued
+
+    def read_block(self, block_num, buff):
+        assert block_num < self.num_blocks, "read_block past end of device"
+        assert len(buff) == self.block_size, "bad buff size to read_block"
+        self.readv_blocks(block_num, [buff])
+
+    def read_blocks(self, start, count, buff):
+        assert len(buff) == self.blocks_to_bytes(count), "bad buff size to read_blocks"
+        self.readv_blocks(start, [buff])
+
+    def readv_blocks(self, start, buffers):
+        count = sum(len(buff) for buff in buffers) // self.block_size
+        # snapshot before reading the device: dispatch only retires a queued
+        # block once it's on the device, so either copy is current
+        self._readv_patched(start, buffers, self._queued_in(start, count))
+
+    def _readv_patched(self, start, buffers, queued):
+        count = sum(len(buff) for buff in buffers) // self.block_size
+        if len(queued) < count:
+            self.block_device.readv_blocks(start, buffers)
+        if len(queued) > 0:
+            block_num = start
+            for buff in buffers:
+                for offset in range(0, len(buff), self.block_size):
+                    if block_num in queued:
+                        buff[offset:offset + self.block_size] = queued[block_num]
+                    block_num += 1
+
+    def view_blocks(self, start, count):
+        queued = self._queued_in(start, count)
+        if len(queued) == 0:
+            return self.block_device.view_blocks(start, count)
+        buff = bytearray(self.blocks_to_bytes(count))
+        self._readv_patched(start, [buff], queued)
+        return memoryview(buff)
+
+    def view_block(self, block_num):
+        return self.view_blocks(block_num, 1)
+
+    def _queued_in(self, start, count):
+        with self.lock:
+            if len(self.queue) == 0:
+                return {}
+            queued = {}
+            for n in range(start, start + count):
+                data = self.queue.get(n)
+                if data is not None:
+                    queued[n] = data
+        self.read_hits += len(queued)
+        return queued
+
+    ########### stats
+
+    def stats(self):
+        """ Counters for this queue; merge_ratio is blocks per device write request """
+        return {
+            "queued": self.queued,
+            "pending": len(self.queue),
+            "deduplicated": self.deduplicated,
+            "dispatched": self.dispatched,
+            "requests": self.requests,
+            "merge_ratio": self.dispatched / self.requests if self.requests > 0 else 0.0,
+            "read_hits": self.read_hits,
+        }
+
+    def statsAsString(self):
+        s = self.stats()
+        return ("queued {queued} ({pending} pending, {deduplicated} deduplicated), "
+                "dispatched {dispatched} blocks in {requests} requests, merge ratio {merge_ratio:.2f}, "
+                "{read_hits} reads served from the queue").format(**s)
+
+
+# Nosetests
+def test_sort_merge_dedup():
+    bd = BlockDevice('testIOSched', 16, create=True)
+    sched = IOScheduler(bd)
+    bs = sched.block_size
+    for n in (7, 5, 6, 5, 12):
+        sched.write_block(n, bytearray([n]) * bs)
+    sched.write_block(5, bytearray(b'\xff') * bs)   # the last write to a block wins
+
+    # queued data is visible before it's dispatched
+    buff = bytearray(3 * bs)
+    sched.read_blocks(5, 3, buff)
+    assert buff == bytes(b'\xff') * bs + bytes([6]) * bs + bytes([7]) * bs
+
+    assert sched.dispatch() == 2, "5,6,7 should merge into one request, 12 in another"
+    s = sched.stats()
+    assert s["queued"] == 6 and s["deduplicated"] == 2 and s["dispatched"] == 4
+    assert s["pending"] == 0
+    sched.close()
+
+    bd = BlockDevice('testIOSched')
+    five = bytearray(bs)
+    twelve = bytearray(bs)
+    bd.read_block(5, five)
+    bd.read_block(12, twelve)
+    bd.close()
+    assert five == bytes(b'\xff') * bs and twelve == bytes([12]) * bs
+
+def test_discard_during_dispatch():
+    bd = BlockDevice('testIOSchedDiscard', 16, create=True)
+    sched = IOScheduler(bd)
+    bs = sched.block_size
+    sched.write_blocks(4, bytearray(b'\x77') * (4 * bs))
+    writev = bd.writev_blocks
+    racer = []
+
+    def writev_racing_discard(start, buffers):
+        # the blocks are freed while their write is on its way to the device
+        racer.append(threading.Thread(target=sched.discard, args=(4, 4)))
+        racer[0].start()
+        racer[0].join(0.1)
+        writev(start, buffers)
+    bd.writev_blocks = writev_racing_discard
+    sched.dispatch()
+    racer[0].join()
+    bd.writev_blocks = writev
+    assert sched.view_blocks(4, 4) == bytes(4 * bs), "a discarded block came back from an in-flight write"
+    assert sched.is_discarded(4, 4)
+    sched.close()
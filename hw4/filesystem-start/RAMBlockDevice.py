@@ -0,0 +1,165 @@
+import mmap
+import threading
+from BlockDevice import *
+
+
+class RAMBlockDevice(BlockDevice):
+    """ A BlockDevice that lives entirely in memory, in one anonymous mmap.
+        It runs at memory speed with no host file I/O at all, which makes it
+        good for benchmarks and for ephemeral scratch file systems.
+
+        Since the storage is a mapping, all of BlockDevice's mmap code
+        paths (including zero-copy view_blocks) are used as they are.
+        Closing a RAM device doesn't throw its contents away - it can be
+        mounted again for as long as the object is around. Use dump to
+        save it to a .dev file and RAMBlockDevice.load to bring one in.
+    """
+
+    def __init__(self, filename="ram", blockCount=-1, blockSize=default_blocksize):
+        """
+        :param filename:   a name for the device, used as dump's default filename
+        :param blockCount: how big the device should be, in blocks
+        :param blockSize:  how big each block should be
+        """
+        assert blockCount > 0, "invalid device size: {}".format(blockCount)
+        self.filename = BlockDevice.normalize_filename(filename, blockSize)
+        self.num_blocks = blockCount
+        self.block_size = blockSize
+        self.seek_lock = threading.Lock()
+        self.iostats = IOStats()
+        if hasattr(mmap, "MAP_PRIVATE"):
+            # private, so pages dropped with MADV_DONTNEED come back as zeros
+            # (a shared anonymous map keeps their contents)
+            self.map = mmap.mmap(-1, self.blocks_to_bytes(blockCount), flags=mmap.MAP_PRIVATE)
+        else:
+            self.map = mmap.mmap(-1, self.blocks_to_bytes(blockCount))
+        self.map_view = memoryview(self.map)
+        # fresh anonymous memory is all zeros, so every block starts out as a hole
+        self.discarded = bytearray(b'\x01') * blockCount
+
+    def close(self):
+        """ Nothing to flush, and the contents stay around for the next mount """
+        pass
+
+    def sync(self):
+        pass
+
+    def discard(self, start, count=1):
+        """ Zero the blocks, giving whole pages back to the OS where we can """
+        assert start + count <= self.num_blocks, "discard past end of device"
+        if count <= 0 or self.is_discarded(start, count):
+            return
+        offset = self.blocks_to_bytes(start)
+        end = offset + self.blocks_to_bytes(count)
+        page_start = -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
+        page_end = end // mmap.PAGESIZE * mmap.PAGESIZE
+        if hasattr(mmap, "MAP_PRIVATE") and hasattr(self.map, "madvise") and page_start < page_end:
+            # private anonymous pages read back as zeros after MADV_DONTNEED
+            self.map.madvise(mmap.MADV_DONTNEED, page_start, page_end - page_start)
+            self.map_view[offset:page_start] = bytes(page_start - offset)
+            self.map_view[page_end:end] = bytes(end - page_end)
+        else:
+            self.map_view[offset:end] = bytes(end - offset)
+        self.discarded[start:start + count] = b'\x01' * count
+        if self.iostats.enabled:
+            self.iostats.record("discard", start, count, self.block_size, 0)
+
+    def dump(self, filename=None):
+        """
+        Save the device to a .dev file, which can be opened as a normal
+        BlockDevice. Holes in the RAM device stay holes in the file.
+        :param filename: the device filename, default is this device's name
+        :return:         the (normalized) filename written
+        """
+        if filename is None:
+            filename = self.filename
+        bd = BlockDevice(filename, self.num_blocks, self.block_size, create=True)
+        if self.discarded[-1]:
+            # creating the file put a marker byte at its very end
+            bd.discard(self.num_blocks - 1)
+        block_num = 0
+        while block_num < self.num_blocks:
+            # copy each run of non-hole blocks with one write
+            run_len = 0
+            while block_num + run_len < self.num_blocks and not self.discarded[block_num + run_len]:
+                run_len += 1
+            if run_len > 0:
+                bd.write_blocks(block_num, self.view_blocks(block_num, run_len))
+                block_num += run_len
+            else:
+                block_num += 1
+        bd.close()
+        return bd.filename
+
+    @staticmethod
+    def load(filename):
+        """
+        Factory method - read a .dev file into a new RAM device
+        :param filename: the device filename
+        :return:         a RAMBlockDevice holding a copy of the file's blocks
+        """
+        bd = BlockDevice(filename)
+        ret = RAMBlockDevice(bd.filename, bd.num_blocks, bd.block_size)
+        block_num = 0
+        while block_num < bd.num_blocks:
+            # holes in the file are already zeros in RAM, so only copy the data
+            run_len = 0
+            while block_num + run_len < bd.num_blocks and not bd.is_discarded(block_num + run_len):
+                run_len += 1
+            if run_len > 0:
+                ret.write_blocks(block_num, bd.view_blocks(block_num, run_len))
+                block_num += run_len
+            else:
+                block_num += 1
+        bd.close()
+        return ret
+
+
+# Nosetests
+def test_ram_read_write():
+    rd = RAMBlockDevice('testRAM', 32)
+    buff = bytearray(rd.block_size)
+    rd.read_block(5, buff)
+    assert buff == bytes(rd.block_size), "fresh RAM device should read as zeros"
+    for i in range(rd.block_size):
+        buff[i] = i % 256
+    rd.write_block(5, buff)
+    assert rd.view_block(5) == buff
+    rd.discard(4, 3)
+    assert rd.view_block(5) == bytes(rd.block_size), "discarded RAM block should read as zeros"
+
+def test_ram_discard_pages():
+    rd = RAMBlockDevice('testRAMDiscard', 32)
+    bs = rd.block_size
+    rd.write_blocks(0, bytearray(b'\xab') * (16 * bs))
+    rd.discard(4, 8)    # whole pages in the middle, when blocks are smaller than pages
+    assert rd.view_block(5) == bytes(bs) and rd.view_blocks(4, 8) == bytes(8 * bs)
+    buff = bytearray(3 * bs)
+    rd.read_blocks(3, 3, buff)
+    assert buff == b'\xab' * bs + bytes(2 * bs)
+    assert rd.view_block(12) == b'\xab' * bs, "blocks past the discard should be left alone"
+
+def test_ram_dump_load():
+    rd = RAMBlockDevice('testRAMDump', 16, 2048)
+    buff = bytearray(b'\x5a') * rd.block_size
+    rd.write_block(3, buff)
+    rd.write_block(11, buff)
+    filename = rd.dump()
+    assert filename == 'testRAMDump.2048.dev'
+
+    bd = BlockDevice(filename)
+    readback = bytearray(bd.block_size)
+    bd.read_block(11, readback)
+    bd.close()
+    assert readback == buff
+
+    loaded = RAMBlockDevice.load(filename)
+    assert loaded.num_blocks == 16 and loaded.block_size == 2048
+    assert loaded.view_block(3) == buff and loaded.view_block(4) == bytes(2048)
+
+def test_ram_dump_trailing_hole():
+    rd = RAMBlockDevice('testRAMDumpHole', 8)
+    rd.write_block(2, bytearray(b'\x3c') * rd.block_size)
+    loaded = RAMBlockDevice.load(rd.dump())
+    assert loaded.view_block(7) == bytes(rd.block_size), "the last block was a hole, and should read as zeros"
+    assert loaded.view_blocks(0, 8) == rd.view_blocks(0, 8)
@@ -3,6 +3,7 @@ import readline
 from FileSystem import FileSystem
 import BlockDevice
 from INode import INodeType
+from ExtentTree import ExtentTree
 
 class Shell:
     """
@@ -118,6 +119,42 @@ def repl():
             as_str = fs.inodeMapAsString()
             print(as_str)
 
+        elif words[0] == 'iosched':
+            if fs == None:
+                print("{} only works on mounted file systems".format(words[0]))
+                continue
+            print(fs.block_device.statsAsString())
+
+        elif words[0] == 'iostat':
+            if fs == None:
+                print("{} only works on mounted file systems".format(words[0]))
+                continue
+            if len(words) == 2 and words[1] == 'reset':
+                fs.resetIOStats()
+            elif len(words) == 2 and words[1] in ('on', 'off'):
+                fs.block_device.iostats.enabled = words[1] == 'on'
+            else:
+                print(fs.ioStatsAsString())
+
+        elif words[0] == 'cache':
+            if fs == None:
+                print("{} only works on mounted file systems".format(words[0]))
+                continue
+            if len(words) == 2 and words[1] == 'reset':
+                fs.resetCacheStats()
+            elif len(words) == 4 and words[1] == 'resize' and words[2] in ('block', 'dentry', 'inode'):
+                fs.resizeCache(words[2], int(words[3]))
+            elif len(words) == 1:
+                print(fs.cacheStatsAsString())
+            else:
+                print("usage: cache [reset | resize block|dentry|inode <capacity>]")
+
+        elif words[0] == 'frag':
+            if fs == None:
+                print("{} only works on mounted file systems".format(words[0]))
+                continue
+            print(fs.fragmentationAsString())
+
         elif words[0] == 'alloc_block':
             if fs == None:
                 print("{} only works on mounted file systems".format(words[0]))
@@ -153,7 +190,10 @@ def repl():
                 continue
             num = int(words[1])
             inode = fs.inode_map[num]
-            inode.printBlocks(inode.level, inode.block_ptrs, fs)
+            if inode.extents:
+                print(ExtentTree(fs, inode).asString())
+            else:
+                inode.printBlocks(inode.level, inode.block_ptrs, fs)
 
         elif words[0] == 'free_block':
             if fs == None:
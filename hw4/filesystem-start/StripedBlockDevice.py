@@ -0,0 +1,219 @@
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from BlockDevice import *
+
+DEFAULT_STRIPE_UNIT = 16
+
+
+class StripedBlockDevice(BlockDevice):
+    """ A RAID-0 style BlockDevice: logical blocks are spread round-robin,
+        stripe_unit blocks at a time, over several member BlockDevices
+        (each one an ordinary device file). A multi-block request is split
+        per member, and the member pieces are served in parallel from a
+        thread pool, so throughput isn't capped by a single host file.
+
+        The member files use the usual device naming scheme with the member
+        number and the stripe unit added to the descriptive part: striping
+        "mydev.2048.dev" over 4 members, 16 blocks at a time, uses
+        mydev-0-su16.2048.dev ... mydev-3-su16.2048.dev. That's where
+        opening finds the stripe unit, like the block size.
+    """
+
+    def __init__(self, filename="stripes.1024.dev", blockCount=-1,
+                 blockSize=default_blocksize, create=False, use_mmap=False,
+                 members=None, stripe_unit=None):
+        """
+        :param filename:    the device filename (no file of this name is created)
+        :param blockCount:  how big the device should be, in blocks - rounded
+                            up to a whole number of stripes
+        :param blockSize:   how big each block should be
+        :param create:      whether to create the member files or just open them
+        :param use_mmap:    memory-map the member files (see BlockDevice)
+        :param members:     how many member files; when opening, default is
+                            however many member files exist
+        :param stripe_unit: consecutive blocks per member before moving to the next
+                            (default DEFAULT_STRIPE_UNIT); when opening, default is
+                            the one in the member filenames, and any other is an error
+        """
+        self.map = None
+        self.map_view = None
+        self.seek_lock = threading.Lock()
+        self.iostats = IOStats()
+        if create:
+            if stripe_unit is None:
+                stripe_unit = DEFAULT_STRIPE_UNIT
+            assert stripe_unit > 0, "invalid stripe unit: {}".format(stripe_unit)
+            self.stripe_unit = stripe_unit
+            assert members is not None and members > 0, "invalid member count: {}".format(members)
+            self.filename = BlockDevice.normalize_filename(filename, blockSize)
+            self.block_size = blockSize
+            stripe_blocks = members * stripe_unit
+            stripes = -(-blockCount // stripe_blocks)
+            member_blocks = stripes * stripe_unit
+        else:
+            self.filename = BlockDevice.normalize_filename(filename)
+            self.block_size = BlockDevice.filename_to_blocksize(self.filename)
+            self.stripe_unit = self._saved_stripe_unit()
+            assert stripe_unit is None or stripe_unit == self.stripe_unit, \
+                "{} was created with stripe unit {}, not {}".format(self.filename, self.stripe_unit, stripe_unit)
+            if members is None:
+                members = 0
+                while os.path.exists(self._member_filename(members)):
+                    members += 1
+                assert members > 0, "no member files for {}".format(self.filename)
+        self.members = []
+        for i in range(members):
+            if create:
+                member = BlockDevice(self._member_filename(i), member_blocks, blockSize,
+                                     create=True, use_mmap=use_mmap)
+            else:
+                member = BlockDevice(self._member_filename(i), use_mmap=use_mmap)
+            self.members.append(member)
+        member_blocks = min(m.num_blocks for m in self.members)
+        assert member_blocks % self.stripe_unit == 0, "member size isn't a whole number of stripe units"
+        self.num_blocks = member_blocks * members
+        self.discarded = bytearray(self.num_blocks)   # the members track their own holes too
+        self.pool = ThreadPoolExecutor(max_workers=members)
+
+    def _member_filename(self, i, stripe_unit=None):
+        parts = self.filename.split(".")
+        parts[0] = "{}-{}-su{}".format(parts[0], i, self.stripe_unit if stripe_unit is None else stripe_unit)
+        return ".".join(parts)
+
+    def _saved_stripe_unit(self):
+        """ The stripe unit in the name of member 0's file """
+        parts = self.filename.split(".")
+        prefix = "{}-0-su".format(parts[0])
+        pattern = ".".join([glob.escape(prefix) + "*"] + [glob.escape(part) for part in parts[1:]])
+        units = [name.split(".")[0][len(prefix):] for name in glob.glob(pattern)]
+        units = [int(unit) for unit in units if unit.isdecimal()]
+        assert len(units) > 0, "no member files for {}".format(self.filename)
+        assert len(units) == 1, "{} has member files for stripe units {}".format(self.filename, units)
+        return units[0]
+
+    def locate(self, block_num):
+        """
+        :param block_num: a logical block number
+        :return:          (member index, block number within that member)
+        """
+        stripe, offset = divmod(block_num, self.stripe_unit)
+        row, member = divmod(stripe, len(self.members))
+        return member, row * self.stripe_unit + offset
+
+    def _split(self, offset, buffers):
+        """
+        Split a request at byte <offset> into per-member runs.
+        :return: dict member index -> list of (member start block, [block views])
+        """
+        per_member = {}
+        block_num = offset // self.block_size
+        for buff in buffers:
+            view = memoryview(buff)
+            for start in range(0, len(buff), self.block_size):
+                member, member_block = self.locate(block_num)
+                runs = per_member.setdefault(member, [])
+                if len(runs) > 0 and runs[-1][0] + len(runs[-1][1]) == member_block:
+                    runs[-1][1].append(view[start:start + self.block_size])
+                else:
+                    runs.append((member_block, [view[start:start + self.block_size]]))
+                block_num += 1
+        return per_member
+
+    def _run_members(self, op, per_member):
+        def do_member(member, runs):
+            for (member_start, views) in runs:
+                op(self.members[member], member_start, views)
+        if len(per_member) == 1:
+            # nothing to overlap, don't pay for the hand-off
+            for member, runs in per_member.items():
+                do_member(member, runs)
+            return
+        futures = [self.pool.submit(do_member, member, runs) for member, runs in per_member.items()]
+        for f in futures:
+            f.result()   # re-raises a member's exception here
+
+    def _readv(self, offset, buffers):
+        self._run_members(BlockDevice.readv_blocks, self._split(offset, buffers))
+
+    def _writev(self, offset, buffers):
+        self._run_members(BlockDevice.writev_blocks, self._split(offset, buffers))
+
+    def discard(self, start, count=1):
+        assert start + count <= self.num_blocks, "discard past end of device"
+        if count <= 0 or self.is_discarded(start, count):
+            return
+        per_member = self._split(self.blocks_to_bytes(start),
+                                 [bytearray(self.blocks_to_bytes(count))])
+        for member, runs in per_member.items():
+            for (member_start, views) in runs:
+                self.members[member].discard(member_start, len(views))
+        self.discarded[start:start + count] = b'\x01' * count
+        if self.iostats.enabled:
+            self.iostats.record("discard", start, count, self.block_size, 0)
+
+    def sync(self):
+        for member in self.members:
+            member.sync()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for member in self.members:
+            member.close()
+
+
+# Nosetests
+def test_striped_layout():
+    sd = StripedBlockDevice('testStriped', 50, create=True, members=3, stripe_unit=4)
+    assert sd.num_blocks == 60, "device should round up to whole stripes"
+    assert sd.locate(0) == (0, 0) and sd.locate(5) == (1, 1) and sd.locate(12) == (0, 4)
+    bs = sd.block_size
+    data = bytearray(i % 256 for i in range(20 * bs))
+    for i in range(0, len(data), bs):
+        data[i] = i // bs     # tag each block with its number
+    sd.write_blocks(3, data)
+    sd.close()
+
+    sd = StripedBlockDevice('testStriped')
+    assert sd.stripe_unit == 4, "the stripe unit should come from the member files"
+    assert len(sd.members) == 3 and sd.num_blocks == 60
+    readback = bytearray(20 * bs)
+    sd.read_blocks(3, 20, readback)
+    # block 3 + k lives on the member locate says it does
+    member, member_block = sd.locate(3 + 7)
+    raw = bytearray(bs)
+    sd.members[member].read_block(member_block, raw)
+    sd.close()
+    assert readback == data, "striped read doesn't match striped write"
+    assert raw == data[7 * bs:8 * bs], "block isn't where locate put it"
+
+def test_striped_filesystem():
+    import FileSystem
+    from INode import INodeType
+    sd = StripedBlockDevice('nose_fs_striped', 400, create=True, members=4, stripe_unit=8)
+    FileSystem.FileSystem.createFileSystem(sd, 400)
+    fs = FileSystem.FileSystem.mount(sd)
+    inode = fs.inode_map[fs.allocINode(INodeType.FILE)]
+    data = bytearray(i % 241 for i in range(40 * fs.block_size))
+    inode.write(0, data)
+    fs.unmount()
+
+    fs = FileSystem.FileSystem.mount(StripedBlockDevice('nose_fs_striped', stripe_unit=8))
+    readback = bytearray(len(data))
+    assert fs.inode_map[inode.inode_num].read(0, readback) == len(data)
+    fs.unmount()
+    assert readback == data
+
+def test_striped_wrong_stripe_unit():
+    sd = StripedBlockDevice('testStripedUnit', 32, create=True, members=2, stripe_unit=8)
+    sd.close()
+    try:
+        StripedBlockDevice('testStripedUnit', stripe_unit=4)
+    except AssertionError:
+        pass
+    else:
+        assert False, "opening with a different stripe unit should fail"
+    sd = StripedBlockDevice('testStripedUnit', stripe_unit=8)
+    assert sd.stripe_unit == 8 and sd.num_blocks == 32
+    sd.close()